@@ -22,10 +22,25 @@ def create_app(config_name='default'):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     
+    # Пул соединений с БД настраивается до создания движка
+    from app.database import database, engine_options
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    
     # Инициализация расширений
     db.init_app(app)
+    database.init_app(app)
+    
+    # Чтение с реплик на маршрутах только на чтение
+    from app.replicas import replicas
+    replicas.init_app(app)
+    
+    # Метрики запросов, событий Socket.IO и SQL
+    from app.metrics import metrics
+    metrics.init_app(app)
     login_manager.init_app(app)
-    socketio.init_app(app)
+    socketio.init_app(app,
+                      message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+                      channel=app.config['SOCKETIO_CHANNEL'])
     migrate.init_app(app, db)
     mail.init_app(app)
     
@@ -40,6 +55,49 @@ def create_app(config_name='default'):
     os.makedirs(app.config['POSTS_FOLDER'], exist_ok=True)
     os.makedirs(app.config['CHAT_FOLDER'], exist_ok=True)
     
+    # Хеширование паролей
+    from app import passwords
+    passwords.init_app(app)
+    
+    # Кэш
+    from app.cache import cache
+    cache.init_app(app)
+    
+    # Загрузчик пользователя для Flask-Login (кэш current_user)
+    from app import identity  # noqa: F401
+    
+    # Кэш страниц для анонимных читателей
+    from app.page_cache import page_cache
+    page_cache.init_app(app)
+    
+    # Функции шаблонов для вариантов изображений
+    from app import images
+    images.init_app(app)
+    
+    # Буферизованный счетчик просмотров
+    from app.view_counter import view_counter
+    view_counter.init_app(app)
+    
+    # Материализованная статистика сайта
+    from app.site_stats import site_stats
+    site_stats.init_app(app)
+    
+    # Индикатор «печатает» в чате
+    from app.chat.typing_indicator import typing_indicator
+    typing_indicator.init_app(app)
+    
+    # Присутствие пользователей в чате
+    from app.chat.presence import presence
+    presence.init_app(app)
+    
+    # Отложенная запись сообщений чата
+    from app.chat.writer import chat_writer
+    chat_writer.init_app(app)
+    
+    # Очередь исходящих писем
+    from app.mailer import outbox
+    outbox.init_app(app)
+    
     # Регистрация blueprints
     from app.auth import auth_bp
     from app.forum import forum_bp
@@ -53,5 +111,9 @@ def create_app(config_name='default'):
     app.register_blueprint(chat_bp, url_prefix='/chat')
     app.register_blueprint(profile_bp, url_prefix='/profile')
     
+    # CLI команды
+    from app.commands import forum_cli
+    app.cli.add_command(forum_cli)
+    
     return app
 
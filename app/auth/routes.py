@@ -3,9 +3,10 @@
 from flask import render_template, redirect, url_for, flash, request, session
 from flask_login import login_user, logout_user, current_user, login_required
 from app.auth import auth_bp
-from app import db
+from app import db, identity
 from app.models import User
 from app.utils import send_verification_email
+from app.site_stats import site_stats
 
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
@@ -51,6 +52,7 @@ def register():
         user = User(username=username, email=email)
         user.set_password(password)
         db.session.add(user)
+        site_stats.incr('users')
         db.session.commit()
         
         # Отправка кода подтверждения
@@ -80,6 +82,9 @@ def login():
         user = User.query.filter_by(email=email).first()
         
         if user and user.check_password(password):
+            # Сохраняем хеш, пересчитанный с новыми параметрами
+            db.session.commit()
+            
             # Проверка подтверждения email
             if not user.email_verified:
                 flash('Пожалуйста, подтвердите ваш email перед входом.', 'warning')
@@ -137,6 +142,7 @@ def verify_email():
         
         if user.verify_code(code):
             db.session.commit()
+            identity.invalidate(user.id)
             session.pop('pending_verification_user_id', None)
             flash('Email успешно подтвержден! Теперь вы можете войти.', 'success')
             return redirect(url_for('auth.login'))
@@ -0,0 +1,216 @@
+"""Массовая загрузка строк в таблицы
+
+На PostgreSQL строки передаются командой ``COPY ... FROM STDIN`` (формат
+CSV) пачками по batch_size; на других СУБД (SQLite для проверок) —
+многострочным INSERT. Строки читаются из итератора, поэтому в памяти
+держится только текущая пачка. Каждая пачка — отдельная транзакция.
+
+Загрузка идет мимо ORM: денормализованные счетчики, сводки переписок,
+последовательности id и поисковый индекс SQLite после нее приводит в
+порядок finish(). Вторичные индексы на время загрузки можно удалить
+(drop_indexes) и построить один раз в конце (create_indexes) — это
+быстрее, чем обновлять их на каждую строку.
+
+Загрузка и пересчет на больших таблицах идут дольше DB_STATEMENT_TIMEOUT,
+поэтому выполняются внутри unlimited_statements().
+"""
+
+import csv
+import io
+import itertools
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+from app import db
+
+# Обозначение NULL в потоке COPY (пустая строка остается пустой строкой)
+NULL = r'\N'
+
+
+def _table(table):
+    return getattr(table, '__table__', table)
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _csv_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return value
+
+
+def _copy(connection, table, columns, chunk):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL)
+    for row in chunk:
+        writer.writerow([_csv_value(value) for value in row])
+    buffer.seek(0)
+
+    cursor = connection.driver_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{NULL}')",
+            buffer
+        )
+    finally:
+        cursor.close()
+
+
+def copy_rows(table, columns, rows, batch_size=10000, progress=None, on_batch=None):
+    """
+    Загрузить строки в таблицу
+
+    Args:
+        table: модель или Table
+        columns: имена столбцов
+        rows: итератор кортежей значений в порядке columns
+        batch_size: строк в одной пачке (транзакции)
+        progress: функция progress(загружено строк) после каждой пачки
+        on_batch: функция on_batch(connection, загружено строк), выполняется
+            в транзакции пачки (например, для записи позиции импорта)
+
+    Returns:
+        количество загруженных строк
+    """
+    table = _table(table)
+    engine = db.engine
+    loaded = 0
+
+    for chunk in _chunks(rows, batch_size):
+        with engine.begin() as connection:
+            if engine.dialect.name == 'postgresql':
+                _copy(connection.connection, table, columns, chunk)
+            else:
+                connection.execute(db.insert(table), [dict(zip(columns, row)) for row in chunk])
+            loaded += len(chunk)
+            if on_batch:
+                on_batch(connection, loaded)
+        if progress:
+            progress(loaded)
+
+    return loaded
+
+
+def next_id(table):
+    """Первый свободный id таблицы (для строк с заранее известными id)"""
+    table = _table(table)
+    return (db.session.scalar(db.select(db.func.max(table.c.id))) or 0) + 1
+
+
+def _search_indexes(tables):
+    # GIN-индексы поиска PostgreSQL (app/search.py)
+    from app import search
+    names = {_table(table).name for table in tables}
+    return [f'ix_{name}_search_vector' for name in search._PG_VECTORS if name in names]
+
+
+def drop_indexes(tables):
+    """Удалить вторичные неуникальные индексы таблиц до загрузки"""
+    for table in tables:
+        for index in _table(table).indexes:
+            if not index.unique:
+                db.session.execute(db.text(f'DROP INDEX IF EXISTS {index.name}'))
+    if db.engine.dialect.name == 'postgresql':
+        for name in _search_indexes(tables):
+            db.session.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+    db.session.commit()
+
+
+def create_indexes(tables):
+    """Построить индексы, удаленные drop_indexes (недостающие)"""
+    from app import search
+
+    connection = db.session.connection()
+    for table in tables:
+        for index in _table(table).indexes:
+            if not index.unique:
+                index.create(connection, checkfirst=True)
+    if db.engine.dialect.name == 'postgresql':
+        names = _search_indexes(tables)
+        for statement in search.PG_SCHEMA:
+            if statement.startswith('CREATE INDEX') and any(name in statement for name in names):
+                db.session.execute(db.text(statement))
+        db.session.execute(db.text('ANALYZE ' + ', '.join(_table(table).name for table in tables)))
+    db.session.commit()
+
+
+@contextmanager
+def unlimited_statements():
+    """
+    Снять DB_STATEMENT_TIMEOUT для транзакций внутри блока (PostgreSQL)
+
+    Действует только на транзакции, начатые в текущем потоке (гринлете):
+    фоновая задача веб-процесса не снимает таймаут с параллельных запросов.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    owner = threading.get_ident()
+
+    def no_timeout(connection):
+        if threading.get_ident() == owner:
+            connection.exec_driver_sql('SET LOCAL statement_timeout = 0')
+
+    # Выполняется после обработчика app.database, поэтому его SET LOCAL перекрывается
+    event.listen(engine, 'begin', no_timeout)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'begin', no_timeout)
+
+
+def reset_sequences(tables):
+    """Сдвинуть последовательности id PostgreSQL за загруженные строки"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        name = _table(table).name
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), "
+            f"GREATEST((SELECT max(id) FROM {name}), 1))"
+        ))
+    db.session.commit()
+
+
+def finish(tables, echo=print):
+    """
+    Привести в порядок производные данные после загрузки
+
+    Последовательности id, счетчики топиков и пользователей, сводки
+    переписок, поисковый индекс (SQLite) и статистика сайта.
+    """
+    from app.models import User, Topic, Conversation
+    from app.site_stats import site_stats
+    from app import search
+
+    reset_sequences(tables)
+
+    Topic.reconcile_counters()
+    db.session.commit()
+    echo('✓ Счетчики топиков пересчитаны')
+
+    User.reconcile_counters()
+    db.session.commit()
+    echo('✓ Счетчики пользователей пересчитаны')
+
+    count = Conversation.rebuild()
+    db.session.commit()
+    echo(f'✓ Переписок: {count}')
+
+    if search.reindex() is not None:
+        db.session.commit()
+        echo('✓ Поисковый индекс пересоздан')
+
+    site_stats.refresh()
+    echo('✓ Статистика сайта обновлена')
@@ -0,0 +1,170 @@
+"""Слой кэширования
+
+Бэкенд выбирается параметром CACHE_BACKEND. По умолчанию используется
+локальный кэш в памяти процесса; при нескольких процессах нужен общий
+бэкенд (redis), иначе счетчики в разных процессах разойдутся. Бэкенды
+реализуют один интерфейс: get/set/add/delete/pop/incr.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCacheBackend:
+    """LRU-кэш в памяти процесса с временем жизни записей"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return entry
+
+    def _set_entry(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def get(self, key):
+        """Значение по ключу или None"""
+        with self._lock:
+            entry = self._get_entry(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        """Записать значение (ttl в секундах, None — без ограничения)"""
+        with self._lock:
+            self._set_entry(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Записать значение, только если ключа нет. Возвращает True при записи"""
+        with self._lock:
+            if self._get_entry(key) is not None:
+                return False
+            self._set_entry(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        """Удалить ключ"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop(self, key):
+        """Атомарно получить значение и удалить ключ (None, если ключа нет)"""
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return None
+            del self._data[key]
+            return entry[0]
+
+    def incr(self, key, delta=1):
+        """
+        Изменить числовое значение
+
+        Returns:
+            новое значение или None, если ключа нет (кэш не создает
+            значение сам, чтобы не подменять данные из БД)
+        """
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return None
+
+            value = entry[0] + delta
+            self._data[key] = (value, entry[1])
+            return value
+
+
+class RedisCacheBackend:
+    """Общий кэш в Redis для нескольких процессов и узлов"""
+
+    # incr только для существующего ключа, как у локального бэкенда
+    _INCR_IF_EXISTS = """
+        if redis.call('exists', KEYS[1]) == 1 then
+            return redis.call('incrby', KEYS[1], ARGV[1])
+        end
+        return nil
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='forum:'):
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+        self._incr = self._redis.register_script(self._INCR_IF_EXISTS)
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._redis.set(self.prefix + key, json.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def pop(self, key):
+        # GETDEL (Redis 6.2+): два клиента не получат одно значение
+        value = self._redis.getdel(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def incr(self, key, delta=1):
+        return self._incr(keys=[self.prefix + key], args=[delta])
+
+
+class Cache:
+    """Расширение Flask для доступа к бэкенду кэша"""
+
+    backends = {
+        'local': LocalCacheBackend,
+        'redis': RedisCacheBackend,
+    }
+
+    def __init__(self):
+        self.backend = LocalCacheBackend()
+
+    def init_app(self, app):
+        backend_cls = self.backends[app.config['CACHE_BACKEND']]
+        self.backend = backend_cls(**app.config['CACHE_OPTIONS'])
+        app.extensions['cache'] = self
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        return self.backend.add(key, value, ttl)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def pop(self, key):
+        return self.backend.pop(key)
+
+    def incr(self, key, delta=1):
+        return self.backend.incr(key, delta)
+
+
+cache = Cache()
@@ -1,35 +1,47 @@
 """WebSocket события для чата"""
 
-from flask import request
+from flask import request, current_app
 from flask_login import current_user
 from flask_socketio import emit, join_room, leave_room
-from app import socketio, db
-from app.models import ChatMessage, User
-from app.utils import allowed_file, save_picture
-import base64
-import secrets
-import os
+from app import socketio, db, identity
+from app.models import ChatMessage, User, Conversation
+from app.chat.unread import get_unread_count, change_unread_count
+from app.chat.receipts import mark_read, notify_read
+from app.chat.uploads import claim_upload
+from app.chat.typing_indicator import typing_indicator, notify as notify_typing
+from app.chat.presence import presence
+from app.chat.writer import chat_writer
+from app.metrics import metrics
 
 
 @socketio.on('connect')
+@metrics.socket_event
 def handle_connect():
     """Подключение к WebSocket"""
     if current_user.is_authenticated:
         # Присоединяемся к персональной комнате пользователя
         join_room(f'user_{current_user.id}')
+        presence.connect(current_user.id, request.sid)
         emit('connected', {'user_id': current_user.id})
+        emit('unread_count', {'count': get_unread_count(current_user.id)})
     else:
         return False  # Отклоняем подключение неавторизованных
 
 
 @socketio.on('disconnect')
+@metrics.socket_event
 def handle_disconnect():
     """Отключение от WebSocket"""
     if current_user.is_authenticated:
         leave_room(f'user_{current_user.id}')
+        presence.disconnect(current_user.id, request.sid)
+        for room in typing_indicator.stop_all(current_user.id):
+            notify_typing(current_user.id, room, False, skip_sid=request.sid)
+    identity.forget_connection(request.sid)
 
 
 @socketio.on('join_chat')
+@metrics.socket_event
 def handle_join_chat(data):
     """Присоединение к чату с пользователем"""
     if not current_user.is_authenticated:
@@ -51,6 +63,7 @@ def handle_join_chat(data):
 
 
 @socketio.on('leave_chat')
+@metrics.socket_event
 def handle_leave_chat(data):
     """Покинуть чат"""
     if not current_user.is_authenticated:
@@ -62,9 +75,13 @@ def handle_leave_chat(data):
     
     room = f'chat_{min(current_user.id, recipient_id)}_{max(current_user.id, recipient_id)}'
     leave_room(room)
+    
+    if typing_indicator.stop(current_user.id, room):
+        notify_typing(current_user.id, room, False)
 
 
 @socketio.on('send_message')
+@metrics.socket_event
 def handle_send_message(data):
     """Отправка сообщения"""
     if not current_user.is_authenticated:
@@ -72,53 +89,64 @@ def handle_send_message(data):
     
     recipient_id = data.get('recipient_id')
     content = data.get('content', '').strip()
-    image_data = data.get('image')  # Base64 encoded image
+    image_token = data.get('image_token')  # Токен из POST /chat/upload
     
     if not recipient_id or not content:
         emit('error', {'message': 'Не указан получатель или текст сообщения'})
         return
     
     # Проверяем существование получателя
-    recipient = User.query.get(recipient_id)
-    if not recipient:
+    if chat_writer.enabled:
+        recipient_exists = chat_writer.known_user(recipient_id)
+    else:
+        recipient_exists = User.query.get(recipient_id) is not None
+    if not recipient_exists:
         emit('error', {'message': 'Пользователь не найден'})
         return
     
-    # Обработка изображения если есть
+    # Изображение уже загружено по HTTP, здесь только ссылка на файл
     image_filename = None
-    if image_data:
-        try:
-            # Декодируем base64
-            image_bytes = base64.b64decode(image_data.split(',')[1])
-            
-            # Генерируем имя файла
-            random_hex = secrets.token_hex(8)
-            image_filename = f'{random_hex}.png'
-            
-            # Сохраняем файл
-            from flask import current_app
-            image_path = os.path.join(current_app.config['CHAT_FOLDER'], image_filename)
-            with open(image_path, 'wb') as f:
-                f.write(image_bytes)
-        except Exception as e:
-            print(f'Error saving image: {e}')
-    
-    # Создаем сообщение в БД
-    message = ChatMessage(
-        content=content,
-        image=image_filename,
-        sender_id=current_user.id,
-        recipient_id=recipient_id
-    )
-    
-    db.session.add(message)
-    db.session.commit()
-    
-    # Формируем данные сообщения
-    message_data = message.to_dict()
+    if image_token:
+        image_filename = claim_upload(image_token, current_user.id)
+        if image_filename is None:
+            emit('error', {'message': 'Изображение не найдено, загрузите его снова'})
+            return
+    
+    if chat_writer.enabled:
+        # Сообщение записывается в фоне, запись подтверждается message_persisted
+        message_data = chat_writer.submit(current_user, recipient_id, content, image_filename)
+        if message_data is None:
+            emit('error', {'message': 'Сервер перегружен, попробуйте отправить сообщение еще раз'})
+            return
+    else:
+        # Создаем сообщение в БД
+        message = ChatMessage(
+            content=content,
+            image=image_filename,
+            sender_id=current_user.id,
+            recipient_id=recipient_id
+        )
+        
+        db.session.add(message)
+        db.session.flush()
+        
+        # Обновляем сводку переписки в той же транзакции
+        conversation = Conversation.get_or_create(current_user.id, recipient_id)
+        conversation.register_message(message)
+        User.change_counters(current_user.id, message_count=1)
+        
+        # Данные сообщения формируются до commit: после него сообщение
+        # было бы перечитано из БД отдельным запросом
+        message_data = message.to_dict(sender=current_user)
+        
+        db.session.commit()
+        
+        change_unread_count(recipient_id, 1)
     
     # Отправляем в комнату чата
     room = f'chat_{min(current_user.id, recipient_id)}_{max(current_user.id, recipient_id)}'
+    if typing_indicator.stop(current_user.id, room):
+        notify_typing(current_user.id, room, False, skip_sid=request.sid)
     emit('new_message', message_data, room=room)
     
     # Отправляем уведомление получателю
@@ -129,8 +157,9 @@ def handle_send_message(data):
 
 
 @socketio.on('typing')
+@metrics.socket_event
 def handle_typing(data):
-    """Пользователь печатает"""
+    """Пользователь печатает: комнате уходит только начало печати"""
     if not current_user.is_authenticated:
         return
     
@@ -139,36 +168,70 @@ def handle_typing(data):
         return
     
     room = f'chat_{min(current_user.id, recipient_id)}_{max(current_user.id, recipient_id)}'
-    emit('user_typing', {
-        'user_id': current_user.id,
-        'username': current_user.username
-    }, room=room, include_self=False)
+    if typing_indicator.touch(current_user.id, room):
+        notify_typing(current_user.id, room, True, skip_sid=request.sid)
+
+
+@socketio.on('stop_typing')
+@metrics.socket_event
+def handle_stop_typing(data):
+    """Пользователь стер текст или ушел из поля ввода"""
+    if not current_user.is_authenticated:
+        return
+    
+    recipient_id = data.get('recipient_id')
+    if not recipient_id:
+        return
+    
+    room = f'chat_{min(current_user.id, recipient_id)}_{max(current_user.id, recipient_id)}'
+    if typing_indicator.stop(current_user.id, room):
+        notify_typing(current_user.id, room, False, skip_sid=request.sid)
+
+
+@socketio.on('presence_query')
+@metrics.socket_event
+def handle_presence_query(data):
+    """Кто из пользователей в сети; ответ приходит в ack"""
+    if not current_user.is_authenticated:
+        return
+    
+    user_ids = [user_id for user_id in (data.get('user_ids') or []) if isinstance(user_id, int)]
+    limit = current_app.config['PRESENCE_QUERY_LIMIT']
+    return {'online': sorted(presence.online(user_ids[:limit]))}
+
+
+def _is_id(value):
+    """Целый положительный id из данных клиента (bool — тоже int, но не id)"""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
 
 
 @socketio.on('mark_read')
+@metrics.socket_event
 def handle_mark_read(data):
     """Отметить сообщения как прочитанные"""
     if not current_user.is_authenticated:
         return
     
     sender_id = data.get('sender_id')
-    if not sender_id:
+    if not _is_id(sender_id):
         return
     
-    # Помечаем все непрочитанные сообщения от отправителя как прочитанные
-    messages = ChatMessage.query.filter_by(
-        sender_id=sender_id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).all()
+    # Клиент может передать id последнего показанного сообщения;
+    # значение другого типа не должно попасть в UPDATE и водяной знак
+    up_to_id = data.get('up_to_id')
+    if up_to_id is not None and not _is_id(up_to_id):
+        return
     
-    for msg in messages:
-        msg.is_read = True
+    # Один UPDATE по всем непрочитанным сообщениям от отправителя
+    count = mark_read(current_user.id, sender_id, up_to_id)
     
     db.session.commit()
     
+    if count:
+        change_unread_count(current_user.id, -count)
+        notify_read(current_user.id, sender_id, up_to_id)
+    
     emit('messages_marked_read', {
-        'count': len(messages),
+        'count': count,
         'sender_id': sender_id
     })
-
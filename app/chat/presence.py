@@ -0,0 +1,349 @@
+"""Присутствие пользователей в чате (в сети / не в сети)
+
+Пользователь в сети, пока у него есть хотя бы одно живое соединение
+Socket.IO (вкладки считаются отдельно). Соединения хранятся в бэкенде
+с временем жизни PRESENCE_TTL; каждый процесс раз в
+PRESENCE_HEARTBEAT_INTERVAL продлевает свои соединения и удаляет чужие
+просроченные — так соединения упавшего процесса исчезают сами. Если
+процесс завис дольше PRESENCE_TTL и его живые соединения успели удалить
+другие процессы, продление записывает их заново и рассылает возвращение
+в сеть.
+
+Бэкенд выбирается параметром PRESENCE_BACKEND (по умолчанию как
+CACHE_BACKEND): local — память процесса (один процесс), redis — общий
+для всех процессов. Память ограничена живыми соединениями, не более
+PRESENCE_MAX_CONNECTIONS на пользователя.
+
+Переходы рассылаются только собеседникам (событие ``presence
+{user_id, online}`` в комнату ``user_<id>``). Уход из сети откладывается
+на PRESENCE_OFFLINE_DELAY секунд: при переходе между страницами сокет
+переподключается, и собеседники не видят мигания статуса.
+"""
+
+import threading
+import time
+from app import socketio
+from app.models import Conversation
+
+
+class LocalPresenceBackend:
+    """Соединения в памяти процесса"""
+
+    def __init__(self, max_connections=16):
+        self.max_connections = max_connections
+        # user_id -> {sid: срок}
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def connect(self, user_id, sid, expires_at, now):
+        """Добавить соединение, вернуть True, если пользователь появился в сети"""
+        with self._lock:
+            connections = self._users.setdefault(user_id, {})
+            online = any(expires > now for expires in connections.values())
+            connections[sid] = expires_at
+            while len(connections) > self.max_connections:
+                del connections[min(connections, key=connections.get)]
+            return not online
+
+    def disconnect(self, user_id, sid, now):
+        """Убрать соединение, вернуть True, если пользователь ушел из сети"""
+        with self._lock:
+            connections = self._users.get(user_id)
+            if connections is None or connections.pop(sid, None) is None:
+                return False
+            return self._prune(user_id, now)
+
+    def refresh(self, connections, expires_at):
+        """
+        Продлить живые соединения процесса: {sid: user_id}
+
+        Соединения, удаленные как просроченные, записываются заново.
+
+        Returns:
+            пользователи, которые снова появились в сети
+        """
+        restored = set()
+        with self._lock:
+            for sid, user_id in connections.items():
+                user_connections = self._users.setdefault(user_id, {})
+                if not user_connections:
+                    restored.add(user_id)
+                user_connections[sid] = expires_at
+                while len(user_connections) > self.max_connections:
+                    del user_connections[min(user_connections, key=user_connections.get)]
+        return restored
+
+    def expire(self, now):
+        """Удалить просроченные соединения, вернуть ушедших из сети"""
+        with self._lock:
+            return [user_id for user_id in list(self._users) if self._prune(user_id, now)]
+
+    def online(self, user_ids, now):
+        """Множество пользователей в сети из списка"""
+        with self._lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires > now for expires in self._users.get(user_id, {}).values())
+            }
+
+    def _prune(self, user_id, now):
+        connections = self._users[user_id]
+        for sid in [sid for sid, expires in connections.items() if expires <= now]:
+            del connections[sid]
+        if connections:
+            return False
+        del self._users[user_id]
+        return True
+
+
+class RedisPresenceBackend:
+    """
+    Соединения в Redis, общие для всех процессов
+
+    presence:<user_id> — sorted set sid -> срок, presence:users — sorted
+    set user_id -> срок последнего соединения (по нему ищутся
+    пользователи с просроченными соединениями).
+    """
+
+    # KEYS: соединения пользователя, presence:users
+    # ARGV: sid, срок, сейчас, ttl ключа, максимум соединений, user_id
+    _CONNECT = """
+        redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[3])
+        local online = redis.call('zcard', KEYS[1]) > 0
+        redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+        local extra = redis.call('zcard', KEYS[1]) - tonumber(ARGV[5])
+        if extra > 0 then
+            redis.call('zremrangebyrank', KEYS[1], 0, extra - 1)
+        end
+        redis.call('expire', KEYS[1], ARGV[4])
+        redis.call('zadd', KEYS[2], ARGV[2], ARGV[6])
+        if online then return 0 end
+        return 1
+    """
+
+    # ARGV: срок, сейчас, ttl ключа, максимум соединений, user_id, sid...
+    # Пустой набор соединений значит, что пользователя уже убрали из сети
+    _REFRESH = """
+        local online = redis.call('zcard', KEYS[1]) > 0
+        for i = 6, #ARGV do
+            redis.call('zadd', KEYS[1], ARGV[1], ARGV[i])
+        end
+        redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[2])
+        local extra = redis.call('zcard', KEYS[1]) - tonumber(ARGV[4])
+        if extra > 0 then
+            redis.call('zremrangebyrank', KEYS[1], 0, extra - 1)
+        end
+        redis.call('expire', KEYS[1], ARGV[3])
+        redis.call('zadd', KEYS[2], 'GT', ARGV[1], ARGV[5])
+        if online then return 0 end
+        return 1
+    """
+
+    # ARGV: sid (пустой при проверке сроков), сейчас, user_id.
+    # Возвращает 1 только одному процессу — тому, кто убрал пользователя
+    _PRUNE = """
+        if ARGV[1] ~= '' then
+            if redis.call('zrem', KEYS[1], ARGV[1]) == 0 then return 0 end
+        end
+        redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[2])
+        local last = redis.call('zrange', KEYS[1], -1, -1, 'WITHSCORES')
+        if #last == 0 then
+            return redis.call('zrem', KEYS[2], ARGV[3])
+        end
+        redis.call('zadd', KEYS[2], last[2], ARGV[3])
+        return 0
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='forum:', max_connections=16, ttl=90):
+        import redis
+
+        self.prefix = prefix
+        self.max_connections = max_connections
+        self.ttl = ttl
+        self._redis = redis.Redis.from_url(url)
+        self._connect = self._redis.register_script(self._CONNECT)
+        self._prune = self._redis.register_script(self._PRUNE)
+        self._refresh = self._redis.register_script(self._REFRESH)
+
+    def _key(self, user_id):
+        return f'{self.prefix}presence:{user_id}'
+
+    @property
+    def _users_key(self):
+        return f'{self.prefix}presence:users'
+
+    def connect(self, user_id, sid, expires_at, now):
+        return bool(self._connect(
+            keys=[self._key(user_id), self._users_key],
+            args=[sid, expires_at, now, int(self.ttl * 2), self.max_connections, user_id]
+        ))
+
+    def disconnect(self, user_id, sid, now):
+        return bool(self._prune(keys=[self._key(user_id), self._users_key], args=[sid, now, user_id]))
+
+    def refresh(self, connections, expires_at):
+        by_user = {}
+        for sid, user_id in connections.items():
+            by_user.setdefault(user_id, []).append(sid)
+
+        now = time.time()
+        pipe = self._redis.pipeline(transaction=False)
+        for user_id, sids in by_user.items():
+            self._refresh(
+                keys=[self._key(user_id), self._users_key],
+                args=[expires_at, now, int(self.ttl * 2), self.max_connections, user_id, *sids],
+                client=pipe
+            )
+        return {user_id for user_id, restored in zip(by_user, pipe.execute()) if restored}
+
+    def expire(self, now):
+        candidates = self._redis.zrangebyscore(self._users_key, '-inf', now)
+        return [
+            int(user_id) for user_id in candidates
+            if self._prune(keys=[self._key(int(user_id)), self._users_key], args=['', now, int(user_id)])
+        ]
+
+    def online(self, user_ids, now):
+        user_ids = list(user_ids)
+        pipe = self._redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self._key(user_id), f'({now}', '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+
+class Presence:
+    """Учет соединений и рассылка переходов в сети / не в сети"""
+
+    def __init__(self):
+        self.app = None
+        self.backend = LocalPresenceBackend()
+        self.ttl = 90
+        self.heartbeat_interval = 30
+        self.offline_delay = 10
+        self.notify_limit = 200
+        # Соединения этого процесса: sid -> user_id
+        self._local = {}
+        # Отложенные уходы из сети: user_id -> когда разослать
+        self._pending_offline = {}
+        self._last_heartbeat = 0
+        self._lock = threading.Lock()
+        self._sweeper_started = False
+
+    def init_app(self, app):
+        """Привязать присутствие к приложению"""
+        self.app = app
+        self.ttl = app.config['PRESENCE_TTL']
+        self.heartbeat_interval = app.config['PRESENCE_HEARTBEAT_INTERVAL']
+        self.offline_delay = app.config['PRESENCE_OFFLINE_DELAY']
+        self.notify_limit = app.config['PRESENCE_NOTIFY_LIMIT']
+
+        max_connections = app.config['PRESENCE_MAX_CONNECTIONS']
+        if (app.config['PRESENCE_BACKEND'] or app.config['CACHE_BACKEND']) == 'redis':
+            self.backend = RedisPresenceBackend(max_connections=max_connections, ttl=self.ttl,
+                                                **app.config['CACHE_OPTIONS'])
+        else:
+            self.backend = LocalPresenceBackend(max_connections=max_connections)
+        app.extensions['presence'] = self
+
+    def connect(self, user_id, sid):
+        """Новое соединение пользователя"""
+        now = time.time()
+        with self._lock:
+            self._local[sid] = user_id
+        self._ensure_sweeper()
+
+        if self.backend.connect(user_id, sid, now + self.ttl, now):
+            self._came_online(user_id)
+
+    def _came_online(self, user_id):
+        with self._lock:
+            # Вернулся до рассылки ухода: собеседники ничего не заметили
+            returned = self._pending_offline.pop(user_id, None) is not None
+        if not returned:
+            self.broadcast(user_id, True)
+
+    def disconnect(self, user_id, sid):
+        """Соединение пользователя закрыто"""
+        now = time.time()
+        with self._lock:
+            self._local.pop(sid, None)
+
+        if self.backend.disconnect(user_id, sid, now):
+            with self._lock:
+                self._pending_offline[user_id] = now + self.offline_delay
+
+    def online(self, user_ids):
+        """
+        Кто из пользователей в сети (один запрос к бэкенду на список)
+
+        Returns:
+            множество id пользователей в сети
+        """
+        if not user_ids:
+            return set()
+        return self.backend.online(user_ids, time.time())
+
+    def is_online(self, user_id):
+        return user_id in self.online([user_id])
+
+    def broadcast(self, user_id, online):
+        """Разослать переход собеседникам пользователя"""
+        payload = {'user_id': user_id, 'online': online}
+        for partner_id in Conversation.partner_ids(user_id, self.notify_limit):
+            socketio.emit('presence', payload, to=f'user_{partner_id}')
+
+    def sweep(self):
+        """Разослать отложенные уходы, продлить свои соединения, удалить просроченные"""
+        now = time.time()
+
+        with self._lock:
+            due = [user_id for user_id, at in self._pending_offline.items() if at <= now]
+            for user_id in due:
+                del self._pending_offline[user_id]
+            local = dict(self._local)
+
+        if due:
+            # Пользователь мог вернуться через другой процесс
+            returned = self.backend.online(due, now)
+            for user_id in due:
+                if user_id not in returned:
+                    self.broadcast(user_id, False)
+
+        if now - self._last_heartbeat >= self.heartbeat_interval:
+            self._last_heartbeat = now
+            if local:
+                for user_id in self.backend.refresh(local, now + self.ttl):
+                    self._came_online(user_id)
+                # Соединения, закрытые во время продления, не должны остаться в бэкенде
+                with self._lock:
+                    closed = {sid: user_id for sid, user_id in local.items() if sid not in self._local}
+                for sid, user_id in closed.items():
+                    if self.backend.disconnect(user_id, sid, now):
+                        with self._lock:
+                            self._pending_offline[user_id] = now + self.offline_delay
+            for user_id in self.backend.expire(now):
+                self.broadcast(user_id, False)
+
+    def _ensure_sweeper(self):
+        """Запустить фоновую проверку при первом соединении"""
+        if self._sweeper_started or self.app is None:
+            return
+
+        with self._lock:
+            if self._sweeper_started:
+                return
+            self._sweeper_started = True
+        socketio.start_background_task(self._run_sweeper)
+
+    def _run_sweeper(self):
+        interval = max(0.5, min(self.offline_delay, self.heartbeat_interval) / 2)
+        while True:
+            socketio.sleep(interval)
+            try:
+                with self.app.app_context():
+                    self.sweep()
+            except Exception as e:
+                self.app.logger.error(f'Error updating presence: {e}')
+
+
+presence = Presence()
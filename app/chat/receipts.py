@@ -0,0 +1,52 @@
+"""Отметки о прочтении сообщений чата
+
+Сообщения отмечаются одним UPDATE без загрузки строк, а в сводке
+переписки сдвигается водяной знак «прочитано до сообщения id», поэтому
+состояние прочтения переписки хранится и читается за O(1).
+"""
+
+from app import db, socketio
+from app.models import ChatMessage, Conversation
+
+
+def mark_read(reader_id, sender_id, up_to_id=None):
+    """
+    Отметить сообщения отправителя как прочитанные получателем
+    
+    Args:
+        reader_id: кто читает
+        sender_id: чьи сообщения прочитаны
+        up_to_id: id последнего прочитанного сообщения (None — все)
+    
+    Returns:
+        количество отмеченных сообщений
+    """
+    stmt = db.update(ChatMessage).where(
+        ChatMessage.sender_id == sender_id,
+        ChatMessage.recipient_id == reader_id,
+        ChatMessage.is_read == False  # noqa: E712
+    ).values(is_read=True)
+    
+    if up_to_id is not None:
+        stmt = stmt.where(ChatMessage.id <= up_to_id)
+    
+    result = db.session.execute(stmt, execution_options={'synchronize_session': False})
+    count = result.rowcount
+    
+    conversation = Conversation.for_users(reader_id, sender_id)
+    if conversation:
+        conversation.mark_read(reader_id, up_to_id, count)
+    
+    return count
+
+
+def notify_read(reader_id, sender_id, up_to_id=None):
+    """Сообщить отправителю, до какого сообщения прочитана переписка"""
+    if up_to_id is None:
+        conversation = Conversation.for_users(reader_id, sender_id)
+        up_to_id = conversation.read_up_to(reader_id) if conversation else None
+    
+    socketio.emit('messages_read', {
+        'reader_id': reader_id,
+        'up_to_id': up_to_id
+    }, to=f'user_{sender_id}')
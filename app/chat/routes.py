@@ -1,35 +1,89 @@
 """Маршруты чата"""
 
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, current_app
 from flask_login import login_required, current_user
 from app.chat import chat_bp
 from app import db
-from app.models import User, ChatMessage
+from app.models import User, ChatMessage, Conversation
+from app.pagination import keyset_paginate, encode_cursor
+from app.chat.unread import get_unread_count, change_unread_count
+from app.chat.receipts import mark_read, notify_read
+from app.chat.uploads import store_upload, UploadError
+from app.chat.presence import presence
+from app.metrics import query_budget
+from app.images import image_url
 from sqlalchemy import or_, and_
+from sqlalchemy.orm import joinedload
 
 
 @chat_bp.route('/')
+@query_budget(3)
 @login_required
 def index():
     """Главная страница чата"""
-    # Получаем список пользователей с которыми есть переписка
-    users_with_messages = db.session.query(User).join(
-        ChatMessage,
+    # Последние переписки пользователя из сводной таблицы
+    conversations = Conversation.inbox_query(
+        current_user.id, current_app.config['CHAT_CONVERSATIONS_LIMIT']
+    ).all()
+    online = presence.online([c.partner_of(current_user.id).id for c in conversations])
+    
+    return render_template('chat/index.html', conversations=conversations, online=online)
+
+
+@chat_bp.route('/users/search')
+@login_required
+def search_users():
+    """API поиска пользователей по началу имени для нового чата"""
+    q = request.args.get('q', '').strip().lower()
+    if not q:
+        return jsonify([])
+    
+    # Экранируем спецсимволы LIKE, ищем по префиксу
+    pattern = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    
+    users = User.query.filter(
+        db.func.lower(User.username).like(pattern, escape='\\'),
+        User.id != current_user.id
+    ).order_by(User.username).limit(current_app.config['USER_SEARCH_LIMIT']).all()
+    
+    return jsonify([
+        {
+            'id': user.id,
+            'username': user.username,
+            'avatar': user.avatar,
+            'avatar_url': image_url('avatars', user.avatar, 'thumb')
+        }
+        for user in users
+    ])
+
+
+def _messages_window(user_id, after=None, before=None, limit=None):
+    """
+    Окно переписки с пользователем
+    
+    Ключ пагинации — id сообщения (монотонно растет вместе с created_at).
+    Без курсоров возвращается последнее окно. Отправитель загружается
+    тем же запросом.
+    """
+    query = ChatMessage.query.options(joinedload(ChatMessage.sender)).filter(
         or_(
-            and_(ChatMessage.sender_id == User.id, ChatMessage.recipient_id == current_user.id),
-            and_(ChatMessage.recipient_id == User.id, ChatMessage.sender_id == current_user.id)
+            and_(ChatMessage.sender_id == current_user.id, ChatMessage.recipient_id == user_id),
+            and_(ChatMessage.sender_id == user_id, ChatMessage.recipient_id == current_user.id)
         )
-    ).filter(User.id != current_user.id).distinct().all()
+    )
     
-    # Получаем всех пользователей для возможности начать новый чат
-    all_users = User.query.filter(User.id != current_user.id).all()
-    
-    return render_template('chat/index.html', 
-                         users_with_messages=users_with_messages,
-                         all_users=all_users)
+    return keyset_paginate(
+        query,
+        (ChatMessage.id,),
+        per_page=limit or current_app.config['CHAT_MESSAGES_PER_PAGE'],
+        after=after,
+        before=before,
+        last=not after and not before
+    )
 
 
 @chat_bp.route('/user/<int:user_id>')
+@query_budget(6)
 @login_required
 def chat_with_user(user_id):
     """Чат с конкретным пользователем"""
@@ -38,53 +92,83 @@ def chat_with_user(user_id):
     if user.id == current_user.id:
         return jsonify({'error': 'Нельзя отправить сообщение самому себе'}), 400
     
-    # Получаем историю сообщений
-    messages = ChatMessage.query.filter(
-        or_(
-            and_(ChatMessage.sender_id == current_user.id, ChatMessage.recipient_id == user_id),
-            and_(ChatMessage.sender_id == user_id, ChatMessage.recipient_id == current_user.id)
-        )
-    ).order_by(ChatMessage.created_at.asc()).all()
+    # Помечаем непрочитанные сообщения как прочитанные одним UPDATE
+    count = mark_read(current_user.id, user_id)
     
-    # Помечаем непрочитанные сообщения как прочитанные
-    unread_messages = ChatMessage.query.filter_by(
-        sender_id=user_id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).all()
+    db.session.commit()
     
-    for msg in unread_messages:
-        msg.is_read = True
+    if count:
+        change_unread_count(current_user.id, -count)
+        notify_read(current_user.id, user_id)
     
-    db.session.commit()
+    # Последнее окно истории, более старые сообщения подгружаются при прокрутке.
+    # Загружается после commit: иначе commit сбросит загруженные сообщения,
+    # и шаблон перечитает каждое отдельным запросом
+    messages = _messages_window(user_id)
     
     return render_template('chat/conversation.html', 
                          recipient=user,
-                         messages=messages)
+                         messages=messages,
+                         recipient_online=presence.is_online(user.id))
 
 
 @chat_bp.route('/messages/<int:user_id>')
+@query_budget(2)
 @login_required
 def get_messages(user_id):
-    """API для получения сообщений с пользователем"""
-    messages = ChatMessage.query.filter(
-        or_(
-            and_(ChatMessage.sender_id == current_user.id, ChatMessage.recipient_id == user_id),
-            and_(ChatMessage.sender_id == user_id, ChatMessage.recipient_id == current_user.id)
-        )
-    ).order_by(ChatMessage.created_at.asc()).all()
+    """
+    API для получения сообщений с пользователем
+    
+    Параметры запроса:
+        before_id: сообщения старше указанного (подгрузка истории)
+        after_id: сообщения новее указанного (догрузка после переподключения)
+        limit: размер окна (не больше CHAT_MESSAGES_MAX_LIMIT)
+    
+    Без параметров возвращает последнее окно переписки. Вместо id можно
+    передать токены before/after из предыдущего ответа.
+    """
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', current_app.config['CHAT_MESSAGES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, current_app.config['CHAT_MESSAGES_MAX_LIMIT']))
+    
+    after = encode_cursor([after_id]) if after_id is not None else request.args.get('after')
+    before = encode_cursor([before_id]) if before_id is not None else request.args.get('before')
+    
+    messages = _messages_window(user_id, after=after, before=before, limit=limit)
     
-    return jsonify([msg.to_dict() for msg in messages])
+    return jsonify(messages.to_dict(ChatMessage.to_dict))
+
+
+@chat_bp.route('/upload', methods=['POST'])
+@login_required
+def upload_image():
+    """
+    Загрузка изображения для сообщения
+    
+    Тело запроса — сам файл (не multipart), оно читается потоком по частям.
+    Возвращает токен, который передается в событии send_message.
+    """
+    try:
+        token = store_upload(request.stream, current_user.id, request.content_length)
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    
+    return jsonify({'token': token}), 201
+
+
+@chat_bp.route('/presence')
+@login_required
+def presence_status():
+    """API: кто из пользователей в сети (?ids=1,2,3)"""
+    ids = [int(part) for part in request.args.get('ids', '').split(',') if part.strip().isdigit()]
+    ids = ids[:current_app.config['PRESENCE_QUERY_LIMIT']]
+    return jsonify({'online': sorted(presence.online(ids))})
 
 
 @chat_bp.route('/unread-count')
 @login_required
 def unread_count():
     """Количество непрочитанных сообщений"""
-    count = ChatMessage.query.filter_by(
-        recipient_id=current_user.id,
-        is_read=False
-    ).count()
-    
-    return jsonify({'count': count})
+    return jsonify({'count': get_unread_count(current_user.id)})
 
@@ -0,0 +1,126 @@
+"""Индикатор «печатает» в чате
+
+Клиент шлет typing на каждый ввод символа, но комнате нужны только
+переходы: начал печатать и перестал. Состояние хранится в памяти
+процесса по ключу (пользователь, комната):
+
+- первое событие отправляет комнате ``user_typing {user_id, typing: true}``;
+- следующие события только продлевают срок; чаще TYPING_MIN_INTERVAL
+  секунд они отбрасываются без какой-либо работы;
+- через TYPING_TIMEOUT секунд без событий, а также при отправке
+  сообщения, выходе из чата и отключении комнате отправляется
+  ``user_typing {user_id, typing: false}``.
+
+В событиях только id: имя собеседника клиент уже знает.
+"""
+
+import threading
+import time
+from app import socketio
+
+
+class TypingIndicator:
+    """Сведение событий typing к переходам «начал/перестал»"""
+
+    def __init__(self):
+        self.app = None
+        self.min_interval = 1.0
+        self.timeout = 5.0
+        # (user_id, room) -> [время последнего принятого события, срок]
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sweeper_started = False
+
+    def init_app(self, app):
+        """Привязать индикатор к приложению"""
+        self.app = app
+        self.min_interval = app.config['TYPING_MIN_INTERVAL']
+        self.timeout = app.config['TYPING_TIMEOUT']
+        app.extensions['typing_indicator'] = self
+
+    def touch(self, user_id, room):
+        """
+        Учесть событие typing
+
+        Returns:
+            True, если пользователь начал печатать (нужно уведомить комнату)
+        """
+        now = time.monotonic()
+        key = (user_id, room)
+
+        with self._lock:
+            state = self._active.get(key)
+            if state is not None:
+                if now - state[0] >= self.min_interval:
+                    state[0] = now
+                    state[1] = now + self.timeout
+                return False
+
+            self._active[key] = [now, now + self.timeout]
+
+        self._ensure_sweeper()
+        return True
+
+    def stop(self, user_id, room):
+        """
+        Пользователь перестал печатать в комнате
+
+        Returns:
+            True, если он печатал (нужно уведомить комнату)
+        """
+        with self._lock:
+            return self._active.pop((user_id, room), None) is not None
+
+    def stop_all(self, user_id):
+        """
+        Пользователь перестал печатать везде (отключение)
+
+        Returns:
+            список комнат, где он печатал
+        """
+        with self._lock:
+            rooms = [room for uid, room in self._active if uid == user_id]
+            for room in rooms:
+                del self._active[(user_id, room)]
+        return rooms
+
+    def expire(self):
+        """
+        Убрать истекшие записи
+
+        Returns:
+            список (user_id, room) для уведомления комнат
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, state in self._active.items() if state[1] <= now]
+            for key in expired:
+                del self._active[key]
+        return expired
+
+    def _ensure_sweeper(self):
+        """Запустить проверку сроков при первом событии"""
+        if self._sweeper_started or self.app is None:
+            return
+
+        with self._lock:
+            if self._sweeper_started:
+                return
+            self._sweeper_started = True
+        socketio.start_background_task(self._run_sweeper)
+
+    def _run_sweeper(self):
+        # Точность остановки — доля таймаута, а не секунда на каждую запись
+        interval = max(0.2, self.timeout / 5)
+        while True:
+            socketio.sleep(interval)
+            for user_id, room in self.expire():
+                notify(user_id, room, False)
+
+
+def notify(user_id, room, typing, skip_sid=None):
+    """Отправить комнате переход состояния"""
+    socketio.emit('user_typing', {'user_id': user_id, 'typing': typing}, room=room, skip_sid=skip_sid)
+
+
+typing_indicator = TypingIndicator()
@@ -0,0 +1,64 @@
+"""Кэшированный счетчик непрочитанных сообщений
+
+Счетчик хранится в кэше и поддерживается обработчиками чата. Промах кэша
+восстанавливает значение из таблицы chat_messages (частичный индекс по
+непрочитанным), а время жизни записи ограничивает возможное расхождение.
+Изменения отправляются клиенту в комнату user_{id}.
+"""
+
+from flask import current_app
+from app import socketio
+from app.cache import cache
+from app.models import ChatMessage
+
+
+def _key(user_id):
+    return f'unread:{user_id}'
+
+
+def count_unread(user_id):
+    """Точное количество непрочитанных по таблице сообщений"""
+    return ChatMessage.query.filter_by(
+        recipient_id=user_id,
+        is_read=False
+    ).count()
+
+
+def get_unread_count(user_id):
+    """Количество непрочитанных сообщений пользователя (из кэша)"""
+    count = cache.get(_key(user_id))
+    if count is None:
+        count = reconcile_unread_count(user_id)
+    return count
+
+
+def reconcile_unread_count(user_id):
+    """Пересчитать счетчик по таблице и записать в кэш"""
+    count = count_unread(user_id)
+    cache.set(_key(user_id), count, ttl=current_app.config['UNREAD_COUNT_TTL'])
+    return count
+
+
+def change_unread_count(user_id, delta):
+    """
+    Изменить счетчик после записи в БД и отправить новое значение клиенту
+    
+    Если значения нет в кэше, оно будет пересчитано при следующем чтении.
+    """
+    if not delta:
+        return
+    
+    count = cache.incr(_key(user_id), delta)
+    if count is not None and count < 0:
+        count = reconcile_unread_count(user_id)
+    
+    if count is not None:
+        push_unread_count(user_id, count)
+
+
+def push_unread_count(user_id, count=None):
+    """Отправить значение счетчика во все вкладки пользователя"""
+    if count is None:
+        count = get_unread_count(user_id)
+    
+    socketio.emit('unread_count', {'count': count}, to=f'user_{user_id}')
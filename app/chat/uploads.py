@@ -0,0 +1,136 @@
+"""Загрузка изображений для чата
+
+Изображение загружается отдельным HTTP-запросом с бинарным телом и
+пишется на диск по частям (CHAT_UPLOAD_CHUNK_SIZE), поэтому в памяти
+процесса никогда не находится файл целиком. Тип файла определяется по
+сигнатуре первых байт, а не по имени. Клиент получает токен загрузки
+и передает его в событии send_message вместо самого изображения.
+
+Токен хранится в кэше CHAT_UPLOAD_TTL секунд и привязан к пользователю.
+Файлы, на которые так и не сослалось сообщение, удаляет команда
+``flask forum cleanup-chat-uploads``.
+"""
+
+import os
+import secrets
+from flask import current_app
+from app.cache import cache
+from app.images import enqueue_processing
+
+# Сигнатуры поддерживаемых форматов: (смещение, байты) -> расширение
+SIGNATURES = [
+    ((0, b'\x89PNG\r\n\x1a\n'), 'png'),
+    ((0, b'\xff\xd8\xff'), 'jpg'),
+    ((0, b'GIF87a'), 'gif'),
+    ((0, b'GIF89a'), 'gif'),
+    ((8, b'WEBP'), 'webp'),
+]
+
+# Сколько байт нужно для определения типа
+SNIFF_SIZE = 12
+
+
+class UploadError(Exception):
+    """Ошибка загрузки (сообщение показывается пользователю)"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def sniff_image_type(head):
+    """
+    Определить тип изображения по первым байтам
+
+    Returns:
+        расширение файла или None, если формат не поддерживается
+    """
+    for (offset, signature), ext in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if ext == 'webp' and not head.startswith(b'RIFF'):
+                continue
+            return ext
+    return None
+
+
+def _upload_key(user_id, token):
+    # Пользователь в ключе: чужой токен не найдется и не сгорит
+    return f'chat_upload:{user_id}:{token}'
+
+
+def store_upload(stream, user_id, content_length=None):
+    """
+    Сохранить изображение из потока запроса
+
+    Args:
+        stream: поток тела запроса
+        user_id: кто загружает
+        content_length: заявленный размер (проверяется до чтения)
+
+    Returns:
+        токен загрузки
+
+    Raises:
+        UploadError: превышен размер или формат не поддерживается
+    """
+    max_size = current_app.config['CHAT_UPLOAD_MAX_SIZE']
+    chunk_size = current_app.config['CHAT_UPLOAD_CHUNK_SIZE']
+
+    if content_length is not None and content_length > max_size:
+        raise UploadError('Файл слишком большой', 413)
+
+    head = stream.read(SNIFF_SIZE)
+    ext = sniff_image_type(head)
+    if ext is None or ext not in current_app.config['ALLOWED_EXTENSIONS']:
+        raise UploadError('Неподдерживаемый формат изображения', 415)
+
+    filename = f'{secrets.token_hex(8)}.{ext}'
+    path = os.path.join(current_app.config['CHAT_FOLDER'], filename)
+    tmp_path = path + '.part'
+
+    try:
+        size = len(head)
+        with open(tmp_path, 'wb') as f:
+            f.write(head)
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                # Content-Length может отсутствовать или быть неверным
+                if size > max_size:
+                    raise UploadError('Файл слишком большой', 413)
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    token = secrets.token_urlsafe(16)
+    cache.set(_upload_key(user_id, token), {'user_id': user_id, 'filename': filename},
+              current_app.config['CHAT_UPLOAD_TTL'])
+
+    enqueue_processing('chat', filename)
+
+    return token
+
+
+def claim_upload(token, user_id):
+    """
+    Получить файл по токену загрузки (токен используется один раз)
+
+    Returns:
+        имя файла или None, если токен неизвестен, истек или чужой
+    """
+    if not token:
+        return None
+
+    # Токен забирается атомарно: два одновременных send_message с одним
+    # токеном не прикрепят файл к двум сообщениям
+    upload = cache.pop(_upload_key(user_id, token))
+    if not upload:
+        return None
+
+    return upload['filename']
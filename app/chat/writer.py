@@ -0,0 +1,311 @@
+"""Отложенная запись сообщений чата (CHAT_WRITE_BEHIND)
+
+В обычном режиме send_message проверяет получателя, вставляет сообщение
+и обновляет сводку переписки до рассылки — собеседник ждет два-три
+обращения к БД. В режиме отложенной записи обработчик только:
+
+- проверяет получателя по кэшу известных пользователей (known_user);
+- берет id сообщения из заранее зарезервированного блока (IdAllocator);
+- ставит строку в очередь и сразу рассылает сообщение со статусом
+  ``pending``.
+
+Фоновый обработчик раз в CHAT_WRITE_INTERVAL секунд записывает очередь
+пакетами до CHAT_WRITE_BATCH_SIZE строк (одна многострочная вставка,
+сводки переписок и счетчики — по одному UPDATE на пару и отправителя)
+и подтверждает запись событием ``message_persisted {ids}`` в комнату
+переписки. Сообщения, которые не удалось записать, приходят в
+``message_failed {ids}``.
+
+Очередь ограничена CHAT_WRITE_QUEUE_SIZE сообщений: если обработчик не
+успевает, отправитель ждет освобождения места до
+CHAT_WRITE_QUEUE_TIMEOUT секунд, после чего получает ошибку.
+
+Границы режима:
+- при аварийном завершении процесса теряются сообщения из очереди
+  (не более CHAT_WRITE_QUEUE_SIZE; при штатной остановке очередь
+  записывается через atexit);
+- id резервируются блоками по CHAT_ID_BLOCK_SIZE на процесс, поэтому
+  сообщения разных процессов могут идти по id не строго в порядке
+  отправки; на SQLite блоки выдаются от max(id) и режим допустим только
+  для одного процесса.
+"""
+
+import atexit
+import threading
+from collections import deque
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError, DataError
+from app import db, socketio, identity
+from app.cache import LocalCacheBackend
+from app.images import image_url
+from app.models import ChatMessage, Conversation, User
+from app.chat.unread import change_unread_count
+
+
+def room_for(user_id, other_id):
+    """Комната переписки двух пользователей"""
+    return f'chat_{min(user_id, other_id)}_{max(user_id, other_id)}'
+
+
+class IdAllocator:
+    """Блоки id сообщений, зарезервированные заранее"""
+
+    def __init__(self, block_size=20):
+        self.block_size = block_size
+        self._ids = deque()
+        self._high = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        """Следующий id (обращается к БД, только если блок исчерпан)"""
+        while True:
+            with self._lock:
+                if self._ids:
+                    return self._ids.popleft()
+            self._fill()
+
+    def prefetch(self):
+        """Зарезервировать новый блок заранее, когда текущий на исходе"""
+        with self._lock:
+            low = len(self._ids) < self.block_size // 2
+        if low:
+            self._fill()
+
+    def _fill(self):
+        # Запрос к БД идет без блокировки: иначе все отправки сообщений
+        # процесса (и hub, если блокировка создана до monkey patching) ждут
+        # его ответа. Два параллельных заполнения дают два блока — это допустимо
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # nextval вне транзакции: зарезервированные id не возвращаются
+            # в последовательность, пропуски в id допустимы
+            ids = list(db.session.scalars(db.text(
+                "SELECT nextval(pg_get_serial_sequence('chat_messages', 'id')) "
+                "FROM generate_series(1, :n)"
+            ), {'n': self.block_size}))
+            with self._lock:
+                self._ids.extend(ids)
+            return
+
+        top = db.session.scalar(db.select(db.func.max(ChatMessage.id))) or 0
+        with self._lock:
+            # Блоки SQLite считаются от _high: параллельные заполнения не пересекаются
+            start = max(self._high, top)
+            self._ids.extend(range(start + 1, start + 1 + self.block_size))
+            self._high = start + self.block_size
+
+
+class ChatWriter:
+    """Очередь сообщений чата с пакетной записью в БД"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.batch_size = 200
+        self.interval = 0.05
+        self.queue_size = 10000
+        self.queue_timeout = 2.0
+        self.max_attempts = 5
+        self.ids = IdAllocator()
+        # Пользователи, существование которых уже проверено; запись живет
+        # known_user_ttl секунд, чтобы удаленный пользователь не принимал
+        # сообщения до перезапуска процесса
+        self.known_users = LocalCacheBackend(max_entries=50000)
+        self.known_user_ttl = 60
+        self._queue = deque()
+        self._writer_started = False
+        self._writer_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Привязать очередь к приложению"""
+        self.app = app
+        self.enabled = app.config['CHAT_WRITE_BEHIND']
+        self.batch_size = app.config['CHAT_WRITE_BATCH_SIZE']
+        self.interval = app.config['CHAT_WRITE_INTERVAL']
+        self.queue_size = app.config['CHAT_WRITE_QUEUE_SIZE']
+        self.queue_timeout = app.config['CHAT_WRITE_QUEUE_TIMEOUT']
+        self.max_attempts = app.config['CHAT_WRITE_MAX_ATTEMPTS']
+        self.ids = IdAllocator(app.config['CHAT_ID_BLOCK_SIZE'])
+        self.known_user_ttl = app.config['USER_IDENTITY_TTL']
+        app.extensions['chat_writer'] = self
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def known_user(self, user_id):
+        """Существует ли пользователь (кэш процесса, затем кэш identity и БД)"""
+        if self.known_users.get(user_id):
+            return True
+        if identity.get_identity(user_id) is None:
+            return False
+        self.known_users.set(user_id, True, self.known_user_ttl)
+        return True
+
+    def submit(self, sender, recipient_id, content, image=None):
+        """
+        Поставить сообщение в очередь записи
+
+        Args:
+            sender: отправитель (current_user)
+
+        Returns:
+            данные сообщения для рассылки или None, если очередь переполнена
+        """
+        waited = 0.0
+        while len(self._queue) >= self.queue_size:
+            # Обратное давление: отправитель ждет, пока обработчик разгребет очередь
+            if waited >= self.queue_timeout:
+                return None
+            socketio.sleep(self.interval)
+            waited += self.interval
+
+        row = {
+            'id': self.ids.next(),
+            'content': content,
+            'image': image,
+            'created_at': datetime.utcnow(),
+            'is_read': False,
+            'sender_id': sender.id,
+            'recipient_id': recipient_id,
+        }
+        self._queue.append((row, 0))
+        self._ensure_writer()
+
+        return {
+            **row,
+            'image_url': image_url('chat', image) if image else None,
+            'created_at': row['created_at'].isoformat(),
+            'sender_username': sender.username,
+            'sender_avatar': sender.avatar,
+            'status': 'pending',
+        }
+
+    def pending(self):
+        """Количество сообщений в очереди"""
+        return len(self._queue)
+
+    def flush(self):
+        """Записать всю очередь"""
+        if not self._queue or self.app is None:
+            return
+        with self.app.app_context():
+            while self._queue:
+                if not self.write_batch():
+                    break
+
+    def write_batch(self):
+        """
+        Записать один пакет из очереди
+
+        Returns:
+            False, если БД недоступна и пакет возвращен в очередь
+        """
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        if not batch:
+            return True
+
+        rows = [row for row, _ in batch]
+        try:
+            self._write(rows)
+            db.session.commit()
+        except (IntegrityError, DataError):
+            # Ошибка в отдельных строках: пишем по одной
+            db.session.rollback()
+            persisted, failed = [], []
+            for row in rows:
+                try:
+                    self._write([row])
+                    db.session.commit()
+                    persisted.append(row)
+                except (IntegrityError, DataError) as e:
+                    db.session.rollback()
+                    self.app.logger.error(f'Chat message {row["id"]} rejected: {e}')
+                    failed.append(row)
+            self._acknowledge(persisted, failed)
+            return True
+        except Exception as e:
+            db.session.rollback()
+            retry = [(row, attempts + 1) for row, attempts in batch if attempts + 1 < self.max_attempts]
+            failed = [row for row, attempts in batch if attempts + 1 >= self.max_attempts]
+            self._queue.extendleft(reversed(retry))
+            self.app.logger.error(f'Error writing chat messages, {len(retry)} will be retried: {e}')
+            self._acknowledge([], failed)
+            return False
+
+        self._acknowledge(rows, [])
+        return True
+
+    def _write(self, rows):
+        """Вставка сообщений, сводки переписок и счетчики отправителей"""
+        db.session.execute(db.insert(ChatMessage), rows)
+
+        pairs = {}
+        senders = {}
+        for row in rows:
+            pair = (min(row['sender_id'], row['recipient_id']), max(row['sender_id'], row['recipient_id']))
+            pairs.setdefault(pair, []).append(row)
+            senders[row['sender_id']] = senders.get(row['sender_id'], 0) + 1
+
+        for (low, high), items in pairs.items():
+            conversation = Conversation.get_or_create(low, high)
+            conversation.set_last_message(_Row(max(items, key=lambda row: row['id'])))
+            for user_id in {low, high}:
+                count = sum(1 for row in items if row['recipient_id'] == user_id)
+                if count:
+                    conversation.add_unread(user_id, count)
+
+        for sender_id, count in senders.items():
+            User.change_counters(sender_id, message_count=count)
+
+    def _acknowledge(self, persisted, failed):
+        """Счетчики непрочитанных и подтверждения записи в комнаты переписок"""
+        unread = {}
+        for row in persisted:
+            unread[row['recipient_id']] = unread.get(row['recipient_id'], 0) + 1
+        for user_id, count in unread.items():
+            change_unread_count(user_id, count)
+
+        for event, rows in (('message_persisted', persisted), ('message_failed', failed)):
+            rooms = {}
+            for row in rows:
+                rooms.setdefault(room_for(row['sender_id'], row['recipient_id']), []).append(row['id'])
+            for room, ids in rooms.items():
+                socketio.emit(event, {'ids': ids}, room=room)
+
+    def _ensure_writer(self):
+        """Запустить обработчик при первом сообщении"""
+        if self._writer_started or self.app is None:
+            return
+
+        with self._writer_lock:
+            if not self._writer_started:
+                self._writer_started = True
+                socketio.start_background_task(self._run_writer)
+
+    def _run_writer(self):
+        backoff = self.interval
+        while True:
+            socketio.sleep(backoff)
+            try:
+                with self.app.app_context():
+                    ok = True
+                    while self._queue and ok:
+                        ok = self.write_batch()
+                    # Новый блок id резервируется здесь, а не в обработчике сообщения
+                    self.ids.prefetch()
+                    db.session.commit()
+            except Exception as e:
+                ok = False
+                self.app.logger.error(f'Error in chat writer: {e}')
+            # БД недоступна: повторы все реже, до секунды
+            backoff = self.interval if ok else min(1.0, backoff * 2)
+
+
+class _Row:
+    """Строка очереди с доступом через атрибуты (для Conversation.set_last_message)"""
+
+    def __init__(self, row):
+        self.__dict__.update(row)
+
+
+chat_writer = ChatWriter()
@@ -0,0 +1,381 @@
+"""CLI команды обслуживания форума"""
+
+import functools
+import click
+from flask.cli import AppGroup
+from app import db
+
+forum_cli = AppGroup('forum', help='Обслуживание данных форума и чата')
+
+
+def _unlimited(func):
+    """
+    Команда без DB_STATEMENT_TIMEOUT
+
+    Пересчеты и чистка идут по таблицам целиком и на большой базе
+    выполняются дольше таймаута, рассчитанного на запросы страниц.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from app import bulk
+        with bulk.unlimited_statements():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@forum_cli.command('reconcile-counters')
+@click.option('--topic-id', 'topic_ids', type=int, multiple=True,
+              help='Пересчитать только указанные топики (можно повторять)')
+@click.option('--user-id', 'user_ids', type=int, multiple=True,
+              help='Пересчитать только указанных пользователей (можно повторять)')
+@_unlimited
+def reconcile_counters(topic_ids, user_ids):
+    """
+    Пересчитать денормализованные счетчики по БД
+    
+    Без параметров пересчитываются все топики, все пользователи
+    и статистика сайта.
+    """
+    from app.models import Topic, User
+    from app.site_stats import site_stats
+    
+    everything = not topic_ids and not user_ids
+    
+    if topic_ids or everything:
+        updated = Topic.reconcile_counters(list(topic_ids) or None)
+        db.session.commit()
+        click.echo(f'✓ Пересчитано топиков: {updated}')
+    
+    if user_ids or everything:
+        updated = User.reconcile_counters(list(user_ids) or None)
+        db.session.commit()
+        click.echo(f'✓ Пересчитано пользователей: {updated}')
+    
+    if everything:
+        stats = site_stats.refresh()
+        click.echo('✓ Статистика сайта: ' + ', '.join(f'{k}={v}' for k, v in stats.items()))
+
+
+@forum_cli.command('rebuild-conversations')
+@_unlimited
+def rebuild_conversations():
+    """Пересоздать сводки переписок чата по таблице сообщений"""
+    from app.models import Conversation
+    
+    count = Conversation.rebuild()
+    db.session.commit()
+    
+    click.echo(f'✓ Пересоздано переписок: {count}')
+
+
+class _StatementLog:
+    """SQL, выполненный приложением, с разбивкой по проверяемым маршрутам"""
+    
+    # Запросы, план которых проверяется (служебные SAVEPOINT, PRAGMA и т. п. — нет)
+    CHECKED = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+    
+    def __init__(self):
+        import threading
+        self.name = None
+        self.statements = {}
+        # Запросы фоновых потоков приложения не относятся к маршрутам
+        self.thread = threading.get_ident()
+    
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        import threading
+        if self.name is None or executemany or threading.get_ident() != self.thread \
+                or not statement.lstrip().upper().startswith(self.CHECKED):
+            return
+        # Повторы одного запроса внутри маршрута проверяются один раз
+        self.statements.setdefault(self.name, {}).setdefault(statement, parameters)
+
+
+def _route_queries(user_id, other_id, topic_id):
+    """
+    SQL горячих маршрутов в том виде, в котором его выполняет приложение
+    
+    Маршруты вызываются через тестовый клиент от имени user_id, запросы
+    записываются обработчиком before_cursor_execute (как в app.metrics). Изменяющий данные код
+    (mark_read, удаление последнего поста) выполняется во вложенной
+    транзакции, которая откатывается. Кэш страниц и реплики на время
+    проверки отключаются, чтобы каждый запрос дошел до основной БД.
+    
+    Returns:
+        {маршрут: {statement: parameters}}
+    """
+    from datetime import datetime
+    from flask import current_app
+    from sqlalchemy import event
+    from app import socketio
+    from app.models import Topic, Post
+    from app.pagination import encode_cursor
+    from app.page_cache import page_cache
+    from app.replicas import replicas
+    from app.chat.receipts import mark_read
+    from app.chat.unread import count_unread
+    
+    requests = [
+        ('forum.index', '/forum/'),
+        ('forum.index (after)', '/forum/?after=' + encode_cursor([datetime.utcnow(), 0])),
+        ('forum.topic_view', f'/forum/topic/{topic_id}'),
+        ('forum.topic_view (after)', f'/forum/topic/{topic_id}?after=' + encode_cursor([datetime(1970, 1, 1), 0])),
+        ('forum.search_view', '/forum/search?q=forum'),
+        ('chat.index', '/chat/'),
+        ('chat.get_messages', f'/chat/messages/{other_id}'),
+        ('chat.get_messages (before)', f'/chat/messages/{other_id}?before_id=1000000'),
+        ('chat.search_users', '/chat/users/search?q=us'),
+        ('profile.view', f'/profile/{user_id}'),
+    ]
+    
+    log = _StatementLog()
+    saved = page_cache.enabled, replicas.healthy
+    page_cache.enabled, replicas.healthy = False, []
+    # Фоновые задачи, которые маршруты запускают при первом обращении (сброс
+    # просмотров, очередь писем и т. п.), команде не нужны, а их потоки не
+    # дали бы процессу завершиться
+    socketio.start_background_task = lambda *args, **kwargs: None
+    event.listen(db.engine, 'before_cursor_execute', log)
+    try:
+        client = current_app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        
+        for name, url in requests:
+            log.name = name
+            response = client.get(url)
+            if response.status_code >= 400:
+                click.echo(f'! {name}: HTTP {response.status_code} ({url})')
+        
+        log.name = 'chat.unread_count'
+        count_unread(user_id)
+        
+        nested = db.session.begin_nested()
+        log.name = 'chat.mark_read'
+        mark_read(user_id, other_id)
+        log.name = 'forum.post_delete (last post)'
+        topic = db.session.get(Topic, topic_id)
+        last_post = db.session.get(Post, topic.last_post_id) if topic and topic.last_post_id else None
+        if last_post is not None:
+            topic.unregister_post(last_post)
+        log.name = None
+        nested.rollback()
+    finally:
+        log.name = None
+        event.remove(db.engine, 'before_cursor_execute', log)
+        del socketio.start_background_task
+        page_cache.enabled, replicas.healthy = saved
+    
+    return log.statements
+
+
+def _seq_scans(conn, statement, parameters):
+    """Таблицы, которые план запроса читает последовательным сканированием"""
+    if conn.dialect.name == 'postgresql':
+        plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        
+        scans = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node['Node Type'] == 'Seq Scan':
+                scans.append(node['Relation Name'])
+            nodes.extend(node.get('Plans', []))
+        return scans
+    
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+    # Чтение готового результата подзапроса (ограниченного LIMIT) — не сканирование таблицы
+    subqueries = {row[-1].split()[-1] for row in rows if row[-1].startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+    return [row[-1] for row in rows
+            if row[-1].startswith('SCAN ') and 'INDEX' not in row[-1]
+            and row[-1].split()[1] not in subqueries]
+
+
+@forum_cli.command('check-indexes')
+def check_indexes():
+    """
+    Проверить планы горячих маршрутов: ни один запрос не должен сканировать таблицу целиком
+    
+    Проверяется SQL, который выполняют сами маршруты (см. _route_queries).
+    """
+    from app.models import User, Topic, Conversation
+    
+    # Пара пользователей с перепиской, иначе первые два
+    conversation = db.session.scalars(db.select(Conversation).limit(1)).first()
+    if conversation is not None:
+        users = [conversation.user_low_id, conversation.user_high_id]
+    else:
+        users = db.session.scalars(db.select(User.id).order_by(User.id).limit(2)).all() + [1, 2]
+    topic_id = db.session.scalar(db.select(Topic.id).order_by(Topic.post_count.desc()).limit(1)) or 1
+    db.session.rollback()
+    
+    queries = _route_queries(users[0], users[1], topic_id)
+    
+    conn = db.session.connection()
+    if conn.dialect.name == 'postgresql':
+        # На маленькой базе планировщик предпочтет Seq Scan даже при наличии индекса
+        conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+    
+    failed = False
+    for name, statements in queries.items():
+        scans = []
+        for statement, parameters in statements.items():
+            scans.extend(_seq_scans(conn, statement, parameters))
+        if scans:
+            failed = True
+            click.echo(f'✗ {name}: последовательное сканирование {", ".join(sorted(set(scans)))}')
+        else:
+            click.echo(f'✓ {name} ({len(statements)} SQL)')
+    
+    db.session.rollback()
+    
+    if failed:
+        raise SystemExit(1)
+
+
+@forum_cli.command('cleanup-chat-uploads')
+@_unlimited
+def cleanup_chat_uploads():
+    """Удалить загруженные изображения чата, на которые не ссылается ни одно сообщение"""
+    import os
+    import time
+    from flask import current_app
+    from app.models import ChatMessage
+    from app.utils import delete_picture
+    
+    folder = current_app.config['CHAT_FOLDER']
+    # Токен загрузки еще может быть использован, пока не истек
+    cutoff = time.time() - current_app.config['CHAT_UPLOAD_TTL']
+    
+    candidates = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.getmtime(path) > cutoff:
+            continue
+        if name.endswith('.part') or name.endswith('.tmp'):
+            # Оборванная загрузка или обработка
+            os.remove(path)
+        elif '_' not in os.path.splitext(name)[0]:
+            # Исходный файл; варианты удаляются вместе с ним
+            candidates.append(name)
+    
+    removed = 0
+    for start in range(0, len(candidates), 500):
+        batch = candidates[start:start + 500]
+        used = set(db.session.scalars(
+            db.select(ChatMessage.image).where(ChatMessage.image.in_(batch))
+        ))
+        for name in batch:
+            if name not in used:
+                delete_picture(name, 'chat')
+                removed += 1
+    
+    click.echo(f'✓ Удалено неиспользуемых изображений: {removed}')
+
+
+@forum_cli.command('search-reindex')
+@_unlimited
+def search_reindex():
+    """Пересоздать поисковый индекс (SQLite FTS5; в PostgreSQL векторы генерируемые)"""
+    from app import search
+    
+    count = search.reindex()
+    db.session.commit()
+    
+    if count is None:
+        click.echo('✓ PostgreSQL: search_vector пересчитывается автоматически, индексация не нужна')
+    else:
+        click.echo(f'✓ Проиндексировано записей: {count}')
+
+
+@forum_cli.command('send-emails')
+@click.option('--loop', is_flag=True,
+              help='Работать постоянно (отдельный процесс отправки при EMAIL_OUTBOX_WORKER=false)')
+def send_emails(loop):
+    """Отправить письма, ожидающие в очереди"""
+    from app.mailer import outbox
+    
+    if loop:
+        outbox.run()
+    
+    try:
+        sent = outbox.drain()
+    finally:
+        outbox.close()
+    click.echo(f'✓ Обработано писем: {sent}')
+
+
+@forum_cli.command('email-outbox')
+@click.option('--retry-failed', is_flag=True, help='Вернуть неотправленные письма в очередь')
+@click.option('--purge-sent', type=int, metavar='DAYS',
+              help='Удалить отправленные письма старше DAYS дней')
+@_unlimited
+def email_outbox(retry_failed, purge_sent):
+    """Показать состояние очереди писем"""
+    from datetime import datetime, timedelta
+    from app.models import EmailMessage
+    
+    if purge_sent is not None:
+        purged = db.session.execute(
+            db.delete(EmailMessage).where(
+                EmailMessage.status == EmailMessage.STATUS_SENT,
+                EmailMessage.sent_at < datetime.utcnow() - timedelta(days=purge_sent)
+            )
+        ).rowcount
+        db.session.commit()
+        click.echo(f'✓ Удалено отправленных писем: {purged}')
+    
+    if retry_failed:
+        retried = db.session.execute(
+            db.update(EmailMessage).where(
+                EmailMessage.status == EmailMessage.STATUS_FAILED
+            ).values(status=EmailMessage.STATUS_PENDING, attempts=0, next_attempt_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        click.echo(f'✓ Возвращено в очередь: {retried}')
+    
+    counts = dict(db.session.execute(
+        db.select(EmailMessage.status, db.func.count()).group_by(EmailMessage.status)
+    ).all())
+    for status in (EmailMessage.STATUS_PENDING, EmailMessage.STATUS_SENT, EmailMessage.STATUS_FAILED):
+        click.echo(f'{status:<8} {counts.get(status, 0)}')
+    
+    oldest = db.session.scalar(
+        db.select(db.func.min(EmailMessage.created_at)).where(
+            EmailMessage.status == EmailMessage.STATUS_PENDING
+        )
+    )
+    if oldest:
+        click.echo(f'Самое старое письмо в очереди: {oldest:%Y-%m-%d %H:%M:%S} UTC')
+
+
+@forum_cli.command('import')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=10000, show_default=True, help='Строк в одной пачке COPY')
+@click.option('--restart', is_flag=True,
+              help='Начать файлы сначала, забыв сохраненную позицию (загруженные строки не удаляются)')
+def import_dump(paths, batch_size, restart):
+    """
+    Импортировать дамп старого форума из CSV/JSONL
+    
+    Таблица определяется по имени файла (users.csv, topics.jsonl.gz,
+    posts.csv, chat_messages.jsonl). После прерывания повторный запуск
+    с теми же файлами продолжает с первой незагруженной строки.
+    """
+    from app.importer import Importer, ImportDataError
+    
+    # Лог SQL режима разработки с миллионами строк только замедлит загрузку
+    db.engine.echo = False
+    
+    try:
+        importer = Importer(paths, batch_size=batch_size, echo=click.echo)
+        if restart:
+            importer.restart()
+        loaded = importer.run()
+    except ImportDataError as e:
+        raise click.ClickException(f'{e}. Исправьте файл и запустите импорт снова — '
+                                   f'загрузка продолжится с этой строки')
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    
+    click.echo(f'✓ Импорт завершен, загружено строк: {sum(loaded.values())}')
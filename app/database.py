@@ -0,0 +1,232 @@
+"""Подключение к БД: пул соединений, режим PgBouncer и таймауты запросов
+
+Параметры пула (DB_POOL_*) задаются в классе конфигурации и переводятся в
+SQLALCHEMY_ENGINE_OPTIONS функцией engine_options() до создания движка.
+Соединения проверяются перед выдачей (pre-ping) и пересоздаются через
+DB_POOL_RECYCLE секунд, поэтому после перезапуска PostgreSQL пул
+восстанавливается сам, без ошибок в запросах.
+
+Под eventlet драйвер psycopg2 ждет ответа БД через hub (set_wait_callback),
+а не блокирует весь процесс; число одновременных запросов ограничено
+размером пула, остальные гринлеты ждут соединение до DB_POOL_TIMEOUT.
+
+Таймаут запросов: DB_STATEMENT_TIMEOUT для всех запросов и
+DB_ROUTE_STATEMENT_TIMEOUTS для отдельных маршрутов (endpoint -> мс).
+В обычном режиме общий таймаут передается при подключении, маршрутный —
+SET LOCAL в начале транзакции.
+
+Режим PgBouncer (DB_PGBOUNCER=true, пул в режиме transaction): соединение
+сервера меняется между транзакциями, поэтому состояние сессии не
+используется — параметры подключения (options) не передаются, таймауты
+ставятся SET LOCAL в каждой транзакции, подготовленные на сервере
+запросы отключены (psycopg2 их не использует, для psycopg 3 задается
+prepare_threshold=None).
+
+Пул считает ожидание соединения и занятые соединения; снимок отдает
+pool_stats().
+"""
+
+import threading
+import time
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from app import db
+
+
+class PoolStats:
+    """Счетчики ожидания соединений пула"""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.slow_wait = 0.5
+        self._lock = threading.Lock()
+
+    def record(self, seconds, waited=False, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            if not waited:
+                return
+            self.waits += 1
+            self.wait_seconds += seconds
+            if seconds > self.max_wait_seconds:
+                self.max_wait_seconds = seconds
+            if timed_out:
+                self.timeouts += 1
+
+
+stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, замеряющий время ожидания свободного соединения"""
+
+    def _do_get(self):
+        # Ожидание — только когда свободных соединений нет и открывать новые нельзя
+        exhausted = self.checkedin() == 0 and self._max_overflow > -1 \
+            and self.overflow() >= self._max_overflow
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            stats.record(time.perf_counter() - started, waited=True, timed_out=True)
+            raise
+
+        seconds = time.perf_counter() - started
+        stats.record(seconds, waited=exhausted)
+        if seconds >= stats.slow_wait and database.app is not None:
+            database.app.logger.warning(
+                f'Waited {seconds:.2f}s for a database connection '
+                f'(pool size {self.size()}, in use {self.checkedout()})'
+            )
+        return connection
+
+
+def engine_options(config):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS по параметрам DB_* конфигурации
+
+    Явно заданные SQLALCHEMY_ENGINE_OPTIONS не изменяются.
+    """
+    if config.get('SQLALCHEMY_ENGINE_OPTIONS'):
+        return config['SQLALCHEMY_ENGINE_OPTIONS']
+
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # База в памяти живет в единственном соединении
+        return {}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        # Свежие соединения сверху: лишние простаивают и закрываются по recycle
+        'pool_use_lifo': True,
+    }
+
+    if url.get_backend_name() == 'postgresql':
+        connect_args = {'connect_timeout': config['DB_CONNECT_TIMEOUT']}
+        if config['DB_PGBOUNCER']:
+            if url.get_driver_name() == 'psycopg':
+                connect_args['prepare_threshold'] = None
+        elif config['DB_STATEMENT_TIMEOUT']:
+            connect_args['options'] = f'-c statement_timeout={config["DB_STATEMENT_TIMEOUT"]}'
+        options['connect_args'] = connect_args
+
+    return options
+
+
+def _eventlet_wait(connection, timeout=None):
+    """Ожидание ответа psycopg2 через hub eventlet"""
+    import psycopg2
+    from psycopg2 import extensions
+    from eventlet.hubs import trampoline
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            trampoline(connection.fileno(), read=True)
+        elif state == extensions.POLL_WRITE:
+            trampoline(connection.fileno(), write=True)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state}')
+
+
+def _green_driver():
+    """Включить ожидание psycopg2 через hub, если процесс работает под eventlet"""
+    try:
+        from eventlet import patcher
+        from psycopg2 import extensions
+    except ImportError:
+        return False
+
+    if not patcher.is_monkey_patched('socket'):
+        return False
+    extensions.set_wait_callback(_eventlet_wait)
+    return True
+
+
+class Database:
+    """Обработчики движка: таймауты запросов и учет пула"""
+
+    def __init__(self):
+        self.app = None
+        self.pgbouncer = False
+        self.statement_timeout = 0
+        self.route_timeouts = {}
+
+    def init_app(self, app):
+        """Подключить обработчики к движку приложения (после db.init_app)"""
+        self.app = app
+        self.pgbouncer = app.config['DB_PGBOUNCER']
+        self.statement_timeout = app.config['DB_STATEMENT_TIMEOUT']
+        self.route_timeouts = app.config['DB_ROUTE_STATEMENT_TIMEOUTS']
+        stats.slow_wait = app.config['DB_POOL_WAIT_WARNING']
+        app.extensions['database'] = self
+
+        with app.app_context():
+            # Основная БД и реплики (SQLALCHEMY_BINDS)
+            engines = [engine for engine in db.engines.values() if engine.dialect.name == 'postgresql']
+        if not engines:
+            return
+
+        if app.config['DB_GREEN_DRIVER'] and any(engine.dialect.driver == 'psycopg2' for engine in engines) \
+                and _green_driver():
+            app.logger.info('psycopg2 waits for the database through the eventlet hub')
+
+        for engine in engines:
+            event.listen(engine, 'begin', self._on_begin)
+
+    def timeout_for_request(self):
+        """Таймаут текущего маршрута (мс) или None"""
+        if not has_request_context() or request.endpoint is None:
+            return None
+        return self.route_timeouts.get(request.endpoint)
+
+    def _on_begin(self, connection):
+        timeout = self.timeout_for_request()
+        if timeout is None and self.pgbouncer:
+            # Параметры подключения через PgBouncer не передаются
+            timeout = self.statement_timeout
+        if timeout:
+            connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+
+def pool_stats():
+    """
+    Снимок состояния пула соединений
+
+    Returns:
+        словарь: размер, занятые и сверх размера соединения, число выдач,
+        ожиданий и таймаутов, суммарное и максимальное ожидание (сек)
+    """
+    pool = db.engine.pool
+    snapshot = {
+        'size': pool.size() if hasattr(pool, 'size') else None,
+        'in_use': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+        'idle': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+        'overflow': max(0, pool.overflow()) if hasattr(pool, 'overflow') else None,
+    }
+    with stats._lock:
+        snapshot.update(
+            checkouts=stats.checkouts,
+            waits=stats.waits,
+            timeouts=stats.timeouts,
+            wait_seconds=round(stats.wait_seconds, 6),
+            max_wait_seconds=round(stats.max_wait_seconds, 6),
+        )
+    return snapshot
+
+
+database = Database()
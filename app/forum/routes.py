@@ -1,45 +1,136 @@
 """Маршруты форума"""
 
-from flask import render_template, redirect, url_for, flash, request, current_app
+from flask import render_template, redirect, url_for, flash, request, current_app, jsonify
 from flask_login import login_required, current_user
 from app.forum import forum_bp
 from app import db
-from app.models import Topic, Post
+from app.models import Topic, Post, User
+from sqlalchemy.orm import joinedload
 from app.utils import allowed_file, save_picture
+from app.view_counter import view_counter
+from app.pagination import keyset_paginate, approximate_count
+from app.page_cache import page_cache
+from app.metrics import query_budget
+from app.site_stats import site_stats
+from app import search
 
 
-@forum_bp.route('/')
-def index():
-    """Список всех топиков"""
-    page = request.args.get('page', 1, type=int)
+def _topics_page():
+    """Страница списка топиков по курсору из запроса"""
+    query = Topic.query.options(
+        joinedload(Topic.author),
+        joinedload(Topic.last_poster)
+    )
     
-    topics = Topic.query.order_by(Topic.updated_at.desc()).paginate(
-        page=page,
+    return keyset_paginate(
+        query,
+        (Topic.updated_at, Topic.id),
         per_page=current_app.config['TOPICS_PER_PAGE'],
-        error_out=False
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        last='last' in request.args,
+        descending=True,
+        total=approximate_count(Topic)
     )
+
+
+def _posts_page(topic):
+    """Страница постов топика по курсору из запроса"""
+    query = Post.query.options(joinedload(Post.author)).filter_by(topic_id=topic.id)
+    
+    return keyset_paginate(
+        query,
+        (Post.created_at, Post.id),
+        per_page=current_app.config['POSTS_PER_PAGE'],
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        last='last' in request.args,
+        total=topic.post_count
+    )
+
+
+@forum_bp.route('/')
+@query_budget(4)
+@page_cache.cached('topics')
+def index():
+    """Список всех топиков"""
+    topics = _topics_page()
     
     return render_template('forum/index.html', topics=topics)
 
 
+def _render_topic(topic_id):
+    topic = Topic.query.get_or_404(topic_id)
+    topic_views = (topic.views or 0) + view_counter.pending(topic.id)
+    
+    posts = _posts_page(topic)
+    
+    return render_template('forum/topic.html', topic=topic, posts=posts,
+                           topic_views=topic_views)
+
+
 @forum_bp.route('/topic/<int:topic_id>')
+@query_budget(4)
 def topic_view(topic_id):
     """Просмотр конкретного топика"""
-    topic = Topic.query.get_or_404(topic_id)
+    response = page_cache.response(lambda: _render_topic(topic_id), f'topic:{topic_id}')
     
-    # Увеличиваем счетчик просмотров
-    topic.views += 1
-    db.session.commit()
+    # Учитываем просмотр в буфере (и при ответе из кэша), в БД он попадет
+    # пакетным сбросом
+    if response.status_code in (200, 304):
+        view_counter.incr(topic_id)
     
-    page = request.args.get('page', 1, type=int)
+    return response
+
+
+@forum_bp.route('/api/topics')
+@query_budget(3)
+def api_topics():
+    """API: страница списка топиков"""
+    return jsonify(_topics_page().to_dict(Topic.to_dict))
+
+
+@forum_bp.route('/api/topic/<int:topic_id>/posts')
+@query_budget(3)
+def api_posts(topic_id):
+    """API: страница постов топика"""
+    topic = Topic.query.get_or_404(topic_id)
     
-    posts = Post.query.filter_by(topic_id=topic_id).order_by(Post.created_at.asc()).paginate(
-        page=page,
-        per_page=current_app.config['POSTS_PER_PAGE'],
-        error_out=False
+    return jsonify(_posts_page(topic).to_dict(Post.to_dict))
+
+
+def _search_page():
+    """Страница результатов поиска по запросу и курсору из запроса"""
+    return search.search(
+        request.args.get('q', ''),
+        per_page=current_app.config['SEARCH_RESULTS_PER_PAGE'],
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        last='last' in request.args
     )
-    
-    return render_template('forum/topic.html', topic=topic, posts=posts)
+
+
+@forum_bp.route('/search')
+@query_budget(4)
+def search_view():
+    """Поиск по топикам и постам"""
+    q = request.args.get('q', '').strip()
+    results = _search_page()
+    
+    return render_template('forum/search.html', q=q, results=results,
+                           hit_url_params=search.hit_url_params,
+                           highlight=search.highlight)
+
+
+@forum_bp.route('/api/search')
+@query_budget(4)
+def api_search():
+    """API: поиск по топикам и постам"""
+    results = _search_page()
+    if results is None:
+        return jsonify({'error': 'Пустой запрос'}), 400
+    
+    return jsonify(results.to_dict(search.hit_to_dict))
 
 
 @forum_bp.route('/topic/create', methods=['GET', 'POST'])
@@ -65,8 +156,14 @@ def topic_create():
         )
         
         db.session.add(topic)
+        db.session.flush()
+        search.index_topic(topic)
+        User.change_counters(current_user.id, topic_count=1)
+        site_stats.incr('topics')
         db.session.commit()
         
+        page_cache.invalidate('topics')
+        
         flash('Топик успешно создан!', 'success')
         return redirect(url_for('forum.topic_view', topic_id=topic.id))
     
@@ -100,14 +197,20 @@ def post_create(topic_id):
     )
     
     db.session.add(post)
+    db.session.flush()
     
-    # Обновляем время обновления топика
-    topic.updated_at = db.func.now()
+    # Обновляем счетчики и время обновления топика в той же транзакции
+    topic.register_post(post)
+    search.index_post(post)
+    User.change_counters(current_user.id, post_count=1)
+    site_stats.incr('posts')
     
     db.session.commit()
     
+    page_cache.invalidate('topics', f'topic:{topic_id}')
+    
     flash('Сообщение успешно добавлено!', 'success')
-    return redirect(url_for('forum.topic_view', topic_id=topic_id))
+    return redirect(url_for('forum.topic_view', topic_id=topic_id, last=1))
 
 
 @forum_bp.route('/post/<int:post_id>/delete', methods=['POST'])
@@ -128,9 +231,15 @@ def post_delete(post_id):
         from app.utils import delete_picture
         delete_picture(post.image, 'posts')
     
+    post.topic.unregister_post(post)
+    search.remove_post(post)
+    User.change_counters(post.author_id, post_count=-1)
+    site_stats.incr('posts', -1)
     db.session.delete(post)
     db.session.commit()
     
+    page_cache.invalidate('topics', f'topic:{topic_id}')
+    
     flash('Сообщение удалено', 'info')
     return redirect(url_for('forum.topic_view', topic_id=topic_id))
 
@@ -0,0 +1,104 @@
+"""Кэш пользователя для current_user
+
+Flask-Login вызывает user_loader на каждый HTTP-запрос, а Flask-SocketIO —
+на каждое событие сокета (включая частые typing). Вместо полной модели
+User загрузчик отдает легкий SessionUser (id, имя, email, аватар, флаг
+подтверждения) из общего кэша с временем жизни USER_IDENTITY_TTL.
+
+Для сокетов копия пользователя дополнительно хранится на соединении
+(по request.sid) и обновляется из кэша раз в USER_IDENTITY_TTL — события
+одного соединения не обращаются ни к БД, ни к Redis.
+
+После изменения имени, аватара, пароля или подтверждения email вызывается
+invalidate(user_id): запись удаляется из общего кэша, а копии на
+соединениях этого процесса сбрасываются. Соединения в других процессах
+увидят изменения не позже чем через USER_IDENTITY_TTL секунд.
+
+Код, которому нужна модель (изменение профиля, отношения), загружает ее
+явно: ``User.query.get(current_user.id)``.
+"""
+
+import time
+from flask import current_app, request
+from flask_login import UserMixin
+from app import db, login_manager
+from app.cache import cache
+from app.models import User
+
+# Поля модели User, которые копируются в SessionUser
+FIELDS = ('id', 'username', 'email', 'avatar', 'email_verified')
+
+
+class SessionUser(UserMixin):
+    """Легкая копия пользователя для current_user"""
+
+    def __init__(self, id, username, email, avatar, email_verified):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.avatar = avatar
+        self.email_verified = email_verified
+
+    def __repr__(self):
+        return f'<SessionUser {self.username}>'
+
+
+# sid соединения -> (SessionUser, время обновления)
+_connections = {}
+
+
+def _key(user_id):
+    return f'user_identity:{user_id}'
+
+
+def get_identity(user_id):
+    """
+    SessionUser из общего кэша или из БД
+
+    Returns:
+        SessionUser или None, если пользователь не существует
+    """
+    fields = cache.get(_key(user_id))
+    if fields is None:
+        row = db.session.execute(
+            db.select(*(getattr(User, name) for name in FIELDS)).where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        fields = dict(row._mapping)
+        cache.set(_key(user_id), fields, ttl=current_app.config['USER_IDENTITY_TTL'])
+    return SessionUser(**fields)
+
+
+def invalidate(user_id):
+    """Сбросить кэш пользователя после изменения его данных"""
+    cache.delete(_key(user_id))
+    for sid, (user, _) in list(_connections.items()):
+        if user.id == user_id:
+            _connections.pop(sid, None)
+
+
+def forget_connection(sid):
+    """Убрать копию пользователя при отключении сокета"""
+    _connections.pop(sid, None)
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    """Загрузить пользователя по ID для Flask-Login"""
+    user_id = int(user_id)
+    sid = getattr(request, 'sid', None)
+    if sid is None:
+        return get_identity(user_id)
+
+    # Событие сокета: копия на соединении
+    entry = _connections.get(sid)
+    now = time.monotonic()
+    if entry is not None and entry[0].id == user_id \
+            and now - entry[1] < current_app.config['USER_IDENTITY_TTL']:
+        return entry[0]
+
+    user = get_identity(user_id)
+    if user is not None:
+        _connections[sid] = (user, now)
+    return user
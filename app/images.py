@@ -0,0 +1,241 @@
+"""Обработка загруженных изображений
+
+В запросе сохраняется только исходный файл, а декодирование, уменьшение
+и перекодирование выполняются в фоне, чтобы CPU-нагрузка Pillow не
+блокировала eventlet hub. Под eventlet обработка идет в пуле нативных
+потоков eventlet.tpool (Pillow отпускает GIL на декодировании, ресайзе и
+кодировании); пул процессов в процессе с monkey patching создавать нельзя —
+его служебные потоки и очереди работают на зеленых примитивах. Без
+eventlet используется пул процессов. IMAGE_WORKERS ограничивает число
+одновременно обрабатываемых изображений.
+
+Для каждого изображения создаются варианты (thumb/medium/original) в
+форматах из IMAGE_FORMATS без метаданных:
+
+    <имя>.<расширение>          — исходная загрузка (хранится в БД)
+    <имя>_<вариант>.<формат>    — производные файлы
+
+Список готовых вариантов записывается в кэш по окончании обработки, и
+шаблоны не проверяют файлы на диске при каждом рендере. Для загрузок,
+сделанных до появления записи в кэше, список один раз собирается с диска.
+Пока варианты не готовы, шаблоны получают исходный файл.
+"""
+
+import glob
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+from app.cache import cache, LocalCacheBackend
+from app.passwords import _eventlet_patched
+
+# Параметры сохранения для форматов Pillow
+FORMAT_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+}
+
+# Время жизни списка вариантов, собранного с диска (сек): если он собран во
+# время обработки, запись по ее окончании все равно его заменит
+PROBE_TTL = 300
+# Время жизни копии списка в памяти процесса (сек)
+LOCAL_TTL = 60
+
+_executor = None
+_semaphore = None
+# Списки вариантов, уже прочитанные из общего кэша этим процессом
+_known = LocalCacheBackend(max_entries=20000)
+
+
+def variant_name(filename, variant, fmt):
+    """Имя файла варианта изображения"""
+    base, _ = os.path.splitext(filename)
+    return f'{base}_{variant}.{fmt}'
+
+
+def process_image(source_path, variants, formats):
+    """
+    Создать варианты изображения (выполняется в пуле процессов или потоков)
+
+    Args:
+        source_path: путь к исходному файлу
+        variants: словарь {вариант: (ширина, высота)}
+        formats: список форматов ('webp', 'jpeg')
+
+    Returns:
+        список созданных файлов
+    """
+    folder, filename = os.path.split(source_path)
+    created = []
+
+    with Image.open(source_path) as img:
+        # Для JPEG декодируем сразу в уменьшенном масштабе, если это возможно
+        largest = max(variants.values())
+        img.draft('RGB', largest)
+
+        # Применяем ориентацию из EXIF до того, как метаданные будут отброшены
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+
+        for variant, size in variants.items():
+            resized = img.copy()
+            resized.thumbnail(size, Image.LANCZOS)
+
+            for fmt in formats:
+                out = resized.convert('RGB') if fmt == 'jpeg' else resized
+                path = os.path.join(folder, variant_name(filename, variant, fmt))
+                tmp_path = path + '.tmp'
+
+                # Без exif/icc_profile: метаданные не переносятся в вариант
+                out.save(tmp_path, **FORMAT_OPTIONS[fmt])
+                os.replace(tmp_path, path)
+                created.append(path)
+
+    return created
+
+
+def _get_executor(app):
+    global _executor
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=app.config['IMAGE_WORKERS'],
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def _cache_key(folder, filename):
+    return f'image_variants:{folder}/{filename}'
+
+
+def _record(folder, filename, created):
+    """Записать готовые варианты в кэш"""
+    names = sorted(os.path.basename(path) for path in created)
+    cache.set(_cache_key(folder, filename), names)
+    _known.set(_cache_key(folder, filename), names, LOCAL_TTL)
+
+
+def _process(app, folder, filename, variants, formats, run=None):
+    source_path = os.path.join(app.config['UPLOAD_FOLDER'], folder, filename)
+    try:
+        if run:
+            created = run(process_image, source_path, variants, formats)
+        else:
+            created = process_image(source_path, variants, formats)
+    except Exception as e:
+        app.logger.error(f'Error processing image {source_path}: {e}')
+        return
+    # Запись в кэш — в гринлете: зеленые сокеты Redis нельзя трогать из потока tpool
+    _record(folder, filename, created)
+
+
+def _process_in_tpool(app, folder, filename, variants, formats):
+    from eventlet import tpool
+
+    # Семафор после monkey patching зеленый: ожидание не блокирует hub
+    with _semaphore:
+        _process(app, folder, filename, variants, formats, run=tpool.execute)
+
+
+def _log_result(app, folder, filename):
+    def callback(future):
+        error = future.exception()
+        if error:
+            source_path = os.path.join(app.config['UPLOAD_FOLDER'], folder, filename)
+            app.logger.error(f'Error processing image {source_path}: {error}')
+        else:
+            _record(folder, filename, future.result())
+    return callback
+
+
+def enqueue_processing(folder, filename):
+    """Поставить изображение в очередь на создание вариантов"""
+    global _semaphore
+
+    app = current_app._get_current_object()
+    variants = app.config['IMAGE_VARIANTS'][folder]
+    formats = app.config['IMAGE_FORMATS']
+
+    if not app.config['IMAGE_WORKERS']:
+        # Без пула (разработка) обрабатываем сразу
+        _process(app, folder, filename, variants, formats)
+        return
+
+    if _eventlet_patched():
+        from app import socketio
+        if _semaphore is None:
+            _semaphore = threading.BoundedSemaphore(app.config['IMAGE_WORKERS'])
+        socketio.start_background_task(_process_in_tpool, app, folder, filename, variants, formats)
+        return
+
+    source_path = os.path.join(app.config['UPLOAD_FOLDER'], folder, filename)
+    future = _get_executor(app).submit(process_image, source_path, variants, formats)
+    future.add_done_callback(_log_result(app, folder, filename))
+
+
+def delete_variants(folder, filename):
+    """Удалить производные файлы изображения"""
+    base, _ = os.path.splitext(filename)
+    pattern = os.path.join(current_app.config['UPLOAD_FOLDER'], folder, glob.escape(base) + '_*.*')
+    for path in glob.glob(pattern):
+        os.remove(path)
+    cache.delete(_cache_key(folder, filename))
+    _known.delete(_cache_key(folder, filename))
+
+
+def _ready_variants(folder, filename):
+    """Имена готовых файлов вариантов: из памяти процесса, кэша или (один раз) с диска"""
+    key = _cache_key(folder, filename)
+    names = _known.get(key)
+    if names is not None:
+        return names
+
+    names = cache.get(key)
+    if names is None:
+        # Загрузка до появления записей в кэше или запись вытеснена
+        base, _ = os.path.splitext(filename)
+        pattern = os.path.join(current_app.config['UPLOAD_FOLDER'], folder, glob.escape(base) + '_*.*')
+        names = sorted(os.path.basename(path) for path in glob.glob(pattern) if not path.endswith('.tmp'))
+        # add: не перезаписать список, записанный обработкой за это время
+        if not cache.add(key, names, PROBE_TTL):
+            names = cache.get(key) or names
+
+    _known.set(key, names, LOCAL_TTL)
+    return names
+
+
+def _variant_exists(folder, filename, variant, fmt):
+    return variant_name(filename, variant, fmt) in _ready_variants(folder, filename)
+
+
+def image_url(folder, filename, variant='medium', fmt='jpeg'):
+    """URL варианта изображения или исходного файла, если вариант еще не готов"""
+    if filename and variant in current_app.config['IMAGE_VARIANTS'].get(folder, {}) \
+            and _variant_exists(folder, filename, variant, fmt):
+        filename = variant_name(filename, variant, fmt)
+
+    return url_for('static', filename=f'uploads/{folder}/{filename}')
+
+
+def image_srcset(folder, filename, fmt='jpeg'):
+    """Значение srcset по готовым вариантам изображения (ширина из IMAGE_VARIANTS)"""
+    if not filename:
+        return ''
+
+    entries = []
+    for variant, (width, _) in current_app.config['IMAGE_VARIANTS'].get(folder, {}).items():
+        if _variant_exists(folder, filename, variant, fmt):
+            url = url_for('static', filename=f'uploads/{folder}/{variant_name(filename, variant, fmt)}')
+            entries.append(f'{url} {width}w')
+
+    return ', '.join(entries)
+
+
+def init_app(app):
+    """Зарегистрировать функции для шаблонов"""
+    app.add_template_global(image_url)
+    app.add_template_global(image_srcset)
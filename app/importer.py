@@ -0,0 +1,287 @@
+"""Импорт дампа старого форума из CSV/JSONL
+
+Каждый файл содержит одну таблицу; она определяется по имени файла:
+users, topics, posts, chat_messages (или messages), расширения .csv,
+.jsonl и их сжатые варианты .csv.gz/.jsonl.gz. Имена полей совпадают со
+столбцами таблицы (в CSV — заголовок, в JSONL — ключи первой записи);
+id из дампа сохраняются, чтобы связи между таблицами остались прежними.
+Пустое поле CSV и null в JSONL — NULL; незаполненные столбцы получают
+значения по умолчанию модели (created_at, email_verified и т. д.).
+
+Пароли передаются готовыми хешами (password_hash) в формате Werkzeug
+(``scrypt:...$соль$хеш`` или ``pbkdf2:...``): хеш с другими параметрами,
+чем PASSWORD_HASH_METHOD, пересчитается при первом входе пользователя.
+
+Файлы читаются потоком и загружаются пачками через COPY (app/bulk.py),
+в памяти — только текущая пачка. Порядок загрузки — по зависимостям
+таблиц, а не по порядку аргументов. На время загрузки вторичные индексы
+удаляются; индексы, счетчики, сводки переписок и последовательности id
+восстанавливаются в конце.
+
+Позиция каждого файла хранится в import_progress и обновляется в
+транзакции пачки: после прерывания повторный запуск с теми же файлами
+пропускает загруженные строки и продолжает со следующей. Пока импорт не
+завершен, индексы таблиц отсутствуют — форум на это время лучше
+остановить.
+"""
+
+import csv
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from app import db, bulk
+from app.models import User, Topic, Post, ChatMessage, ImportProgress
+
+# Таблицы в порядке загрузки (внешние ключи ссылаются на предыдущие)
+TABLES = {
+    'users': User,
+    'topics': Topic,
+    'posts': Post,
+    'chat_messages': ChatMessage,
+}
+
+ALIASES = {'messages': 'chat_messages'}
+
+# Алгоритмы хешей, которые умеет проверять User.check_password
+HASH_METHODS = ('scrypt:', 'pbkdf2:')
+
+TRUE_VALUES = {'1', 'true', 't', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'f', 'no', 'n'}
+
+
+class ImportDataError(ValueError):
+    """Строка дампа не подходит для загрузки"""
+
+    def __init__(self, path, line, message):
+        super().__init__(f'{os.path.basename(path)}, строка {line}: {message}')
+        self.path = path
+        self.line = line
+
+
+def table_for(path):
+    """Имя таблицы по имени файла"""
+    name = os.path.basename(path).split('.', 1)[0].lower()
+    name = ALIASES.get(name, name)
+    if name not in TABLES:
+        raise ValueError(f'{os.path.basename(path)}: неизвестная таблица {name!r} '
+                         f'(ожидаются {", ".join(TABLES)})')
+    return name
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def read_records(path):
+    """
+    Записи файла по одной
+
+    Yields:
+        (номер строки файла, словарь полей)
+    """
+    base = path[:-3] if path.endswith('.gz') else path
+    with _open(path) as f:
+        if base.endswith('.jsonl'):
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    yield line, json.loads(text)
+        elif base.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for record in reader:
+                # Пустое поле CSV — NULL
+                yield reader.line_num, {key: value if value != '' else None for key, value in record.items()}
+        else:
+            raise ValueError(f'{os.path.basename(path)}: ожидается .csv или .jsonl')
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    # В БД время хранится в UTC без часового пояса
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f'не логическое значение {value!r}')
+
+
+class Converter:
+    """Преобразование записей дампа в строки таблицы"""
+
+    def __init__(self, table, fields):
+        self.table = table.__table__
+        unknown = [field for field in fields if field not in self.table.c]
+        if unknown:
+            raise ValueError(f'{self.table.name}: неизвестные поля {", ".join(unknown)}')
+
+        self.fields = list(fields)
+        # Столбцы, которых нет в дампе, но у модели есть значение по умолчанию
+        self.defaults = [
+            column for column in self.table.c
+            if column.name not in fields and column.default is not None and not column.primary_key
+        ]
+        self.columns = tuple(self.fields) + tuple(column.name for column in self.defaults)
+        self.required = [column.name for column in self.table.c
+                         if not column.nullable and column.default is None and column.server_default is None
+                         and not column.primary_key]
+        absent = [name for name in self.required if name not in self.columns]
+        if absent:
+            raise ValueError(f'{self.table.name}: в файле нет обязательных полей {", ".join(absent)}')
+
+    def convert(self, record):
+        """Кортеж значений в порядке self.columns"""
+        values = []
+        for field in self.fields:
+            values.append(self._value(self.table.c[field], record.get(field)))
+        for column in self.defaults:
+            default = column.default
+            values.append(default.arg(None) if default.is_callable else default.arg)
+
+        missing = [name for name in self.required if values[self.columns.index(name)] is None]
+        if missing:
+            raise ValueError(f'не заполнены {", ".join(missing)}')
+        if self.table.name == 'users':
+            self._check_hash(values[self.columns.index('password_hash')])
+        return tuple(values)
+
+    def _value(self, column, value):
+        if value is None:
+            return None
+
+        python_type = column.type.python_type
+        if python_type is datetime:
+            return _parse_datetime(value)
+        if python_type is bool:
+            return _parse_bool(value)
+        if python_type is int:
+            return int(value)
+
+        value = str(value)
+        length = getattr(column.type, 'length', None)
+        if length and len(value) > length:
+            raise ValueError(f'{column.name}: длиннее {length} символов')
+        return value
+
+    def _check_hash(self, value):
+        if not value.startswith(HASH_METHODS) or value.count('$') != 2:
+            raise ValueError('password_hash: ожидается хеш Werkzeug (scrypt:... или pbkdf2:...)')
+
+
+class Importer:
+    """Загрузка файлов дампа с продолжением после прерывания"""
+
+    def __init__(self, paths, batch_size=10000, echo=print):
+        self.batch_size = batch_size
+        self.echo = echo
+        self.files = sorted(((table_for(path), path) for path in paths),
+                            key=lambda item: list(TABLES).index(item[0]))
+        self.tables = [TABLES[name] for name in dict.fromkeys(name for name, _ in self.files)]
+
+    @staticmethod
+    def source(name, path):
+        """Ключ файла в import_progress"""
+        return f'{name}:{os.path.basename(path)}'
+
+    def progress(self, name, path):
+        return db.session.get(ImportProgress, self.source(name, path))
+
+    def restart(self):
+        """Забыть позиции файлов (уже загруженные строки не удаляются)"""
+        sources = [self.source(name, path) for name, path in self.files]
+        db.session.execute(db.delete(ImportProgress).where(ImportProgress.source.in_(sources)))
+        db.session.commit()
+
+    def run(self):
+        """
+        Загрузить файлы и восстановить индексы и производные данные
+
+        Returns:
+            словарь {файл: загружено строк в этом запуске}
+        """
+        # Ошибки в заголовках файлов — до удаления индексов
+        for name, path in self.files:
+            first = next(read_records(path), None)
+            if first is not None:
+                Converter(TABLES[name], first[1].keys())
+
+        loaded = {}
+        with bulk.unlimited_statements():
+            bulk.drop_indexes(self.tables)
+            for name, path in self.files:
+                loaded[path] = self.load(name, path)
+
+            self.echo('Построение индексов...')
+            bulk.create_indexes(self.tables)
+            self.echo('✓ Индексы построены')
+            bulk.finish(self.tables, echo=self.echo)
+        return loaded
+
+    def load(self, name, path):
+        """Загрузить один файл с позиции из import_progress"""
+        source = self.source(name, path)
+        state = self.progress(name, path)
+        if state is not None and state.finished_at is not None:
+            self.echo(f'{os.path.basename(path)}: уже загружен ({state.rows} строк)')
+            return 0
+
+        skip = state.rows if state is not None else 0
+        if state is None:
+            db.session.add(ImportProgress(source=source, rows=0))
+        db.session.commit()
+
+        records = read_records(path)
+        first = next(records, None)
+        if first is None:
+            self._mark(source, skip, finished=True)
+            return 0
+        converter = Converter(TABLES[name], first[1].keys())
+
+        def rows():
+            for index, (line, record) in enumerate(_chain(first, records)):
+                if index < skip:
+                    continue
+                try:
+                    yield converter.convert(record)
+                except (ValueError, TypeError) as e:
+                    raise ImportDataError(path, line, e) from None
+
+        if skip:
+            self.echo(f'{os.path.basename(path)}: продолжение с записи {skip + 1}')
+        else:
+            self.echo(f'{os.path.basename(path)}: загрузка в {name}')
+
+        def on_batch(connection, count):
+            connection.execute(db.update(ImportProgress).where(ImportProgress.source == source).values(
+                rows=skip + count, updated_at=datetime.utcnow()
+            ))
+
+        count = bulk.copy_rows(TABLES[name], converter.columns, rows(), self.batch_size,
+                               progress=lambda count: self.echo(f'  {skip + count} строк'),
+                               on_batch=on_batch)
+        self._mark(source, skip + count, finished=True)
+        return count
+
+    def _mark(self, source, rows, finished=False):
+        db.session.execute(db.update(ImportProgress).where(ImportProgress.source == source).values(
+            rows=rows, updated_at=datetime.utcnow(), finished_at=datetime.utcnow() if finished else None
+        ))
+        db.session.commit()
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
@@ -0,0 +1,306 @@
+"""Очередь исходящих писем
+
+Письмо сохраняется в таблицу email_outbox в транзакции запроса
+(Outbox.enqueue), а отправляет его фоновый обработчик: письма не
+теряются при сбое SMTP или перезапуске процесса, а всплеск регистраций
+не порождает поток на каждое письмо.
+
+Обработчик забирает письма пакетами по EMAIL_BATCH_SIZE и отправляет их
+через одно постоянное SMTP-соединение (закрывается после
+EMAIL_SMTP_IDLE_TIMEOUT секунд простоя), не быстрее EMAIL_RATE_LIMIT
+писем в секунду на процесс. Неудачная отправка повторяется с
+экспоненциальной задержкой, после EMAIL_MAX_ATTEMPTS попыток (или при
+постоянной ошибке 5xx) письмо помечается как failed.
+
+Письма захватываются арендой (claimed_by/claimed_until): если процесс
+упал посреди пакета, после EMAIL_CLAIM_TIMEOUT письма заберет другой.
+Письмо, отправленное перед самым падением, может уйти повторно — очередь
+гарантирует доставку «хотя бы один раз».
+
+При EMAIL_OUTBOX_WORKER=false процессы приложения только ставят письма
+в очередь, а отправляет их отдельный процесс ``flask forum send-emails --loop``.
+"""
+
+import secrets
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from flask_mail import Message
+from sqlalchemy import event
+from app import db, mail, socketio
+from app.models import EmailMessage
+
+# Верхняя граница задержки между попытками (сек)
+MAX_RETRY_DELAY = 3600
+
+# Шаг ожидания обработчика: проверка флага «есть новые письма»
+WAKEUP_CHECK_INTERVAL = 0.2
+
+
+class Outbox:
+    """Очередь писем в БД с фоновой отправкой"""
+
+    def __init__(self):
+        self.app = None
+        self.batch_size = 50
+        self.rate_limit = 10
+        self.max_attempts = 8
+        self.retry_delay = 30
+        self.poll_interval = 5
+        self.claim_timeout = 300
+        self.idle_timeout = 60
+        self.run_worker = True
+        self._connection = None
+        self._last_used = 0
+        self._next_send = 0
+        self._wakeup = False
+        self._worker_started = False
+        self._worker_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Привязать очередь к приложению"""
+        self.app = app
+        self.batch_size = app.config['EMAIL_BATCH_SIZE']
+        self.rate_limit = app.config['EMAIL_RATE_LIMIT']
+        self.max_attempts = app.config['EMAIL_MAX_ATTEMPTS']
+        self.retry_delay = app.config['EMAIL_RETRY_DELAY']
+        self.poll_interval = app.config['EMAIL_POLL_INTERVAL']
+        self.claim_timeout = app.config['EMAIL_CLAIM_TIMEOUT']
+        self.idle_timeout = app.config['EMAIL_SMTP_IDLE_TIMEOUT']
+        self.run_worker = app.config['EMAIL_OUTBOX_WORKER']
+        app.extensions['outbox'] = self
+
+        # Письма, оставшиеся в очереди после перезапуска, отправятся
+        # с первым запросом, даже если новых писем нет
+        app.before_request(self._ensure_worker)
+
+    def enqueue(self, subject, recipient, text_body, html_body=None, dedupe_key=None):
+        """
+        Поставить письмо в очередь в текущей транзакции
+
+        Письмо уйдет после commit. Если в очереди уже ждет письмо с тем же
+        dedupe_key, оно заменяется новым (например, повторный запрос кода
+        подтверждения отправит одно письмо с последним кодом).
+        """
+        now = datetime.utcnow()
+        values = {
+            'recipient': recipient,
+            'subject': subject,
+            'text_body': text_body,
+            'html_body': html_body,
+            'next_attempt_at': now,
+        }
+
+        replaced = 0
+        if dedupe_key:
+            # Захваченное письмо уже отправляется, его не трогаем
+            replaced = db.session.execute(
+                db.update(EmailMessage).where(
+                    EmailMessage.dedupe_key == dedupe_key,
+                    EmailMessage.status == EmailMessage.STATUS_PENDING,
+                    db.or_(EmailMessage.claimed_until.is_(None), EmailMessage.claimed_until < now)
+                ).values(attempts=0, last_error=None, claimed_by=None, claimed_until=None, **values),
+                execution_options={'synchronize_session': False}
+            ).rowcount
+
+        if not replaced:
+            db.session.add(EmailMessage(dedupe_key=dedupe_key, created_at=now, **values))
+
+        db.session.info['outbox_wakeup'] = True
+        self._ensure_worker()
+
+    def process_batch(self):
+        """
+        Отправить один пакет писем, которые пора отправлять
+
+        Returns:
+            количество обработанных писем
+        """
+        messages = self._claim()
+
+        for message in messages:
+            try:
+                self._send(message)
+            except Exception as e:
+                self._failed(message, e)
+            else:
+                message.status = EmailMessage.STATUS_SENT
+                message.sent_at = datetime.utcnow()
+                message.last_error = None
+            message.claimed_by = None
+            message.claimed_until = None
+            # Статус фиксируется сразу: при падении посреди пакета
+            # отправленные письма не уйдут повторно
+            db.session.commit()
+
+        return len(messages)
+
+    def drain(self):
+        """
+        Отправить все письма, которые пора отправлять
+
+        Returns:
+            количество обработанных писем
+        """
+        total = 0
+        while True:
+            processed = self.process_batch()
+            total += processed
+            if processed < self.batch_size:
+                return total
+
+    def close(self):
+        """Закрыть SMTP-соединение"""
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+
+    def run(self):
+        """Цикл обработчика: отправка очереди и ожидание новых писем"""
+        while True:
+            try:
+                with self.app.app_context():
+                    self.drain()
+            except Exception as e:
+                self.app.logger.error(f'Error sending queued email: {e}')
+                self.close()
+
+            if self._connection is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                self.close()
+
+            self._wait()
+
+    def _wait(self):
+        """
+        Ждать новых писем до EMAIL_POLL_INTERVAL секунд
+
+        Ожидание короткими socketio.sleep, а не threading.Event: так
+        гринлет обработчика не блокирует hub, даже если eventlet
+        работает без monkey patching (flask run, скрипты).
+        """
+        deadline = time.monotonic() + self.poll_interval
+        while not self._wakeup and time.monotonic() < deadline:
+            socketio.sleep(WAKEUP_CHECK_INTERVAL)
+        self._wakeup = False
+
+    def _claim(self):
+        """Захватить пакет писем арендой на EMAIL_CLAIM_TIMEOUT секунд"""
+        now = datetime.utcnow()
+        token = secrets.token_hex(16)
+
+        due = db.select(EmailMessage.id).where(
+            EmailMessage.status == EmailMessage.STATUS_PENDING,
+            EmailMessage.next_attempt_at <= now,
+            db.or_(EmailMessage.claimed_until.is_(None), EmailMessage.claimed_until < now)
+        ).order_by(EmailMessage.next_attempt_at, EmailMessage.id).limit(self.batch_size)
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # Конкурирующие обработчики пропускают чужие строки, а не ждут их
+            due = due.with_for_update(skip_locked=True)
+
+        db.session.execute(
+            db.update(EmailMessage).where(EmailMessage.id.in_(due.scalar_subquery())).values(
+                claimed_by=token,
+                claimed_until=now + timedelta(seconds=self.claim_timeout)
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.commit()
+
+        return EmailMessage.query.filter_by(claimed_by=token).order_by(EmailMessage.id).all()
+
+    def _send(self, message):
+        """Отправить письмо через постоянное соединение"""
+        msg = Message(message.subject,
+                      sender=self.app.config['MAIL_DEFAULT_SENDER'],
+                      recipients=[message.recipient])
+        msg.body = message.text_body
+        if message.html_body:
+            msg.html = message.html_body
+
+        self._throttle()
+
+        reused = self._connection is not None
+        try:
+            self._connect().send(msg)
+        except Exception as e:
+            if not (reused and _connection_lost(e)):
+                raise
+            # Сервер закрыл простаивавшее соединение: одна попытка
+            # с новым соединением, дальше ошибка уходит в повтор
+            self.close()
+            self._connect().send(msg)
+
+        self._last_used = time.monotonic()
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = mail.connect().__enter__()
+        return self._connection
+
+    def _throttle(self):
+        """Не отправлять быстрее EMAIL_RATE_LIMIT писем в секунду"""
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        if self._next_send > now:
+            socketio.sleep(self._next_send - now)
+        self._next_send = max(now, self._next_send) + 1.0 / self.rate_limit
+
+    def _failed(self, message, error):
+        """Запланировать повтор или пометить письмо как неотправляемое"""
+        if _connection_lost(error):
+            self.close()
+
+        message.attempts += 1
+        message.last_error = f'{type(error).__name__}: {error}'[:1000]
+
+        if _permanent(error) or message.attempts >= self.max_attempts:
+            message.status = EmailMessage.STATUS_FAILED
+            self.app.logger.error(f'Email {message.id} to {message.recipient} failed: {message.last_error}')
+        else:
+            delay = min(self.retry_delay * 2 ** (message.attempts - 1), MAX_RETRY_DELAY)
+            message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            self.app.logger.warning(f'Email {message.id} to {message.recipient} '
+                                    f'will be retried in {delay}s: {message.last_error}')
+
+    def _ensure_worker(self):
+        """Запустить обработчик при первом обращении"""
+        if self._worker_started or self.app is None or not self.run_worker:
+            return
+
+        with self._worker_lock:
+            if not self._worker_started:
+                self._worker_started = True
+                socketio.start_background_task(self.run)
+
+
+def _connection_lost(error):
+    """Ошибка соединения (а не ответ сервера на конкретное письмо)"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    # SMTPException — подкласс OSError, но означает ответ сервера
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def _permanent(error):
+    """Постоянная ошибка 5xx (адрес не существует и т.п.): повтор не поможет"""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return False
+
+
+outbox = Outbox()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wakeup_worker(session):
+    """Разбудить обработчик, когда письмо записано в БД"""
+    if session.info.pop('outbox_wakeup', False):
+        outbox._wakeup = True
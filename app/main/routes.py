@@ -1,21 +1,30 @@
 """Главные маршруты приложения"""
 
-from flask import render_template
+from flask import render_template, request, jsonify, abort, current_app, Response
 from app.main import main_bp
-from app.models import Topic, User
+from app.models import Topic
 from app import db
+from app.page_cache import page_cache
+from app.site_stats import site_stats
+from app.database import pool_stats
+from app.metrics import metrics
+from sqlalchemy.orm import joinedload
 
 
 @main_bp.route('/')
+@page_cache.cached('topics')
 def index():
     """Главная страница"""
     # Последние топики
-    recent_topics = Topic.query.order_by(Topic.created_at.desc()).limit(5).all()
+    recent_topics = Topic.query.options(joinedload(Topic.author)).order_by(
+        Topic.created_at.desc()
+    ).limit(5).all()
     
-    # Статистика
+    # Статистика из материализованных счетчиков
+    counters = site_stats.get()
     stats = {
-        'total_users': User.query.count(),
-        'total_topics': Topic.query.count(),
+        'total_users': counters['users'],
+        'total_topics': counters['topics'],
     }
     
     return render_template('index.html', recent_topics=recent_topics, stats=stats)
@@ -26,3 +35,26 @@ def about():
     """Страница о проекте"""
     return render_template('about.html')
 
+
+
+def _check_metrics_token():
+    """Служебные метрики доступны только с токеном METRICS_TOKEN"""
+    token = current_app.config['METRICS_TOKEN']
+    if not token or request.headers.get('Authorization') != f'Bearer {token}':
+        abort(404)
+
+
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    """Метрики этого процесса в формате Prometheus"""
+    _check_metrics_token()
+    
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@main_bp.route('/metrics/db-pool')
+def db_pool_metrics():
+    """Состояние пула соединений с БД этого процесса"""
+    _check_metrics_token()
+    
+    return jsonify(pool_stats())
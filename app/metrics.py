@@ -0,0 +1,310 @@
+"""Метрики производительности и бюджеты SQL-запросов
+
+Для каждого HTTP-запроса (по endpoint) и каждого события Socket.IO
+собираются время обработки, число SQL-запросов и их суммарное время.
+Метрики процесса отдаются в формате Prometheus на ``GET /metrics``
+(заголовок ``Authorization: Bearer $METRICS_TOKEN``); при нескольких
+процессах опрашивается каждый из них.
+
+Бюджет запросов объявляется на маршруте декоратором::
+
+    @forum_bp.route('/')
+    @query_budget(4)
+    def index(): ...
+
+Превышение учитывается в forum_query_budget_exceeded_total и пишется в
+лог; при QUERY_BUDGETS_ENFORCE (по умолчанию в режиме TESTING) запрос
+завершается исключением QueryBudgetExceeded со списком выполненных
+запросов. Для проверки произвольного кода есть контекстный менеджер
+``assert_max_queries(n)``.
+"""
+
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_app_context, request, current_app
+from sqlalchemy import event
+from app import db
+
+# Границы гистограмм: время (сек) и число запросов
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Маршрут выполнил больше SQL-запросов, чем объявлено в бюджете"""
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    """Счетчик Prometheus с метками"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labels, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # метки -> [счетчики по границам, сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket',
+                                    _labels(self.labels + ('le',), key + (bound,)), bucket_count))
+                samples.append((f'{self.name}_bucket', _labels(self.labels + ('le',), key + ('+Inf',)), count))
+                samples.append((f'{self.name}_sum', _labels(self.labels, key), total))
+                samples.append((f'{self.name}_count', _labels(self.labels, key), count))
+        return samples
+
+
+class Gauge:
+    """Значение, вычисляемое при выдаче метрик (kind='counter' для накопительных)"""
+
+    def __init__(self, name, help, collect, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        value = self.collect()
+        return [] if value is None else [(self.name, '', value)]
+
+
+class Scope:
+    """SQL-запросы одного HTTP-запроса или события Socket.IO"""
+
+    def __init__(self, keep_statements=False):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.statements = [] if keep_statements else None
+
+
+def _pool_value(key):
+    from app.database import pool_stats
+    return pool_stats()[key]
+
+
+# Активные проверки assert_max_queries (видят запросы любого контекста)
+_watchers = []
+
+
+class Metrics:
+    """Сбор метрик запросов, событий Socket.IO и SQL"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.registry = []
+
+        self.http_duration = self._add(Histogram(
+            'forum_http_request_duration_seconds', 'Время обработки HTTP-запроса',
+            ('endpoint', 'method')))
+        self.http_requests = self._add(Counter(
+            'forum_http_requests_total', 'HTTP-запросы по статусу ответа',
+            ('endpoint', 'method', 'status')))
+        self.sql_queries = self._add(Histogram(
+            'forum_sql_queries', 'SQL-запросов на HTTP-запрос или событие Socket.IO',
+            ('endpoint',), QUERY_BUCKETS))
+        self.sql_duration = self._add(Histogram(
+            'forum_sql_duration_seconds', 'Суммарное время SQL на HTTP-запрос или событие Socket.IO',
+            ('endpoint',)))
+        self.socket_duration = self._add(Histogram(
+            'forum_socketio_event_duration_seconds', 'Время обработки события Socket.IO',
+            ('event',)))
+        self.budget_exceeded = self._add(Counter(
+            'forum_query_budget_exceeded_total', 'Превышения бюджета SQL-запросов маршрута',
+            ('endpoint',)))
+
+        for name, key, kind, help in (
+            ('forum_db_pool_size', 'size', 'gauge', 'Размер пула соединений с БД'),
+            ('forum_db_pool_in_use', 'in_use', 'gauge', 'Занятые соединения пула'),
+            ('forum_db_pool_overflow', 'overflow', 'gauge', 'Соединения сверх размера пула'),
+            ('forum_db_pool_checkouts_total', 'checkouts', 'counter', 'Выдачи соединений из пула'),
+            ('forum_db_pool_waits_total', 'waits', 'counter', 'Ожидания свободного соединения'),
+            ('forum_db_pool_wait_seconds_total', 'wait_seconds', 'counter', 'Суммарное ожидание соединения'),
+            ('forum_db_pool_timeouts_total', 'timeouts', 'counter', 'Таймауты ожидания соединения'),
+        ):
+            self._add(Gauge(name, help, functools.partial(_pool_value, key), kind))
+
+    def _add(self, metric):
+        self.registry.append(metric)
+        return metric
+
+    def init_app(self, app):
+        """Привязать сбор метрик к приложению (после db.init_app)"""
+        self.app = app
+        self.enabled = app.config['METRICS_ENABLED']
+        app.extensions['metrics'] = self
+
+        if not self.enabled:
+            return
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+        with app.app_context():
+            engines = list(db.engines.values())
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def enforce_budgets(self):
+        """Превышение бюджета — ошибка (по умолчанию в режиме TESTING)"""
+        enforce = current_app.config['QUERY_BUDGETS_ENFORCE']
+        return current_app.config['TESTING'] if enforce is None else enforce
+
+    def _start_request(self):
+        g._metrics_scope = Scope(keep_statements=self.enforce_budgets())
+        g._metrics_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        scope = g.pop('_metrics_scope', None)
+        if scope is None:
+            return response
+
+        endpoint = request.endpoint or 'unknown'
+        self.http_duration.observe(time.perf_counter() - g.pop('_metrics_started'), endpoint, request.method)
+        self.http_requests.inc(endpoint, request.method, str(response.status_code))
+        self.sql_queries.observe(scope.queries, endpoint)
+        self.sql_duration.observe(scope.sql_seconds, endpoint)
+
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', None)
+        if budget is not None and scope.queries > budget:
+            self.budget_exceeded.inc(endpoint)
+            message = f'{endpoint} executed {scope.queries} SQL statements, budget is {budget}'
+            if self.enforce_budgets():
+                raise QueryBudgetExceeded(message + ':\n' + '\n'.join(scope.statements))
+            current_app.logger.warning(message)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_started'].pop()
+        scopes = list(_watchers)
+        if has_app_context() and g.get('_metrics_scope') is not None:
+            scopes.append(g._metrics_scope)
+        for scope in scopes:
+            scope.queries += 1
+            scope.sql_seconds += seconds
+            if scope.statements is not None:
+                scope.statements.append(' '.join(statement.split()))
+
+    def socket_event(self, f):
+        """Декоратор обработчика Socket.IO: время события и его SQL"""
+        # Flask-SocketIO передает connect аргумент auth, если обработчик его принимает
+        arity = len(inspect.signature(f).parameters)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            args = args[:arity]
+            if not self.enabled:
+                return f(*args, **kwargs)
+
+            name = request.event['message'] if getattr(request, 'event', None) else f.__name__
+            previous = g.get('_metrics_scope')
+            scope = g._metrics_scope = Scope()
+            started = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.socket_duration.observe(time.perf_counter() - started, name)
+                self.sql_queries.observe(scope.queries, f'socketio:{name}')
+                self.sql_duration.observe(scope.sql_seconds, f'socketio:{name}')
+                g._metrics_scope = previous
+        return wrapper
+
+    def render(self):
+        """Метрики процесса в текстовом формате Prometheus"""
+        lines = []
+        for metric in self.registry:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def query_budget(max_queries):
+    """Объявить бюджет SQL-запросов маршрута"""
+    def decorator(f):
+        f.query_budget = max_queries
+        return f
+    return decorator
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    """
+    Проверка в тестах: код внутри блока выполняет не больше max_queries запросов
+
+    Пример::
+
+        with assert_max_queries(3):
+            client.get('/forum/')
+    """
+    scope = Scope(keep_statements=True)
+    _watchers.append(scope)
+    try:
+        yield scope
+    finally:
+        _watchers.remove(scope)
+    if scope.queries > max_queries:
+        raise QueryBudgetExceeded(
+            f'{scope.queries} SQL statements, expected at most {max_queries}:\n' + '\n'.join(scope.statements)
+        )
+
+
+metrics = Metrics()
@@ -2,14 +2,21 @@
 
 from datetime import datetime, timedelta
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import db, login_manager
+from app import db
+from app.images import image_url
+from app.passwords import hash_password, verify_password, needs_rehash
+from sqlalchemy.exc import IntegrityError
 import secrets
 
 
 class User(UserMixin, db.Model):
     """Модель пользователя"""
     __tablename__ = 'users'
+    __table_args__ = (
+        # Поиск собеседника по началу имени
+        db.Index('ix_users_username_lower', db.func.lower(db.text('username')).label('username_lower'),
+                 postgresql_ops={'username_lower': 'varchar_pattern_ops'}),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False, index=True)
@@ -23,8 +30,14 @@ class User(UserMixin, db.Model):
     verification_code = db.Column(db.String(6), nullable=True)
     verification_code_expires = db.Column(db.DateTime, nullable=True)
     
+    # Денормализованные счетчики для профиля (см. change_counters)
+    topic_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     # Relationships
-    topics = db.relationship('Topic', backref='author', lazy='dynamic', cascade='all, delete-orphan')
+    topics = db.relationship('Topic', foreign_keys='Topic.author_id', backref='author',
+                             lazy='dynamic', cascade='all, delete-orphan')
     posts = db.relationship('Post', backref='author', lazy='dynamic', cascade='all, delete-orphan')
     sent_messages = db.relationship('ChatMessage', foreign_keys='ChatMessage.sender_id',
                                    backref='sender', lazy='dynamic', cascade='all, delete-orphan')
@@ -33,11 +46,22 @@ class User(UserMixin, db.Model):
     
     def set_password(self, password):
         """Установить хеш пароля"""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        """Проверить пароль"""
-        return check_password_hash(self.password_hash, password)
+        """
+        Проверить пароль
+        
+        Если хеш создан со старыми параметрами (PASSWORD_HASH_METHOD),
+        он пересчитывается с текущими; сохранить изменение должен
+        вызывающий код (commit).
+        """
+        if not verify_password(self.password_hash, password):
+            return False
+        
+        if needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     def generate_verification_code(self):
         """Сгенерировать код подтверждения (6 цифр)"""
@@ -63,19 +87,62 @@ class User(UserMixin, db.Model):
         
         return False
     
+    @classmethod
+    def change_counters(cls, user_id, **deltas):
+        """
+        Изменить счетчики пользователя в текущей транзакции
+        
+        Счетчики меняются выражением SQL (``post_count = post_count + 1``),
+        поэтому параллельные записи не теряются.
+        
+        Args:
+            user_id: id пользователя
+            deltas: столбец счетчика -> изменение (topic_count=1, post_count=-1)
+        """
+        values = {
+            name: db.case((getattr(cls, name) + delta > 0, getattr(cls, name) + delta), else_=0)
+            for name, delta in deltas.items()
+        }
+        db.session.execute(db.update(cls).where(cls.id == user_id).values(**values))
+    
+    @classmethod
+    def reconcile_counters(cls, user_ids=None):
+        """
+        Пересчитать счетчики пользователей по таблицам топиков, постов и сообщений
+        
+        Args:
+            user_ids: список id пользователей или None для всех
+        
+        Returns:
+            количество обновленных пользователей
+        """
+        def count_of(model, column):
+            return db.select(db.func.count(model.id)).where(column == cls.id).scalar_subquery()
+        
+        stmt = db.update(cls).values(
+            topic_count=count_of(Topic, Topic.author_id),
+            post_count=count_of(Post, Post.author_id),
+            message_count=count_of(ChatMessage, ChatMessage.sender_id),
+        )
+        
+        if user_ids is not None:
+            stmt = stmt.where(cls.id.in_(user_ids))
+        
+        result = db.session.execute(stmt)
+        return result.rowcount
+    
     def __repr__(self):
         return f'<User {self.username}>'
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    """Загрузить пользователя по ID для Flask-Login"""
-    return User.query.get(int(user_id))
-
-
 class Topic(db.Model):
     """Модель топика форума"""
     __tablename__ = 'topics'
+    __table_args__ = (
+        # Список топиков (keyset по updated_at, id) и топики в профиле
+        db.Index('ix_topics_updated_at_id', 'updated_at', 'id'),
+        db.Index('ix_topics_author_id_created_at', 'author_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
@@ -85,22 +152,125 @@ class Topic(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     views = db.Column(db.Integer, default=0)
     
+    # Денормализованные счетчики (обновляются в post_create / post_delete)
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_post_id = db.Column(db.Integer, nullable=True)
+    last_post_at = db.Column(db.DateTime, nullable=True)
+    last_poster_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    
     # Relationships
     posts = db.relationship('Post', backref='topic', lazy='dynamic', cascade='all, delete-orphan',
                           order_by='Post.created_at')
+    last_poster = db.relationship('User', foreign_keys=[last_poster_id])
     
     def __repr__(self):
         return f'<Topic {self.title}>'
     
-    @property
-    def post_count(self):
-        """Количество постов в топике"""
-        return self.posts.count()
+    def to_dict(self):
+        """Преобразовать топик в словарь для JSON"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+            'author_id': self.author_id,
+            'author_username': self.author.username,
+            'views': self.views,
+            'post_count': self.post_count,
+            'last_post_at': self.last_post_at.isoformat() if self.last_post_at else None,
+            'last_poster_id': self.last_poster_id
+        }
+    
+    def register_post(self, post):
+        """
+        Учесть новый пост в счетчиках топика
+        
+        Вызывается после flush, чтобы у поста уже был id. Счетчик
+        увеличивается выражением SQL, поэтому параллельные ответы не теряются.
+        """
+        self.post_count = Topic.post_count + 1
+        self.last_post_id = post.id
+        self.last_post_at = post.created_at
+        self.last_poster_id = post.author_id
+        self.updated_at = post.created_at
+    
+    def unregister_post(self, post):
+        """
+        Убрать удаляемый пост из счетчиков топика
+        
+        Если удаляется последний пост, ссылка на последний ответ
+        пересчитывается одним индексированным запросом. Время обновления
+        топика при этом не меняется.
+        """
+        values = {
+            'post_count': db.case((Topic.post_count > 0, Topic.post_count - 1), else_=0),
+            'updated_at': Topic.updated_at,
+        }
+        
+        if self.last_post_id == post.id:
+            last_post = Post.query.filter(
+                Post.topic_id == self.id,
+                Post.id != post.id
+            ).order_by(Post.created_at.desc(), Post.id.desc()).first()
+            
+            values['last_post_id'] = last_post.id if last_post else None
+            values['last_post_at'] = last_post.created_at if last_post else None
+            values['last_poster_id'] = last_post.author_id if last_post else None
+        
+        db.session.execute(
+            db.update(Topic).where(Topic.id == self.id).values(**values)
+        )
+    
+    @classmethod
+    def reconcile_counters(cls, topic_ids=None):
+        """
+        Пересчитать счетчики топиков по таблице постов
+        
+        Args:
+            topic_ids: список id топиков или None для всех топиков
+        
+        Returns:
+            количество обновленных топиков
+        """
+        posts = Post.__table__
+        
+        count_sq = db.select(db.func.count(posts.c.id)).where(
+            posts.c.topic_id == cls.id
+        ).scalar_subquery()
+        
+        last_sq = db.select(posts.c.id).where(
+            posts.c.topic_id == cls.id
+        ).order_by(posts.c.created_at.desc(), posts.c.id.desc()).limit(1).scalar_subquery()
+        
+        last_post = db.aliased(Post)
+        
+        stmt = db.update(cls).values(
+            post_count=count_sq,
+            last_post_id=last_sq,
+            last_post_at=db.select(last_post.created_at).where(
+                last_post.id == last_sq
+            ).scalar_subquery(),
+            last_poster_id=db.select(last_post.author_id).where(
+                last_post.id == last_sq
+            ).scalar_subquery(),
+            updated_at=cls.updated_at,
+        )
+        
+        if topic_ids is not None:
+            stmt = stmt.where(cls.id.in_(topic_ids))
+        
+        result = db.session.execute(stmt)
+        return result.rowcount
 
 
 class Post(db.Model):
     """Модель поста (сообщения в топике)"""
     __tablename__ = 'posts'
+    __table_args__ = (
+        # Посты топика (keyset по created_at, id) и посты в профиле
+        db.Index('ix_posts_topic_id_created_at_id', 'topic_id', 'created_at', 'id'),
+        db.Index('ix_posts_author_id_created_at', 'author_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -112,11 +282,32 @@ class Post(db.Model):
     
     def __repr__(self):
         return f'<Post {self.id} in Topic {self.topic_id}>'
+    
+    def to_dict(self):
+        """Преобразовать пост в словарь для JSON"""
+        return {
+            'id': self.id,
+            'content': self.content,
+            'image': self.image,
+            'created_at': self.created_at.isoformat(),
+            'author_id': self.author_id,
+            'author_username': self.author.username,
+            'author_avatar': self.author.avatar,
+            'topic_id': self.topic_id
+        }
 
 
 class ChatMessage(db.Model):
     """Модель сообщения в чате"""
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        # Окна переписки: каждая ветка OR идет по своему диапазону индекса
+        db.Index('ix_chat_messages_sender_recipient_id', 'sender_id', 'recipient_id', 'id'),
+        # Только непрочитанные: счетчик и отметка о прочтении
+        db.Index('ix_chat_messages_unread', 'recipient_id', 'sender_id',
+                 postgresql_where=db.text('is_read = false'),
+                 sqlite_where=db.text('is_read = 0')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -129,17 +320,334 @@ class ChatMessage(db.Model):
     def __repr__(self):
         return f'<ChatMessage from {self.sender_id} to {self.recipient_id}>'
     
-    def to_dict(self):
-        """Преобразовать сообщение в словарь для JSON"""
+    def to_dict(self, sender=None):
+        """
+        Преобразовать сообщение в словарь для JSON
+        
+        sender — уже известный отправитель (например current_user): с ним
+        связь sender не загружается отдельным запросом.
+        """
+        if sender is None:
+            sender = self.sender
         return {
             'id': self.id,
             'content': self.content,
             'image': self.image,
+            'image_url': image_url('chat', self.image) if self.image else None,
             'created_at': self.created_at.isoformat(),
             'is_read': self.is_read,
             'sender_id': self.sender_id,
-            'sender_username': self.sender.username,
-            'sender_avatar': self.sender.avatar,
+            'sender_username': sender.username,
+            'sender_avatar': sender.avatar,
             'recipient_id': self.recipient_id
         }
 
+
+
+class Conversation(db.Model):
+    """
+    Сводка переписки двух пользователей для списка чатов
+    
+    Одна строка на пару (user_low_id < user_high_id). Хранит последнее
+    сообщение и счетчики непрочитанных для каждой стороны.
+    """
+    __tablename__ = 'conversations'
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversations_pair'),
+        db.Index('ix_conversations_low_last_message_at', 'user_low_id', 'last_message_at'),
+        db.Index('ix_conversations_high_last_message_at', 'user_high_id', 'last_message_at'),
+    )
+    
+    PREVIEW_LENGTH = 100
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_preview = db.Column(db.String(PREVIEW_LENGTH), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    unread_low = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_high = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Водяной знак прочтения: id последнего прочитанного сообщения каждой стороной
+    read_up_to_low = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    read_up_to_high = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    # Relationships
+    user_low = db.relationship('User', foreign_keys=[user_low_id])
+    user_high = db.relationship('User', foreign_keys=[user_high_id])
+    
+    def __repr__(self):
+        return f'<Conversation {self.user_low_id}-{self.user_high_id}>'
+    
+    @staticmethod
+    def pair(user_id, other_id):
+        """Упорядоченная пара id пользователей"""
+        return min(user_id, other_id), max(user_id, other_id)
+    
+    @classmethod
+    def for_users(cls, user_id, other_id):
+        """Найти переписку двух пользователей"""
+        low, high = cls.pair(user_id, other_id)
+        return cls.query.filter_by(user_low_id=low, user_high_id=high).first()
+    
+    @classmethod
+    def get_or_create(cls, user_id, other_id):
+        """Найти или создать переписку (устойчиво к параллельному созданию)"""
+        conversation = cls.for_users(user_id, other_id)
+        if conversation:
+            return conversation
+        
+        low, high = cls.pair(user_id, other_id)
+        try:
+            with db.session.begin_nested():
+                conversation = cls(user_low_id=low, user_high_id=high)
+                db.session.add(conversation)
+        except IntegrityError:
+            conversation = cls.for_users(user_id, other_id)
+        
+        return conversation
+    
+    @classmethod
+    def _recent(cls, user_id, limit):
+        """
+        Последние переписки пользователя: (id, last_message_at)
+
+        Пользователь может быть любой из сторон пары. Вместо OR по двум
+        столбцам (сканирование всех переписок и сортировка) — две
+        упорядоченные выборки по индексам ix_conversations_low/high_last_message_at
+        не длиннее limit, объединенные UNION ALL.
+        """
+        sides = [
+            db.select(cls.id, cls.last_message_at).where(column == user_id)
+            .order_by(cls.last_message_at.desc()).limit(limit).subquery()
+            for column in (cls.user_low_id, cls.user_high_id)
+        ]
+        return db.union_all(*(db.select(side) for side in sides)).subquery('recent')
+
+    @classmethod
+    def inbox_query(cls, user_id, limit):
+        """Не более limit переписок пользователя, последние сверху"""
+        recent = cls._recent(user_id, limit)
+        return cls.query.options(
+            db.joinedload(cls.user_low),
+            db.joinedload(cls.user_high)
+        ).join(recent, recent.c.id == cls.id).order_by(recent.c.last_message_at.desc()).limit(limit)
+    
+    @classmethod
+    def partner_ids(cls, user_id, limit):
+        """id собеседников пользователя (не более limit), недавние сверху"""
+        recent = cls._recent(user_id, limit)
+        partner = db.case((cls.user_low_id == user_id, cls.user_high_id), else_=cls.user_low_id)
+        query = db.select(partner).join(recent, recent.c.id == cls.id).order_by(
+            recent.c.last_message_at.desc()
+        ).limit(limit)
+        return db.session.scalars(query).all()
+    
+    def partner_of(self, user_id):
+        """Собеседник пользователя в этой переписке"""
+        return self.user_high if user_id == self.user_low_id else self.user_low
+    
+    def unread_for(self, user_id):
+        """Количество непрочитанных сообщений для пользователя"""
+        return self.unread_low if user_id == self.user_low_id else self.unread_high
+    
+    def register_message(self, message):
+        """Учесть новое сообщение: последнее сообщение и непрочитанные получателя"""
+        self.set_last_message(message)
+        self.add_unread(message.recipient_id, 1)
+    
+    def set_last_message(self, message):
+        """
+        Запомнить последнее сообщение переписки
+
+        Для сохраненной переписки — условный UPDATE: пакеты отложенной
+        записи из разных процессов приходят в произвольном порядке, и
+        более старое сообщение не должно заменить более новое.
+        """
+        values = {
+            'last_message_id': message.id,
+            'last_message_preview': message.content[:self.PREVIEW_LENGTH],
+            'last_message_at': message.created_at,
+            'last_sender_id': message.sender_id,
+        }
+        if not db.inspect(self).persistent:
+            for name, value in values.items():
+                setattr(self, name, value)
+            return
+
+        # В одном UPDATE все выражения видят старое last_message_id
+        newer = db.or_(Conversation.last_message_id.is_(None), Conversation.last_message_id < message.id)
+        for name, value in values.items():
+            setattr(self, name, db.case((newer, value), else_=getattr(Conversation, name)))
+    
+    def add_unread(self, user_id, count):
+        """Увеличить счетчик непрочитанных пользователя одним UPDATE"""
+        if user_id == self.user_low_id:
+            self.unread_low = Conversation.unread_low + count
+        else:
+            self.unread_high = Conversation.unread_high + count
+    
+    def read_up_to(self, user_id):
+        """id последнего сообщения, прочитанного пользователем"""
+        return self.read_up_to_low if user_id == self.user_low_id else self.read_up_to_high
+    
+    def mark_read(self, user_id, up_to_id=None, count=None):
+        """
+        Сдвинуть водяной знак прочтения пользователя
+        
+        Args:
+            user_id: кто прочитал
+            up_to_id: до какого сообщения включительно (None — до последнего)
+            count: сколько сообщений отмечено (для частичного прочтения)
+        """
+        last_id = self.last_message_id or 0
+        watermark = last_id if up_to_id is None else min(up_to_id, last_id)
+        watermark = max(watermark, self.read_up_to(user_id))
+        
+        if watermark >= last_id:
+            unread = 0
+        else:
+            column = Conversation.unread_low if user_id == self.user_low_id else Conversation.unread_high
+            unread = db.case((column > (count or 0), column - (count or 0)), else_=0)
+        
+        if user_id == self.user_low_id:
+            self.read_up_to_low = watermark
+            self.unread_low = unread
+        else:
+            self.read_up_to_high = watermark
+            self.unread_high = unread
+    
+    @classmethod
+    def rebuild(cls):
+        """
+        Пересоздать сводки переписок по таблице сообщений
+        
+        Returns:
+            количество переписок
+        """
+        low = db.case((ChatMessage.sender_id < ChatMessage.recipient_id, ChatMessage.sender_id),
+                      else_=ChatMessage.recipient_id)
+        high = db.case((ChatMessage.sender_id < ChatMessage.recipient_id, ChatMessage.recipient_id),
+                       else_=ChatMessage.sender_id)
+        
+        pairs = db.session.query(
+            low.label('low'),
+            high.label('high'),
+            db.func.max(ChatMessage.id).label('last_id'),
+            db.func.sum(db.case(
+                (db.and_(ChatMessage.recipient_id == low, ChatMessage.is_read.is_(False)), 1),
+                else_=0
+            )).label('unread_low'),
+            db.func.sum(db.case(
+                (db.and_(ChatMessage.recipient_id == high, ChatMessage.is_read.is_(False)), 1),
+                else_=0
+            )).label('unread_high'),
+            db.func.max(db.case(
+                (db.and_(ChatMessage.recipient_id == low, ChatMessage.is_read.is_(True)), ChatMessage.id),
+                else_=0
+            )).label('read_up_to_low'),
+            db.func.max(db.case(
+                (db.and_(ChatMessage.recipient_id == high, ChatMessage.is_read.is_(True)), ChatMessage.id),
+                else_=0
+            )).label('read_up_to_high')
+        ).group_by(low, high).all()
+        
+        cls.query.delete(synchronize_session='fetch')
+        
+        last_messages = {
+            m.id: m for m in ChatMessage.query.filter(
+                ChatMessage.id.in_([p.last_id for p in pairs])
+            )
+        } if pairs else {}
+        
+        for p in pairs:
+            message = last_messages[p.last_id]
+            db.session.add(cls(
+                user_low_id=p.low,
+                user_high_id=p.high,
+                last_message_id=message.id,
+                last_message_preview=message.content[:cls.PREVIEW_LENGTH],
+                last_message_at=message.created_at,
+                last_sender_id=message.sender_id,
+                unread_low=p.unread_low or 0,
+                unread_high=p.unread_high or 0,
+                read_up_to_low=p.read_up_to_low or 0,
+                read_up_to_high=p.read_up_to_high or 0
+            ))
+        
+        return len(pairs)
+
+
+class SiteStat(db.Model):
+    """
+    Материализованный глобальный счетчик сайта (см. app.site_stats)
+    
+    Значение меняется на каждую запись и периодически пересчитывается по БД.
+    """
+    __tablename__ = 'site_stats'
+    
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<SiteStat {self.name}={self.value}>'
+
+
+
+class ImportProgress(db.Model):
+    """
+    Позиция импорта файла дампа (см. app.importer)
+    
+    Обновляется в транзакции каждой загруженной пачки, поэтому после
+    прерывания импорт продолжается ровно с первой незагруженной строки.
+    """
+    __tablename__ = 'import_progress'
+    
+    source = db.Column(db.String(255), primary_key=True)
+    rows = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ImportProgress {self.source} {self.rows}>'
+
+
+class EmailMessage(db.Model):
+    """
+    Письмо в очереди отправки (см. app.mailer)
+    
+    Запись создается в транзакции запроса, а отправляет ее фоновый
+    обработчик. Обработчик захватывает письма на время claimed_until,
+    поэтому несколько процессов не отправят одно письмо дважды.
+    """
+    __tablename__ = 'email_outbox'
+    
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    text_body = db.Column(db.Text, nullable=False)
+    html_body = db.Column(db.Text, nullable=True)
+    # Письма с одним ключом заменяют друг друга, пока не отправлены
+    dedupe_key = db.Column(db.String(64), nullable=True, index=True)
+    status = db.Column(db.String(10), nullable=False, default=STATUS_PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    claimed_until = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Выборка писем, которые пора отправить
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<EmailMessage {self.id} {self.recipient} {self.status}>'
@@ -0,0 +1,208 @@
+"""Кэш страниц для анонимных читателей
+
+Готовый HTML главной, списка топиков и страницы топика хранится в двух
+уровнях: локальный LRU процесса перед общим бэкендом кэша (app.cache).
+Ключ страницы строится из маршрута, пути с параметрами (курсор страницы),
+состояния авторизации и версий тегов страницы:
+
+    page:<endpoint>:<хэш пути>:anon:<версии тегов>
+
+Инвалидация — смена версии тега (``invalidate('topics', 'topic:1')``),
+поэтому старые записи просто перестают находиться, в том числе в
+локальных LRU других процессов. Версия тега — время последнего
+изменения, она же отдается в Last-Modified.
+
+Запись свежая PAGE_CACHE_TTL секунд, затем еще PAGE_CACHE_STALE секунд
+отдается устаревшей, пока один фоновый пересчет (stale-while-revalidate)
+готовит новую. Ответы содержат ETag и Last-Modified, условные запросы
+получают 304.
+
+Авторизованные пользователи, запросы с flash-сообщениями и ответы
+со статусом, отличным от 200, не кэшируются.
+
+Страница, прочитанная с реплики (app.replicas) раньше чем через
+DB_REPLICA_MAX_LAG секунд после последней смены версии ее тегов, не
+сохраняется: реплика могла еще не получить изменение, из-за которого
+сменилась версия, и устаревший HTML попал бы в кэш под новой версией до
+следующей инвалидации.
+"""
+
+import hashlib
+import time
+from functools import wraps
+from flask import g, request, session, current_app, make_response
+from flask_login import current_user
+from app import socketio
+from app.cache import cache, LocalCacheBackend
+
+
+class PageCache:
+    """Кэш готовых ответов с инвалидацией по тегам"""
+
+    def __init__(self):
+        self.enabled = False
+        self.ttl = 30
+        self.stale = 300
+        self.local = None
+
+    def init_app(self, app):
+        """Привязать кэш к приложению"""
+        self.enabled = app.config['PAGE_CACHE_ENABLED']
+        self.ttl = app.config['PAGE_CACHE_TTL']
+        self.stale = app.config['PAGE_CACHE_STALE']
+
+        # При локальном общем кэше второй уровень в процессе не нужен
+        if app.config['CACHE_BACKEND'] != 'local':
+            self.local = LocalCacheBackend(app.config['PAGE_CACHE_LOCAL_ENTRIES'])
+
+        app.extensions['page_cache'] = self
+
+    def invalidate(self, *tags):
+        """Сбросить все страницы с указанными тегами"""
+        now = time.time()
+        for tag in tags:
+            cache.set(f'page_tag:{tag}', now)
+
+    def cached(self, *tags):
+        """Декоратор представления со статическим набором тегов"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.response(lambda: view(*args, **kwargs), *tags)
+            return wrapper
+        return decorator
+
+    def response(self, render, *tags):
+        """
+        Ответ из кэша или результат render()
+
+        Args:
+            render: функция без аргументов, возвращающая ответ представления
+            tags: теги, при инвалидации которых страница пересчитывается
+
+        Returns:
+            Response
+        """
+        if not self._cacheable_request():
+            return make_response(render())
+
+        key, last_modified = self._key(tags)
+        entry = self._get(key)
+
+        if entry is None:
+            response = make_response(render())
+            entry = self._store(key, response, last_modified)
+            if entry is None:
+                return response
+            status = 'MISS'
+        elif time.time() - entry['created'] > self.ttl:
+            self._refresh(render, tags)
+            status = 'STALE'
+        else:
+            status = 'HIT'
+
+        return self._build_response(entry, status)
+
+    def _cacheable_request(self):
+        return (
+            self.enabled
+            and request.method == 'GET'
+            and not current_user.is_authenticated
+            and '_flashes' not in session
+        )
+
+    def _tag_versions(self, tags):
+        versions = []
+        for tag in tags:
+            version = cache.get(f'page_tag:{tag}')
+            if version is None:
+                # Тег еще не инвалидировался (или вытеснен) — начинаем отсчет
+                version = time.time()
+                if not cache.add(f'page_tag:{tag}', version):
+                    version = cache.get(f'page_tag:{tag}') or version
+            versions.append(version)
+        return versions
+
+    def _key(self, tags):
+        """Ключ страницы и время последнего изменения ее тегов"""
+        versions = self._tag_versions(tags)
+        path_hash = hashlib.sha1(request.full_path.encode()).hexdigest()[:16]
+        version_part = '-'.join(f'{v:.6f}' for v in versions)
+        key = f'page:{request.endpoint}:{path_hash}:anon:{version_part}'
+        return key, max(versions, default=time.time())
+
+    def _get(self, key):
+        entry = self.local.get(key) if self.local else None
+
+        if entry is None or time.time() - entry['created'] > self.ttl:
+            # Свежая версия могла появиться в общем кэше из другого процесса
+            shared = cache.get(key)
+            if shared is not None:
+                entry = shared
+                if self.local:
+                    self.local.set(key, entry, self.ttl + self.stale)
+
+        return entry
+
+    def _store(self, key, response, last_modified):
+        """Сохранить ответ, если его можно кэшировать"""
+        if response.status_code != 200 or response.direct_passthrough or session.modified:
+            return None
+        if self._maybe_stale_replica(last_modified):
+            return None
+
+        body = response.get_data(as_text=True)
+        entry = {
+            'body': body,
+            'mimetype': response.mimetype,
+            'etag': hashlib.sha1(body.encode()).hexdigest(),
+            'last_modified': last_modified,
+            'created': time.time(),
+        }
+
+        cache.set(key, entry, self.ttl + self.stale)
+        if self.local:
+            self.local.set(key, entry, self.ttl + self.stale)
+        return entry
+
+    def _maybe_stale_replica(self, last_modified):
+        """Прочитана ли страница с реплики, которая может не видеть последнее изменение"""
+        if not g.get('_db_replica'):
+            return False
+        from app.replicas import replicas
+        return time.time() - last_modified < replicas.max_lag
+
+    def _refresh(self, render, tags):
+        """Пересчитать устаревшую страницу в фоне (один пересчет на ключ)"""
+        lock_key = f'page_lock:{request.endpoint}:{request.full_path}'
+        if not cache.add(lock_key, 1, self.ttl):
+            return
+
+        app = current_app._get_current_object()
+        path = request.full_path
+        base_url = request.host_url
+
+        def refresh():
+            try:
+                # Чистый контекст без cookie: страница рендерится для анонима
+                with app.test_request_context(path, base_url=base_url):
+                    key, last_modified = self._key(tags)
+                    self._store(key, make_response(render()), last_modified)
+            except Exception as e:
+                app.logger.error(f'Error refreshing cached page {path}: {e}')
+            finally:
+                cache.delete(lock_key)
+
+        socketio.start_background_task(refresh)
+
+    def _build_response(self, entry, status):
+        response = current_app.response_class(entry['body'], mimetype=entry['mimetype'])
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['last_modified']
+        response.headers['Cache-Control'] = f'public, max-age=0, stale-while-revalidate={self.stale}'
+        response.vary.add('Cookie')
+        response.headers['X-Cache'] = status
+        return response.make_conditional(request)
+
+
+page_cache = PageCache()
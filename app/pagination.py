@@ -0,0 +1,162 @@
+"""Курсорная (keyset) пагинация
+
+Вместо OFFSET страница выбирается условием по ключу сортировки
+``(col1, col2) > (:v1, :v2)``, поэтому любая страница стоит столько же,
+сколько первая (при наличии составного индекса по ключу).
+"""
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_, text
+from app import db
+
+
+def encode_cursor(values):
+    """Закодировать значения ключа в непрозрачный токен"""
+    data = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(data, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, keys):
+    """
+    Раскодировать токен курсора
+
+    Returns:
+        список значений ключа или None, если токен некорректен
+    """
+    if not token:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(raw)
+        if not isinstance(data, list) or len(data) != len(keys):
+            return None
+
+        values = []
+        for key, value in zip(keys, data):
+            python_type = key.type.python_type
+            if python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif python_type is float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            elif not isinstance(value, python_type) or isinstance(value, bool) is not (python_type is bool):
+                # Подмененный токен не должен попасть в SQL как значение другого типа
+                return None
+            values.append(value)
+        return values
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def approximate_count(model):
+    """
+    Приблизительное количество строк таблицы
+
+    На PostgreSQL берется оценка планировщика из pg_class.reltuples
+    (без полного сканирования), на остальных СУБД — точный COUNT(*).
+    """
+    if db.engine.dialect.name == 'postgresql':
+        estimate = db.session.execute(
+            text('SELECT reltuples::bigint FROM pg_class WHERE relname = :table'),
+            {'table': model.__tablename__}
+        ).scalar()
+        if estimate is not None and estimate >= 0:
+            return estimate
+
+    return db.session.query(db.func.count()).select_from(model).scalar()
+
+
+class KeysetPagination:
+    """Страница результатов курсорной пагинации"""
+
+    def __init__(self, items, keys, per_page, has_next, has_prev, total=None):
+        self.items = items
+        self.keys = keys
+        self.per_page = per_page
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.total = total
+
+    def _cursor_for(self, item):
+        return encode_cursor([getattr(item, key.key) for key in self.keys])
+
+    @property
+    def next_cursor(self):
+        """Токен следующей страницы"""
+        if not self.has_next or not self.items:
+            return None
+        return self._cursor_for(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        """Токен предыдущей страницы"""
+        if not self.has_prev or not self.items:
+            return None
+        return self._cursor_for(self.items[0])
+
+    def to_dict(self, serialize):
+        """Преобразовать страницу в словарь для JSON"""
+        return {
+            'items': [serialize(item) for item in self.items],
+            'next_cursor': self.next_cursor,
+            'prev_cursor': self.prev_cursor,
+            'has_next': self.has_next,
+            'has_prev': self.has_prev,
+            'total': self.total
+        }
+
+
+def keyset_paginate(query, keys, per_page, after=None, before=None, last=False,
+                    descending=False, total=None):
+    """
+    Выбрать страницу запроса по курсору
+
+    Args:
+        query: запрос без order_by
+        keys: столбцы ключа сортировки, последний должен быть уникальным (id)
+        per_page: размер страницы
+        after: токен — страница после указанной позиции
+        before: токен — страница перед указанной позицией
+        last: выбрать последнюю страницу (если курсоры не заданы)
+        descending: сортировка по убыванию ключа
+        total: общее количество (точное или приблизительное), если известно
+
+    Returns:
+        KeysetPagination
+    """
+    after_values = decode_cursor(after, keys)
+    before_values = decode_cursor(before, keys) if after_values is None else None
+
+    key_tuple = tuple_(*keys)
+    forward = [key.desc() if descending else key.asc() for key in keys]
+    backward = [key.asc() if descending else key.desc() for key in keys]
+
+    if before_values is not None or (last and after_values is None):
+        # Идем назад: выбираем в обратном порядке и разворачиваем
+        if before_values is not None:
+            bound = tuple_(*before_values)
+            query = query.filter(key_tuple < bound if not descending else key_tuple > bound)
+
+        rows = query.order_by(*backward).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page]
+        items.reverse()
+
+        return KeysetPagination(items, keys, per_page,
+                                has_next=before_values is not None,
+                                has_prev=has_prev,
+                                total=total)
+
+    if after_values is not None:
+        bound = tuple_(*after_values)
+        query = query.filter(key_tuple > bound if not descending else key_tuple < bound)
+
+    rows = query.order_by(*forward).limit(per_page + 1).all()
+
+    return KeysetPagination(rows[:per_page], keys, per_page,
+                            has_next=len(rows) > per_page,
+                            has_prev=after_values is not None,
+                            total=total)
@@ -0,0 +1,65 @@
+"""Хеширование паролей вне eventlet hub
+
+scrypt/PBKDF2 — намеренно медленные вычисления (десятки-сотни мс CPU).
+В процессе gunicorn с eventlet синхронный вызов останавливает все
+гринлеты, включая WebSocket чата, на время каждого входа. Поэтому под
+eventlet хеш считается в пуле нативных потоков (eventlet.tpool): hashlib
+отпускает GIL, и hub продолжает обслуживать остальные соединения.
+Размер пула (PASSWORD_HASH_THREADS) ограничивает число одновременных
+вычислений, то есть нагрузку на CPU во время волны входов.
+
+Алгоритм и стоимость задаются PASSWORD_HASH_METHOD в формате Werkzeug
+(``scrypt:32768:8:1``, ``pbkdf2:sha256:600000``). Хеш со старыми
+параметрами пересчитывается при следующем успешном входе
+(см. User.check_password).
+"""
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+_method = 'scrypt:32768:8:1'
+_offload = False
+
+
+def init_app(app):
+    """Настроить алгоритм и пул потоков для хеширования"""
+    global _method, _offload
+
+    # Каноническая запись параметров (как она попадает в начало хеша):
+    # 'pbkdf2:sha256' превращается в 'pbkdf2:sha256:600000'
+    _method = generate_password_hash('', app.config['PASSWORD_HASH_METHOD']).split('$', 1)[0]
+
+    _offload = app.config['PASSWORD_HASH_OFFLOAD'] and _eventlet_patched()
+    if _offload:
+        from eventlet import tpool
+        tpool.set_num_threads(app.config['PASSWORD_HASH_THREADS'])
+
+
+def _eventlet_patched():
+    """Работает ли процесс под eventlet с monkey patching"""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('socket')
+
+
+def _run(func, *args):
+    if _offload:
+        from eventlet import tpool
+        return tpool.execute(func, *args)
+    return func(*args)
+
+
+def hash_password(password):
+    """Хеш пароля с текущими параметрами"""
+    return _run(generate_password_hash, password, _method)
+
+
+def verify_password(password_hash, password):
+    """Проверить пароль по хешу"""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Создан ли хеш с параметрами, отличными от текущих"""
+    return password_hash.split('$', 1)[0] != _method
@@ -3,25 +3,28 @@
 from flask import render_template, redirect, url_for, flash, request
 from flask_login import login_required, current_user
 from app.profile import profile_bp
-from app import db
+from app import db, identity
 from app.models import User, Topic, Post
 from app.utils import allowed_file, save_picture, delete_picture
+from app.metrics import query_budget
+from sqlalchemy.orm import joinedload
 
 
 @profile_bp.route('/<int:user_id>')
+@query_budget(5)
 def view(user_id):
     """Просмотр профиля пользователя"""
     user = User.query.get_or_404(user_id)
     
-    # Получаем статистику
-    topics_count = user.topics.count()
-    posts_count = user.posts.count()
+    # Статистика из счетчиков пользователя (без COUNT по топикам и постам)
+    topics_count = user.topic_count
+    posts_count = user.post_count
     
     # Последние топики пользователя
     recent_topics = user.topics.order_by(Topic.created_at.desc()).limit(5).all()
     
-    # Последние посты пользователя
-    recent_posts = user.posts.order_by(Post.created_at.desc()).limit(5).all()
+    # Последние посты пользователя (с топиками для ссылок)
+    recent_posts = user.posts.options(joinedload(Post.topic)).order_by(Post.created_at.desc()).limit(5).all()
     
     return render_template('profile/view.html',
                          user=user,
@@ -36,6 +39,8 @@ def view(user_id):
 def edit():
     """Редактирование профиля"""
     if request.method == 'POST':
+        # current_user — кэшированная копия, изменяется модель
+        user = User.query.get(current_user.id)
         username = request.form.get('username', '').strip()
         
         # Валидация
@@ -44,28 +49,29 @@ def edit():
             return render_template('profile/edit.html')
         
         # Проверка уникальности имени (если изменилось)
-        if username != current_user.username:
+        if username != user.username:
             if User.query.filter_by(username=username).first():
                 flash('Это имя пользователя уже занято', 'danger')
                 return render_template('profile/edit.html')
             
-            current_user.username = username
+            user.username = username
         
         # Обработка аватара
         if 'avatar' in request.files:
             file = request.files['avatar']
             if file and file.filename and allowed_file(file.filename):
                 # Удаляем старый аватар
-                if current_user.avatar != 'default-avatar.png':
-                    delete_picture(current_user.avatar, 'avatars')
+                if user.avatar != 'default-avatar.png':
+                    delete_picture(user.avatar, 'avatars')
                 
-                # Сохраняем новый с изменением размера
-                avatar_filename = save_picture(file, 'avatars', size=(200, 200))
-                current_user.avatar = avatar_filename
+                # Сохраняем новый, уменьшенные варианты создаются в фоне
+                avatar_filename = save_picture(file, 'avatars')
+                user.avatar = avatar_filename
         
         db.session.commit()
+        identity.invalidate(user.id)
         flash('Профиль обновлен!', 'success')
-        return redirect(url_for('profile.view', user_id=current_user.id))
+        return redirect(url_for('profile.view', user_id=user.id))
     
     return render_template('profile/edit.html')
 
@@ -75,12 +81,13 @@ def edit():
 def change_password():
     """Изменение пароля"""
     if request.method == 'POST':
+        user = User.query.get(current_user.id)
         current_password = request.form.get('current_password', '')
         new_password = request.form.get('new_password', '')
         confirm_password = request.form.get('confirm_password', '')
         
         # Валидация
-        if not current_user.check_password(current_password):
+        if not user.check_password(current_password):
             flash('Неверный текущий пароль', 'danger')
             return render_template('profile/change_password.html')
         
@@ -93,11 +100,12 @@ def change_password():
             return render_template('profile/change_password.html')
         
         # Обновляем пароль
-        current_user.set_password(new_password)
+        user.set_password(new_password)
         db.session.commit()
+        identity.invalidate(user.id)
         
         flash('Пароль успешно изменен!', 'success')
-        return redirect(url_for('profile.view', user_id=current_user.id))
+        return redirect(url_for('profile.view', user_id=user.id))
     
     return render_template('profile/change_password.html')
 
@@ -0,0 +1,165 @@
+"""Чтение с реплик БД для маршрутов только на чтение
+
+Реплики задаются в DATABASE_REPLICA_URLS и становятся binds
+Flask-SQLAlchemy (replica_1, replica_2, ...). На маршрутах из
+DB_REPLICA_ROUTES (GET-запросы) SELECT-запросы сессии уходят на одну из
+исправных реплик, а INSERT/UPDATE/DELETE, flush и SELECT ... FOR UPDATE —
+всегда на основную БД. Вне запросов (фоновые задачи, CLI) и в событиях
+Socket.IO используется только основная БД.
+
+Исправность реплик раз в DB_REPLICA_CHECK_INTERVAL секунд проверяет
+фоновая задача процесса: реплика с отставанием больше DB_REPLICA_MAX_LAG
+секунд или недоступная исключается, пока не догонит. Если исправных реплик
+нет, чтение идет с основной БД.
+
+Чтение своих записей: после запроса, изменившего данные (создание топика,
+ответ, правка профиля), в сессию пользователя записывается срок
+DB_REPLICA_STICKY_SECONDS, и до него все его запросы читают основную БД —
+редирект на топик покажет новый пост, даже если реплика отстает.
+"""
+
+import random
+import threading
+import time
+from flask import g, has_request_context, request, session
+from sqlalchemy import event
+from app import db, socketio
+
+# Отставание реплики PostgreSQL (сек); 0, если реплика применила все полученное
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReplicaRouter:
+    """Выбор реплики для чтения и проверка их отставания"""
+
+    def __init__(self):
+        self.app = None
+        self.keys = []
+        self.routes = set()
+        self.max_lag = 5.0
+        self.check_interval = 5
+        self.sticky_seconds = 10
+        # Реплики, прошедшие последнюю проверку
+        self.healthy = []
+        self.lags = {}
+        self._checker_started = False
+        self._checker_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Привязать маршрутизацию к приложению (после db.init_app)"""
+        self.app = app
+        self.keys = [key for key in app.config['SQLALCHEMY_BINDS'] if key.startswith('replica_')]
+        self.routes = set(app.config['DB_REPLICA_ROUTES'])
+        self.max_lag = app.config['DB_REPLICA_MAX_LAG']
+        self.check_interval = app.config['DB_REPLICA_CHECK_INTERVAL']
+        self.sticky_seconds = app.config['DB_REPLICA_STICKY_SECONDS']
+        app.extensions['replicas'] = self
+
+        if not self.keys:
+            return
+
+        event.listen(db.session, 'do_orm_execute', self._route)
+        event.listen(db.session, 'after_flush', self._mark_write)
+        app.before_request(self._ensure_checker)
+        app.after_request(self._stick_to_primary)
+
+    def replica_for_request(self):
+        """
+        Реплика для чтения в текущем запросе
+
+        Returns:
+            ключ bind реплики или None (читать основную БД)
+        """
+        if not has_request_context():
+            return None
+
+        key = g.get('_db_replica', False)
+        if key is False:
+            key = None
+            if request.endpoint in self.routes and request.method in ('GET', 'HEAD') \
+                    and session.get('db_primary_until', 0) <= time.time() and self.healthy:
+                key = random.choice(self.healthy)
+            g._db_replica = key
+        return key
+
+    def _route(self, state):
+        """Отправить SELECT сессии на реплику"""
+        if state.is_select:
+            if state.bind_arguments.get('bind') is not None \
+                    or getattr(state.statement, '_for_update_arg', None) is not None:
+                return None
+            key = self.replica_for_request()
+            if key is None:
+                return None
+            return state.invoke_statement(bind_arguments={'bind': db.engines[key]})
+
+        if state.is_insert or state.is_update or state.is_delete:
+            self._mark_write()
+        return None
+
+    def _mark_write(self, *args):
+        if has_request_context():
+            g._db_wrote = True
+
+    def _stick_to_primary(self, response):
+        """После записи пользователь некоторое время читает основную БД"""
+        if g.get('_db_wrote') and request.method not in ('GET', 'HEAD'):
+            session['db_primary_until'] = time.time() + self.sticky_seconds
+        return response
+
+    def lag(self, key):
+        """Отставание реплики (сек)"""
+        engine = db.engines[key]
+        with engine.connect() as connection:
+            if engine.dialect.name != 'postgresql':
+                # Для SQLite (проверка на двух файлах) отставание не измеряется
+                connection.exec_driver_sql('SELECT 1')
+                return 0.0
+            return float(connection.exec_driver_sql(LAG_QUERY).scalar())
+
+    def check(self):
+        """Обновить список исправных реплик"""
+        healthy = []
+        for key in self.keys:
+            try:
+                self.lags[key] = self.lag(key)
+            except Exception as e:
+                self.lags[key] = None
+                self.app.logger.warning(f'Replica {key} is unavailable: {e}')
+                continue
+            if self.lags[key] <= self.max_lag:
+                healthy.append(key)
+            else:
+                self.app.logger.warning(f'Replica {key} lags {self.lags[key]:.1f}s, reading from primary')
+        self.healthy = healthy
+        return healthy
+
+    def _ensure_checker(self):
+        """Запустить проверку реплик при первом запросе"""
+        if self._checker_started:
+            return
+
+        with self._checker_lock:
+            if self._checker_started:
+                return
+            self._checker_started = True
+        socketio.start_background_task(self._run_checker)
+
+    def _run_checker(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.check()
+            except Exception as e:
+                self.healthy = []
+                self.app.logger.error(f'Error checking replicas: {e}')
+            socketio.sleep(self.check_interval)
+
+
+replicas = ReplicaRouter()
@@ -0,0 +1,327 @@
+"""Полнотекстовый поиск по топикам и постам
+
+PostgreSQL: у таблиц topics и posts есть генерируемые столбцы
+``search_vector tsvector`` (словари russian и english, заголовок топика
+с весом A, текст с весом B) с GIN-индексами. Столбец пересчитывается
+самой СУБД при INSERT/UPDATE, поэтому отдельная индексация не нужна.
+
+SQLite (разработка и проверки): виртуальная таблица FTS5 search_index,
+которую приложение заполняет явно — index_topic/index_post/remove_post
+вызываются в транзакции записи, reindex() пересоздает индекс целиком.
+
+Результаты ранжируются (ts_rank / bm25), фрагменты текста подсвечиваются
+(ts_headline / snippet) и листаются курсором по ключу (rank, kind, id).
+"""
+
+from markupsafe import Markup, escape
+from sqlalchemy import event, DDL
+from app import db
+from app.models import Topic, Post
+from app.pagination import keyset_paginate, encode_cursor
+
+# Маркеры подсветки: СУБД вставляет их вокруг найденных слов, затем текст
+# экранируется и маркеры заменяются на <mark> (пользовательский HTML не
+# попадает на страницу)
+HL_START = '\x02'
+HL_STOP = '\x03'
+
+# Максимальное число слов запроса
+MAX_TERMS = 16
+
+_PG_VECTORS = {
+    'topics': (
+        "setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('russian', coalesce(content, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+    ),
+    'posts': (
+        "setweight(to_tsvector('russian', coalesce(content, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+    ),
+}
+
+PG_SCHEMA = [
+    f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector '
+    f'GENERATED ALWAYS AS ({expr}) STORED'
+    for table, expr in _PG_VECTORS.items()
+] + [
+    f'CREATE INDEX IF NOT EXISTS ix_{table}_search_vector ON {table} USING gin (search_vector)'
+    for table in _PG_VECTORS
+]
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "title, content, kind UNINDEXED, ref_id UNINDEXED, topic_id UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+]
+
+# Схема поиска создается вместе с таблицами при db.create_all()
+# (в развернутой базе ее создает миграция 008)
+for _statement in PG_SCHEMA:
+    event.listen(db.metadata, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+for _statement in SQLITE_SCHEMA:
+    event.listen(db.metadata, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _terms(query):
+    """Слова запроса без операторов и спецсимволов"""
+    words = ''.join(ch if ch.isalnum() else ' ' for ch in query).split()
+    return words[:MAX_TERMS]
+
+
+def highlight(fragment):
+    """Экранировать фрагмент и заменить маркеры подсветки на <mark>"""
+    if not fragment:
+        return Markup('')
+    text = str(escape(fragment))
+    return Markup(text.replace(HL_START, '<mark>').replace(HL_STOP, '</mark>'))
+
+
+# --- Индексация (только SQLite; в PostgreSQL столбцы генерируемые) ---
+
+def index_topic(topic):
+    """Добавить топик в индекс (после flush, когда у топика есть id)"""
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(db.text(
+        "INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+        "VALUES (:title, :content, 'topic', :id, :id)"
+    ), {'title': topic.title, 'content': topic.content, 'id': topic.id})
+
+
+def index_post(post):
+    """Добавить пост в индекс (после flush)"""
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(db.text(
+        "INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+        "VALUES ('', :content, 'post', :id, :topic_id)"
+    ), {'content': post.content, 'id': post.id, 'topic_id': post.topic_id})
+
+
+def remove_post(post):
+    """Убрать пост из индекса"""
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(db.text(
+        "DELETE FROM search_index WHERE kind = 'post' AND ref_id = :id"
+    ), {'id': post.id})
+
+
+def reindex():
+    """
+    Пересоздать поисковый индекс по таблицам топиков и постов
+
+    Returns:
+        количество проиндексированных записей (None для PostgreSQL, где
+        векторы пересчитывает сама СУБД)
+    """
+    if _dialect() != 'sqlite':
+        return None
+
+    for statement in SQLITE_SCHEMA:
+        db.session.execute(db.text(statement))
+    db.session.execute(db.text('DELETE FROM search_index'))
+    db.session.execute(db.text(
+        "INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+        "SELECT title, content, 'topic', id, id FROM topics"
+    ))
+    db.session.execute(db.text(
+        "INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+        "SELECT '', content, 'post', id, topic_id FROM posts"
+    ))
+    return db.session.execute(db.text('SELECT count(*) FROM search_index')).scalar()
+
+
+# --- Поиск ---
+#
+# Запрос идет в два шага: сначала ранжируются и отбираются по курсору
+# только ключи совпадений (kind, id, topic_id, rank), затем для строк
+# страницы одним-двумя запросами догружаются заголовки, даты и фрагменты.
+# Так соединение с topics и ts_headline выполняются для страницы, а не
+# для всех совпадений.
+
+class SearchHit:
+    """Результат поиска: топик или пост"""
+
+    def __init__(self, kind, id, topic_id, rank, snippet=None):
+        self.kind = kind
+        self.id = id
+        self.topic_id = topic_id
+        self.rank = rank
+        self.snippet = snippet
+        self.title = None
+        self.created_at = None
+
+
+def _pg_tsquery(terms):
+    query_text = ' '.join(terms)
+    return db.func.websearch_to_tsquery(db.literal_column("'russian'"), query_text).op('||')(
+        db.func.websearch_to_tsquery(db.literal_column("'english'"), query_text)
+    )
+
+
+def _rank(vector, tsquery):
+    # ts_rank возвращает real (float4), а значение из курсора передается как
+    # double precision: при сравнении real расширяется до double и не равно
+    # округленному значению из курсора, строки с равным rank теряются или
+    # повторяются на границе страниц. Поэтому rank сразу приводится к double
+    return db.cast(db.func.ts_rank(vector, tsquery), db.Float(53))
+
+
+def _pg_hits(terms):
+    tsquery = _pg_tsquery(terms)
+    topic_vector = db.literal_column('topics.search_vector')
+    post_vector = db.literal_column('posts.search_vector')
+
+    topics = db.select(
+        db.literal_column("'topic'", db.String).label('kind'),
+        Topic.id.label('id'),
+        Topic.id.label('topic_id'),
+        _rank(topic_vector, tsquery).label('rank'),
+    ).where(topic_vector.op('@@')(tsquery))
+
+    posts = db.select(
+        db.literal_column("'post'", db.String).label('kind'),
+        Post.id.label('id'),
+        Post.topic_id.label('topic_id'),
+        _rank(post_vector, tsquery).label('rank'),
+    ).where(post_vector.op('@@')(tsquery))
+
+    return db.union_all(topics, posts).subquery('hits')
+
+
+def _pg_snippets(hits, terms):
+    """Фрагменты с подсветкой (ts_headline) только для строк страницы"""
+    tsquery = _pg_tsquery(terms)
+    options = f'StartSel={HL_START}, StopSel={HL_STOP}, MaxWords=35, MinWords=15, MaxFragments=2'
+
+    for kind, model in (('topic', Topic), ('post', Post)):
+        ids = [hit.id for hit in hits if hit.kind == kind]
+        if not ids:
+            continue
+
+        snippets = dict(db.session.execute(db.select(
+            model.id,
+            db.func.ts_headline(db.literal_column("'russian'"), model.content, tsquery, options)
+        ).where(model.id.in_(ids))).all())
+
+        for hit in hits:
+            if hit.kind == kind:
+                hit.snippet = snippets.get(hit.id)
+
+
+def _sqlite_hits(terms):
+    # Каждое слово в кавычках (без операторов FTS5) и с поиском по префиксу
+    match = ' '.join('"{}"*'.format(term.replace('"', '')) for term in terms)
+    fts = db.table('search_index', db.column('kind'), db.column('ref_id'), db.column('topic_id'))
+
+    return db.select(
+        db.type_coerce(fts.c.kind, db.String).label('kind'),
+        db.type_coerce(fts.c.ref_id, db.Integer).label('id'),
+        db.type_coerce(fts.c.topic_id, db.Integer).label('topic_id'),
+        # bm25 тем меньше, чем лучше совпадение; заголовок весит больше текста
+        (-db.func.bm25(db.literal_column('search_index'), 4.0, 1.0, type_=db.Float)).label('rank'),
+        # snippet в FTS5 вычисляется только для выбранных строк
+        db.func.snippet(db.literal_column('search_index'), 1, HL_START, HL_STOP, '…', 24).label('snippet'),
+    ).select_from(fts).where(
+        db.literal_column('search_index').op('MATCH')(match)
+    ).subquery('hits')
+
+
+def _hydrate(rows, terms, postgres):
+    """Превратить строки страницы в SearchHit с заголовками и датами"""
+    hits = [SearchHit(row.kind, row.id, row.topic_id, row.rank, getattr(row, 'snippet', None))
+            for row in rows]
+    if not hits:
+        return hits
+
+    topics = {
+        topic_id: (title, created_at)
+        for topic_id, title, created_at in db.session.execute(
+            db.select(Topic.id, Topic.title, Topic.created_at).where(
+                Topic.id.in_({hit.topic_id for hit in hits})
+            )
+        )
+    }
+    post_dates = dict(db.session.execute(
+        db.select(Post.id, Post.created_at).where(
+            Post.id.in_([hit.id for hit in hits if hit.kind == 'post'])
+        )
+    ).all())
+
+    for hit in hits:
+        hit.title, hit.created_at = topics.get(hit.topic_id, (None, None))
+        if hit.kind == 'post':
+            hit.created_at = post_dates.get(hit.id)
+
+    if postgres:
+        _pg_snippets(hits, terms)
+
+    return hits
+
+
+def search(query, per_page, after=None, before=None, last=False):
+    """
+    Найти топики и посты по тексту
+
+    Args:
+        query: строка запроса пользователя
+        per_page: размер страницы
+        after, before, last: курсор страницы (см. keyset_paginate)
+
+    Returns:
+        KeysetPagination со списком SearchHit или None для пустого запроса
+    """
+    terms = _terms(query)
+    if not terms:
+        return None
+
+    postgres = _dialect() == 'postgresql'
+    hits = _pg_hits(terms) if postgres else _sqlite_hits(terms)
+
+    page = keyset_paginate(
+        db.session.query(hits),
+        (hits.c.rank, hits.c.kind, hits.c.id),
+        per_page=per_page,
+        after=after,
+        before=before,
+        last=last,
+        descending=True
+    )
+    page.items = _hydrate(page.items, terms, postgres)
+    return page
+
+
+def hit_url_params(hit):
+    """
+    Параметры url_for('forum.topic_view') для результата
+
+    Для поста открывается страница топика, начинающаяся с этого поста:
+    курсор (created_at, id - 1) пропускает все более ранние посты.
+    """
+    if hit.kind == 'post' and hit.created_at is not None:
+        return {
+            'topic_id': hit.topic_id,
+            'after': encode_cursor([hit.created_at, hit.id - 1]),
+            '_anchor': f'post-{hit.id}',
+        }
+    return {'topic_id': hit.topic_id}
+
+
+def hit_to_dict(hit):
+    """Преобразовать результат поиска в словарь для JSON"""
+    return {
+        'kind': hit.kind,
+        'id': hit.id,
+        'topic_id': hit.topic_id,
+        'title': hit.title,
+        'created_at': hit.created_at.isoformat() if hit.created_at else None,
+        'snippet': str(highlight(hit.snippet)),
+        'rank': hit.rank,
+    }
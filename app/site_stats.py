@@ -0,0 +1,214 @@
+"""Материализованная статистика сайта
+
+Глобальные счетчики (пользователи, топики, посты) хранятся в таблице
+site_stats, поэтому страницы читают готовые числа вместо COUNT(*) по
+большим таблицам. Строки site_stats — общие для всех запросов записи,
+поэтому их не обновляют в транзакции запроса (иначе все создания постов
+выстраиваются в очередь за блокировкой одной строки до своего COMMIT).
+Изменения копятся в памяти процесса после COMMIT транзакции запроса и
+раз в SITE_STATS_FLUSH_INTERVAL секунд сбрасываются в БД одним UPDATE в
+отдельной короткой транзакции, как просмотры в app.view_counter. При
+аварийном завершении процесса несброшенные изменения теряются.
+
+Расхождения (потерянные изменения, удаление каскадом, ручные правки БД)
+исправляет периодический пересчет по БД раз в SITE_STATS_REFRESH_INTERVAL
+секунд — его выполняет один процесс из всех, остальные пропускают
+интервал.
+
+При SITE_STATS_APPROXIMATE пересчет берет оценку планировщика
+(pg_class.reltuples на PostgreSQL) вместо точного COUNT(*).
+
+Счетчики пользователя (topic_count, post_count, message_count) хранятся
+в таблице users, см. User.change_counters.
+"""
+
+import atexit
+import threading
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import event
+from app import db, socketio, bulk
+from app.cache import cache
+from app.models import User, Topic, Post, SiteStat
+from app.pagination import approximate_count
+
+# Имя счетчика -> модель, по которой он пересчитывается
+COUNTERS = {
+    'users': User,
+    'topics': Topic,
+    'posts': Post,
+}
+
+
+class SiteStats:
+    """Глобальные счетчики сайта с инкрементальным обновлением"""
+
+    def __init__(self):
+        self.app = None
+        self.refresh_interval = 600
+        self.flush_interval = 5
+        self.approximate = False
+        self._pending = Counter()
+        self._pending_lock = threading.Lock()
+        self._refresher_started = False
+        self._flusher_started = False
+        self._refresher_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Привязать статистику к приложению"""
+        self.app = app
+        self.refresh_interval = app.config['SITE_STATS_REFRESH_INTERVAL']
+        self.flush_interval = app.config['SITE_STATS_FLUSH_INTERVAL']
+        self.approximate = app.config['SITE_STATS_APPROXIMATE']
+        app.extensions['site_stats'] = self
+        atexit.register(self.flush)
+
+    def incr(self, name, delta=1):
+        """Изменить счетчик после COMMIT текущей транзакции (без UPDATE в ней)"""
+        # Изменения привязаны к транзакции: без нее rollback не вызывает событий
+        session = db.session()
+        if not session.in_transaction():
+            session.begin()
+        session.info.setdefault('site_stats', Counter())[name] += delta
+
+    def _add_pending(self, deltas):
+        with self._pending_lock:
+            self._pending.update(deltas)
+        self._ensure_flusher()
+
+    def flush(self):
+        """
+        Сбросить накопленные изменения в БД одним UPDATE
+
+        Returns:
+            словарь записанных изменений {имя: delta}
+        """
+        with self._pending_lock:
+            deltas = {name: delta for name, delta in self._pending.items() if delta}
+            self._pending.clear()
+        if not deltas or self.app is None:
+            return {}
+
+        stats = SiteStat.__table__
+        stmt = db.update(stats).where(stats.c.name.in_(list(deltas))).values(
+            value=stats.c.value + db.case(deltas, value=stats.c.name, else_=0)
+        )
+
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(stmt)
+        except Exception as e:
+            with self._pending_lock:
+                self._pending.update(deltas)
+            self.app.logger.error(f'Error flushing site stats: {e}')
+            return {}
+
+        return deltas
+
+    def get(self):
+        """
+        Текущие значения счетчиков
+
+        Returns:
+            словарь {имя: значение}
+        """
+        self._ensure_refresher()
+
+        stats = dict(db.session.execute(db.select(SiteStat.name, SiteStat.value)).all())
+        if len(stats) < len(COUNTERS):
+            # Таблица еще не заполнена (новая база)
+            return self.refresh()
+
+        # Несброшенные изменения этого процесса (автор видит свой пост сразу)
+        with self._pending_lock:
+            for name, delta in self._pending.items():
+                if name in stats:
+                    stats[name] += delta
+        return stats
+
+    def refresh(self):
+        """
+        Пересчитать счетчики по БД
+
+        Returns:
+            словарь {имя: значение}
+        """
+        # Пересчет уже учитывает закоммиченные строки: изменения этого
+        # процесса, еще не сброшенные в БД, после него посчитались бы дважды
+        with self._pending_lock:
+            self._pending.clear()
+
+        now = datetime.utcnow()
+        stats = {}
+
+        for name, model in COUNTERS.items():
+            if self.approximate:
+                value = approximate_count(model)
+            else:
+                value = db.session.query(db.func.count()).select_from(model).scalar()
+
+            db.session.merge(SiteStat(name=name, value=value, refreshed_at=now))
+            stats[name] = value
+
+        db.session.commit()
+        return stats
+
+    def _ensure_refresher(self):
+        """Запустить периодический пересчет при первом обращении"""
+        if self._refresher_started or self.app is None:
+            return
+
+        with self._refresher_lock:
+            if not self._refresher_started:
+                self._refresher_started = True
+                socketio.start_background_task(self._run_refresher)
+
+    def _ensure_flusher(self):
+        """Запустить фоновый сброс при первом изменении"""
+        if self._flusher_started or self.app is None:
+            return
+
+        with self._refresher_lock:
+            if not self._flusher_started:
+                self._flusher_started = True
+                socketio.start_background_task(self._run_flusher)
+
+    def _run_flusher(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            self.flush()
+
+    def _run_refresher(self):
+        while True:
+            socketio.sleep(self.refresh_interval)
+
+            # Один пересчет за интервал на все процессы
+            if not cache.add('site_stats:refresh', 1, max(1, self.refresh_interval - 1)):
+                continue
+
+            try:
+                # COUNT(*) по большим таблицам дольше таймаута запросов страниц
+                with self.app.app_context(), bulk.unlimited_statements():
+                    self.refresh()
+            except Exception as e:
+                self.app.logger.error(f'Error refreshing site stats: {e}')
+
+
+site_stats = SiteStats()
+
+
+@event.listens_for(db.session, 'after_commit')
+def _collect_deltas(session):
+    """Изменения закоммиченной транзакции — в буфер процесса"""
+    deltas = session.info.pop('site_stats', None)
+    if deltas:
+        site_stats._add_pending(deltas)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_deltas(session, previous_transaction):
+    """Изменения отмененной транзакции не учитываются"""
+    # Откат SAVEPOINT не отменяет внешнюю транзакцию
+    if previous_transaction.parent is None:
+        session.info.pop('site_stats', None)
@@ -2,12 +2,10 @@
 
 import os
 import secrets
-from PIL import Image
 from flask import current_app
 from werkzeug.utils import secure_filename
-from flask_mail import Message
-from app import mail
-from threading import Thread
+from app.images import enqueue_processing, delete_variants
+from app.mailer import outbox
 
 
 def allowed_file(filename):
@@ -16,32 +14,29 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 
-def save_picture(form_picture, folder, size=None):
+def save_picture(form_picture, folder):
     """
     Сохранение изображения
     
+    В запросе сохраняется только исходный файл, варианты размеров
+    создаются в фоне (см. app.images).
+    
     Args:
         form_picture: файл из формы
         folder: папка для сохранения (относительно UPLOAD_FOLDER)
-        size: кортеж (width, height) для изменения размера, или None
     
     Returns:
         имя сохраненного файла
     """
     random_hex = secrets.token_hex(8)
     _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
+    picture_fn = random_hex + f_ext.lower()
     
     # Полный путь к файлу
     picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], folder, picture_fn)
+    form_picture.save(picture_path)
     
-    # Изменение размера если указан
-    if size:
-        img = Image.open(form_picture)
-        img.thumbnail(size)
-        img.save(picture_path)
-    else:
-        form_picture.save(picture_path)
+    enqueue_processing(folder, picture_fn)
     
     return picture_fn
 
@@ -58,29 +53,17 @@ def delete_picture(filename, folder):
         file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], folder, filename)
         if os.path.exists(file_path):
             os.remove(file_path)
+        delete_variants(folder, filename)
 
 
-def send_async_email(app, msg):
-    """Отправка email в отдельном потоке"""
-    with app.app_context():
-        try:
-            mail.send(msg)
-        except Exception as e:
-            current_app.logger.error(f'Error sending email: {e}')
-
-
-def send_email(subject, recipient, text_body, html_body=None):
-    """Отправка email сообщения"""
-    msg = Message(subject,
-                  sender=current_app.config['MAIL_DEFAULT_SENDER'],
-                  recipients=[recipient])
-    msg.body = text_body
-    if html_body:
-        msg.html = html_body
+def send_email(subject, recipient, text_body, html_body=None, dedupe_key=None):
+    """
+    Отправка email сообщения
     
-    # Отправка в отдельном потоке, чтобы не блокировать основной процесс
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    Письмо ставится в очередь в текущей транзакции и уходит после commit
+    (см. app.mailer).
+    """
+    outbox.enqueue(subject, recipient, text_body, html_body, dedupe_key=dedupe_key)
 
 
 def send_verification_email(user):
@@ -123,5 +106,6 @@ def send_verification_email(user):
     </html>
     '''
     
-    send_email(subject, user.email, text_body, html_body)
+    # Повторные запросы кода заменяют неотправленное письмо
+    send_email(subject, user.email, text_body, html_body, dedupe_key=f'verify:{user.id}')
 
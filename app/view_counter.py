@@ -0,0 +1,136 @@
+"""Буферизованный счетчик просмотров топиков
+
+Просмотры накапливаются в памяти процесса (или в подключаемом бэкенде)
+и периодически сбрасываются в БД одним запросом
+``UPDATE topics SET views = views + n``. Столбец ``Topic.views``
+становится согласованным в конечном счете.
+
+Границы потерь: при аварийном завершении процесса теряются только
+несброшенные просмотры — не более VIEW_COUNTER_MAX_PENDING штук или
+накопленных за VIEW_COUNTER_FLUSH_INTERVAL секунд. При штатной остановке
+буфер сбрасывается через atexit.
+"""
+
+import atexit
+import threading
+from collections import Counter
+from app import db, socketio
+from app.models import Topic
+
+
+class LocalViewCounterBackend:
+    """Хранилище несброшенных просмотров в памяти процесса"""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def incr(self, topic_id, amount=1):
+        """Добавить просмотры, вернуть общее число несброшенных просмотров"""
+        with self._lock:
+            self._counts[topic_id] += amount
+            self._total += amount
+            return self._total
+
+    def get(self, topic_id):
+        """Несброшенные просмотры топика"""
+        with self._lock:
+            return self._counts.get(topic_id, 0)
+
+    def drain(self):
+        """Забрать все накопленные просмотры и очистить буфер"""
+        with self._lock:
+            counts = dict(self._counts)
+            self._counts.clear()
+            self._total = 0
+            return counts
+
+    def restore(self, counts):
+        """Вернуть просмотры в буфер (если сброс в БД не удался)"""
+        with self._lock:
+            for topic_id, amount in counts.items():
+                self._counts[topic_id] += amount
+                self._total += amount
+
+
+class ViewCounter:
+    """Агрегатор просмотров с периодическим пакетным сбросом в БД"""
+
+    def __init__(self, backend=None):
+        self.backend = backend or LocalViewCounterBackend()
+        self.app = None
+        self.flush_interval = 10
+        self.max_pending = 1000
+        self._flusher_started = False
+        self._flusher_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Привязать счетчик к приложению"""
+        self.app = app
+        self.flush_interval = app.config['VIEW_COUNTER_FLUSH_INTERVAL']
+        self.max_pending = app.config['VIEW_COUNTER_MAX_PENDING']
+        app.extensions['view_counter'] = self
+        atexit.register(self.flush)
+
+    def incr(self, topic_id, amount=1):
+        """Учесть просмотр топика"""
+        total = self.backend.incr(topic_id, amount)
+        self._ensure_flusher()
+
+        # Ограничиваем объем просмотров, которые можно потерять
+        if total >= self.max_pending:
+            self.flush()
+
+    def pending(self, topic_id):
+        """Просмотры топика, еще не записанные в БД"""
+        return self.backend.get(topic_id)
+
+    def flush(self):
+        """
+        Сбросить накопленные просмотры в БД одним UPDATE
+
+        Returns:
+            количество записанных просмотров
+        """
+        counts = self.backend.drain()
+        if not counts or self.app is None:
+            return 0
+
+        topics = Topic.__table__
+        stmt = db.update(topics).where(
+            topics.c.id.in_(list(counts))
+        ).values(
+            views=db.func.coalesce(topics.c.views, 0) + db.case(counts, value=topics.c.id, else_=0),
+            # Просмотр не должен поднимать топик в списке
+            updated_at=topics.c.updated_at
+        )
+
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(stmt)
+        except Exception as e:
+            self.backend.restore(counts)
+            self.app.logger.error(f'Error flushing topic views: {e}')
+            return 0
+
+        return sum(counts.values())
+
+    def _ensure_flusher(self):
+        """Запустить фоновый сброс при первом просмотре"""
+        if self._flusher_started:
+            return
+
+        with self._flusher_lock:
+            if not self._flusher_started:
+                self._flusher_started = True
+                socketio.start_background_task(self._run_flusher)
+
+    def _run_flusher(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            self.flush()
+
+
+view_counter = ViewCounter()
@@ -16,6 +16,29 @@ mkdir -p /app/uploads/posts
 mkdir -p /app/uploads/chat
 chmod -R 755 /app/uploads
 
-echo "Starting application..."
-exec gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:5000 "run:app"
+# Socket.IO требует, чтобы все запросы клиента попадали в один процесс,
+# а балансировщик gunicorn этого не гарантирует. Поэтому вместо -w N
+# запускаем WEB_WORKERS отдельных однопроцессных gunicorn на портах
+# 5000, 5001, ... и распределяем клиентов в nginx (ip_hash).
+WEB_WORKERS=${WEB_WORKERS:-1}
+
+if [ "$WEB_WORKERS" -gt 1 ] && [ -z "$SOCKETIO_MESSAGE_QUEUE" ]; then
+  echo "WEB_WORKERS=$WEB_WORKERS requires SOCKETIO_MESSAGE_QUEUE (e.g. redis://redis:6379/0)"
+  exit 1
+fi
+
+echo "Starting application ($WEB_WORKERS worker(s))..."
+if [ "$WEB_WORKERS" -eq 1 ]; then
+  exec gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:5000 "run:app"
+fi
+
+for i in $(seq 0 $((WEB_WORKERS - 1))); do
+  gunicorn --worker-class eventlet -w 1 --bind 0.0.0.0:$((5000 + i)) "run:app" &
+done
+
+# Если любой процесс завершился, останавливаем контейнер (docker перезапустит его)
+trap 'kill $(jobs -p) 2>/dev/null' TERM INT
+wait -n
+kill $(jobs -p) 2>/dev/null
+exit 1
 
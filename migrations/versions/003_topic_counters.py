@@ -0,0 +1,53 @@
+"""Add denormalized post counters to topics
+
+Revision ID: 003_topic_counters
+Revises: 002_email_verification
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '003_topic_counters'
+down_revision = '002_email_verification'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('topics', sa.Column('post_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('topics', sa.Column('last_post_id', sa.Integer(), nullable=True))
+    op.add_column('topics', sa.Column('last_post_at', sa.DateTime(), nullable=True))
+    op.add_column('topics', sa.Column('last_poster_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_topics_last_poster_id_users', 'topics', 'users',
+                          ['last_poster_id'], ['id'])
+    
+    # Индекс для списка топиков (forum.index сортирует по updated_at)
+    op.create_index(op.f('ix_topics_updated_at'), 'topics', ['updated_at'], unique=False)
+    
+    # Заполняем счетчики для существующих топиков
+    op.execute('''
+        UPDATE topics SET
+            post_count = (SELECT COUNT(*) FROM posts WHERE posts.topic_id = topics.id),
+            last_post_id = (
+                SELECT p.id FROM posts p WHERE p.topic_id = topics.id
+                ORDER BY p.created_at DESC, p.id DESC LIMIT 1
+            )
+    ''')
+    op.execute('''
+        UPDATE topics SET
+            last_post_at = (SELECT p.created_at FROM posts p WHERE p.id = topics.last_post_id),
+            last_poster_id = (SELECT p.author_id FROM posts p WHERE p.id = topics.last_post_id)
+        WHERE last_post_id IS NOT NULL
+    ''')
+
+
+def downgrade():
+    op.drop_index(op.f('ix_topics_updated_at'), table_name='topics')
+    op.drop_constraint('fk_topics_last_poster_id_users', 'topics', type_='foreignkey')
+    op.drop_column('topics', 'last_poster_id')
+    op.drop_column('topics', 'last_post_at')
+    op.drop_column('topics', 'last_post_id')
+    op.drop_column('topics', 'post_count')
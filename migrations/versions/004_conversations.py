@@ -0,0 +1,65 @@
+"""Add conversations summary table
+
+Revision ID: 004_conversations
+Revises: 003_topic_counters
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004_conversations'
+down_revision = '003_topic_counters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_low_id', sa.Integer(), nullable=False),
+        sa.Column('user_high_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('last_message_preview', sa.String(length=100), nullable=True),
+        sa.Column('last_message_at', sa.DateTime(), nullable=True),
+        sa.Column('last_sender_id', sa.Integer(), nullable=True),
+        sa.Column('unread_low', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('unread_high', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['user_low_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['user_high_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversations_pair')
+    )
+    op.create_index('ix_conversations_low_last_message_at', 'conversations',
+                    ['user_low_id', 'last_message_at'], unique=False)
+    op.create_index('ix_conversations_high_last_message_at', 'conversations',
+                    ['user_high_id', 'last_message_at'], unique=False)
+    
+    # Заполняем сводки по существующим сообщениям
+    op.execute('''
+        INSERT INTO conversations (user_low_id, user_high_id, last_message_id,
+                                   unread_low, unread_high)
+        SELECT LEAST(sender_id, recipient_id),
+               GREATEST(sender_id, recipient_id),
+               MAX(id),
+               SUM(CASE WHEN recipient_id < sender_id AND NOT is_read THEN 1 ELSE 0 END),
+               SUM(CASE WHEN recipient_id > sender_id AND NOT is_read THEN 1 ELSE 0 END)
+        FROM chat_messages
+        GROUP BY LEAST(sender_id, recipient_id), GREATEST(sender_id, recipient_id)
+    ''')
+    op.execute('''
+        UPDATE conversations SET
+            last_message_preview = LEFT(m.content, 100),
+            last_message_at = m.created_at,
+            last_sender_id = m.sender_id
+        FROM chat_messages m
+        WHERE m.id = conversations.last_message_id
+    ''')
+
+
+def downgrade():
+    op.drop_index('ix_conversations_high_last_message_at', table_name='conversations')
+    op.drop_index('ix_conversations_low_last_message_at', table_name='conversations')
+    op.drop_table('conversations')
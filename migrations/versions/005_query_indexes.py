@@ -0,0 +1,63 @@
+"""Add composite and partial indexes for hot queries
+
+Revision ID: 005_query_indexes
+Revises: 004_conversations
+Create Date: 2026-10-18
+
+На PostgreSQL индексы создаются через CREATE INDEX CONCURRENTLY вне
+транзакции, чтобы не блокировать запись в рабочей базе. Если построение
+прервется, невалидный индекс нужно удалить и повторить миграцию.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '005_query_indexes'
+down_revision = '004_conversations'
+branch_labels = None
+depends_on = None
+
+
+# (имя, таблица, столбцы, условие частичного индекса)
+INDEXES = [
+    ('ix_topics_updated_at_id', 'topics', ['updated_at', 'id'], None),
+    ('ix_topics_author_id_created_at', 'topics', ['author_id', 'created_at'], None),
+    ('ix_posts_topic_id_created_at_id', 'posts', ['topic_id', 'created_at', 'id'], None),
+    ('ix_posts_author_id_created_at', 'posts', ['author_id', 'created_at'], None),
+    ('ix_chat_messages_sender_recipient_id', 'chat_messages', ['sender_id', 'recipient_id', 'id'], None),
+    ('ix_chat_messages_unread', 'chat_messages', ['recipient_id', 'sender_id'], 'is_read = false'),
+]
+
+
+def upgrade():
+    is_postgres = op.get_bind().dialect.name == 'postgresql'
+    
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True,
+                            postgresql_where=sa.text(where) if where else None,
+                            if_not_exists=True)
+        
+        if is_postgres:
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_lower '
+                       'ON users (lower(username) varchar_pattern_ops)')
+        else:
+            op.execute('CREATE INDEX IF NOT EXISTS ix_users_username_lower ON users (lower(username))')
+        
+        # Заменен составным ix_topics_updated_at_id
+        op.drop_index('ix_topics_updated_at', table_name='topics',
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_topics_updated_at', 'topics', ['updated_at'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_users_username_lower', table_name='users',
+                      postgresql_concurrently=True, if_exists=True)
+        
+        for name, table, columns, where in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
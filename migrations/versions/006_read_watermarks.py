@@ -0,0 +1,43 @@
+"""Add read watermarks to conversations
+
+Revision ID: 006_read_watermarks
+Revises: 005_query_indexes
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '006_read_watermarks'
+down_revision = '005_query_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('conversations', sa.Column('read_up_to_low', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('conversations', sa.Column('read_up_to_high', sa.Integer(), nullable=False, server_default='0'))
+    
+    # Водяной знак — последнее прочитанное сообщение каждой стороны
+    op.execute('''
+        UPDATE conversations SET
+            read_up_to_low = COALESCE((
+                SELECT MAX(m.id) FROM chat_messages m
+                WHERE m.sender_id = conversations.user_high_id
+                  AND m.recipient_id = conversations.user_low_id
+                  AND m.is_read
+            ), 0),
+            read_up_to_high = COALESCE((
+                SELECT MAX(m.id) FROM chat_messages m
+                WHERE m.sender_id = conversations.user_low_id
+                  AND m.recipient_id = conversations.user_high_id
+                  AND m.is_read
+            ), 0)
+    ''')
+
+
+def downgrade():
+    op.drop_column('conversations', 'read_up_to_high')
+    op.drop_column('conversations', 'read_up_to_low')
@@ -0,0 +1,52 @@
+"""Add per-user counters and materialized site statistics
+
+Revision ID: 007_user_counters_site_stats
+Revises: 006_read_watermarks
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '007_user_counters_site_stats'
+down_revision = '006_read_watermarks'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('topic_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('users', sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+
+    op.create_table('site_stats',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('value', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('refreshed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+    # Заполняем счетчики для существующих данных
+    op.execute('''
+        UPDATE users SET
+            topic_count = (SELECT COUNT(*) FROM topics WHERE topics.author_id = users.id),
+            post_count = (SELECT COUNT(*) FROM posts WHERE posts.author_id = users.id),
+            message_count = (SELECT COUNT(*) FROM chat_messages WHERE chat_messages.sender_id = users.id)
+    ''')
+    op.execute('''
+        INSERT INTO site_stats (name, value, refreshed_at)
+        SELECT 'users', COUNT(*), CURRENT_TIMESTAMP FROM users
+        UNION ALL
+        SELECT 'topics', COUNT(*), CURRENT_TIMESTAMP FROM topics
+        UNION ALL
+        SELECT 'posts', COUNT(*), CURRENT_TIMESTAMP FROM posts
+    ''')
+
+
+def downgrade():
+    op.drop_table('site_stats')
+    op.drop_column('users', 'message_count')
+    op.drop_column('users', 'post_count')
+    op.drop_column('users', 'topic_count')
@@ -0,0 +1,68 @@
+"""Add full-text search over topics and posts
+
+Revision ID: 008_full_text_search
+Revises: 007_user_counters_site_stats
+Create Date: 2026-10-18
+
+PostgreSQL: генерируемые столбцы search_vector (словари russian и
+english) и GIN-индексы, построенные CONCURRENTLY. Добавление STORED
+столбца переписывает таблицу, поэтому на большой базе миграцию стоит
+выполнять в окно обслуживания.
+
+SQLite: виртуальная таблица FTS5 search_index, заполненная по текущим
+топикам и постам (дальше ее ведет приложение, см. app.search).
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '008_full_text_search'
+down_revision = '007_user_counters_site_stats'
+branch_labels = None
+depends_on = None
+
+
+VECTORS = {
+    'topics': (
+        "setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('russian', coalesce(content, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+    ),
+    'posts': (
+        "setweight(to_tsvector('russian', coalesce(content, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+    ),
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for table, expr in VECTORS.items():
+            op.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector '
+                       f'GENERATED ALWAYS AS ({expr}) STORED')
+
+        with op.get_context().autocommit_block():
+            for table in VECTORS:
+                op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search_vector '
+                           f'ON {table} USING gin (search_vector)')
+    else:
+        op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                   "title, content, kind UNINDEXED, ref_id UNINDEXED, topic_id UNINDEXED, "
+                   "tokenize = 'unicode61 remove_diacritics 2')")
+        op.execute("INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+                   "SELECT title, content, 'topic', id, id FROM topics")
+        op.execute("INSERT INTO search_index (title, content, kind, ref_id, topic_id) "
+                   "SELECT '', content, 'post', id, topic_id FROM posts")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for table in VECTORS:
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search_vector')
+        for table in VECTORS:
+            op.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector')
+    else:
+        op.execute('DROP TABLE IF EXISTS search_index')
@@ -0,0 +1,30 @@
+"""Add import progress for resumable dump imports
+
+Revision ID: 010_import_progress
+Revises: 009_email_outbox
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010_import_progress'
+down_revision = '009_email_outbox'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_progress',
+        sa.Column('source', sa.String(length=255), nullable=False),
+        sa.Column('rows', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('source')
+    )
+
+
+def downgrade():
+    op.drop_table('import_progress')
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест форума и чата с сохранением результатов
+
+Сценарии:
+
+- index_deep — листание списка топиков (forum.index) вглубь по ссылке
+  «следующая страница» до --depth страниц;
+- topic_view — открытие случайных топиков;
+- login — вход пользователей bench<id> (POST /auth/login);
+- chat — пары клиентов Socket.IO: typing, send_message, у получателя
+  mark_read на каждое сообщение. Замеряются доставка user_typing и
+  new_message и ответ messages_marked_read.
+
+Для каждого сценария печатаются p50/p90/p99/max задержки, число ошибок
+и пропускная способность; --output сохраняет их в JSON вместе с
+параметрами запуска и коммитом. --compare сравнивает запуск с
+сохраненным результатом, --max-regression задает допустимое ухудшение
+p99 и пропускной способности (доля); при его превышении код выхода 1.
+
+Без --url создается временная SQLite база с синтетическими данными
+(scripts/init_db.py --synthetic) и запускается процесс приложения под
+eventlet; --env KEY=VALUE передает ему настройки. С --url тест идет
+против развернутого форума, данные в котором сгенерированы
+init_db.py --synthetic (--first-user — id первого пользователя bench).
+
+Использование:
+    python scripts/benchmark.py --output results/baseline.json
+    python scripts/benchmark.py --env CHAT_WRITE_BEHIND=true --compare results/baseline.json
+    python scripts/benchmark.py --url https://forum.example.com --users 1000000 \\
+        --scenarios index_deep,topic_view --concurrency 64 --requests 20000
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from login_storm_benchmark import serve, wait_for_port
+
+SCENARIOS = ('index_deep', 'topic_view', 'login', 'chat')
+
+# Ссылка на следующую страницу в _pagination.html
+NEXT_PAGE = re.compile(r'href="[^"]*[?&]after=([^"&]+)"')
+
+
+class Recorder:
+    """Задержки и ошибки одного сценария"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def summary(self):
+        ms = sorted(t * 1000 for t in self.latencies)
+        elapsed = (self.finished or time.perf_counter()) - self.started
+
+        def percentile(p):
+            return round(ms[min(len(ms) - 1, int(len(ms) * p))], 2) if ms else None
+
+        return {
+            'requests': len(ms),
+            'errors': self.errors,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput': round(len(ms) / elapsed, 2) if elapsed else None,
+            'mean_ms': round(sum(ms) / len(ms), 2) if ms else None,
+            'p50_ms': percentile(0.50),
+            'p90_ms': percentile(0.90),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(ms[-1], 2) if ms else None,
+        }
+
+
+def login(url, user_id):
+    """Сессия requests пользователя bench<user_id>"""
+    import requests
+
+    session = requests.Session()
+    response = session.post(f'{url}/auth/login',
+                            data={'email': f'bench{user_id}@example.com', 'password': 'password123'},
+                            allow_redirects=False)
+    if response.status_code != 302:
+        raise RuntimeError(f'Не удалось войти как bench{user_id}: HTTP {response.status_code}')
+    return session
+
+
+def run_http(recorder, args, step):
+    """
+    Выполнить --requests запросов в --concurrency потоков
+
+    step(session, state) выполняет один запрос и возвращает успех;
+    state — словарь потока для сценариев с состоянием (курсор листания).
+    """
+    import requests
+
+    counter = itertools.count()
+
+    def worker():
+        session = requests.Session()
+        state = {}
+        while next(counter) < args.requests:
+            started = time.perf_counter()
+            try:
+                ok = step(session, state)
+            except Exception:
+                ok = False
+            recorder.record(time.perf_counter() - started, ok)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    recorder.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    recorder.stop()
+
+
+def index_deep(args):
+    recorder = Recorder('index_deep')
+
+    def step(session, state):
+        cursor = state.get('cursor')
+        url = f'{args.url}/forum/' + (f'?after={cursor}' if cursor else '')
+        response = session.get(url)
+        match = NEXT_PAGE.search(response.text)
+        state['depth'] = state.get('depth', 0) + 1
+        if match and state['depth'] < args.depth:
+            state['cursor'] = match.group(1)
+        else:
+            state['cursor'], state['depth'] = None, 0
+        return response.status_code == 200
+
+    run_http(recorder, args, step)
+    return [recorder]
+
+
+def topic_view(args):
+    recorder = Recorder('topic_view')
+    rng = random.Random(args.seed)
+    lock = threading.Lock()
+
+    def step(session, state):
+        with lock:
+            topic_id = rng.randint(args.first_topic, args.first_topic + args.topics - 1)
+        return session.get(f'{args.url}/forum/topic/{topic_id}').status_code == 200
+
+    run_http(recorder, args, step)
+    return [recorder]
+
+
+def login_scenario(args):
+    recorder = Recorder('login')
+    users = itertools.cycle(range(args.first_user, args.first_user + args.users))
+    lock = threading.Lock()
+
+    def step(session, state):
+        with lock:
+            user_id = next(users)
+        session.cookies.clear()
+        response = session.post(f'{args.url}/auth/login',
+                                data={'email': f'bench{user_id}@example.com', 'password': 'password123'},
+                                allow_redirects=False)
+        return response.status_code == 302
+
+    run_http(recorder, args, step)
+    return [recorder]
+
+
+def chat(args):
+    """Пары отправитель — получатель: typing, send_message, mark_read"""
+    import socketio
+
+    typing_recorder = Recorder('chat_typing')
+    send_recorder = Recorder('chat_send_message')
+    read_recorder = Recorder('chat_mark_read')
+    lock = threading.Lock()
+    delivered = threading.Semaphore(0)
+
+    def connect(user_id):
+        session = login(args.url, user_id)
+        cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+        client = socketio.Client()
+        return client, {'headers': {'Cookie': cookie}, 'transports': ['websocket']}
+
+    pairs = []
+    for pair in range(args.chat_pairs):
+        sender_id = args.first_user + 2 * pair
+        recipient_id = sender_id + 1
+        state = {'sent_at': {}, 'typing_at': None, 'read_at': []}
+        sender, sender_options = connect(sender_id)
+        recipient, recipient_options = connect(recipient_id)
+
+        def on_typing(data, state=state, sender_id=sender_id):
+            with lock:
+                started = state['typing_at']
+                if data['user_id'] == sender_id and data['typing'] and started is not None:
+                    typing_recorder.record(time.perf_counter() - started)
+                    state['typing_at'] = None
+
+        def on_message(data, state=state, recipient=recipient, sender_id=sender_id):
+            if data['sender_id'] != sender_id:
+                return
+            with lock:
+                started = state['sent_at'].pop(data['content'], None)
+                if started is None:
+                    return
+                send_recorder.record(time.perf_counter() - started)
+                state['read_at'].append(time.perf_counter())
+            recipient.emit('mark_read', {'sender_id': sender_id, 'up_to_id': data['id']})
+            delivered.release()
+
+        def on_marked_read(data, state=state):
+            with lock:
+                if state['read_at']:
+                    read_recorder.record(time.perf_counter() - state['read_at'].pop(0))
+
+        def on_error(data):
+            send_recorder.record(0, ok=False)
+            delivered.release()
+
+        recipient.on('user_typing', on_typing)
+        recipient.on('new_message', on_message)
+        recipient.on('messages_marked_read', on_marked_read)
+        sender.on('error', on_error)
+        sender.connect(args.url, **sender_options)
+        recipient.connect(args.url, **recipient_options)
+        sender.emit('join_chat', {'recipient_id': recipient_id})
+        recipient.emit('join_chat', {'recipient_id': sender_id})
+        pairs.append((sender, recipient, recipient_id, state))
+    time.sleep(1)
+
+    def send(index, client, recipient_id, state):
+        for i in range(args.chat_messages):
+            content = f'bench {index}:{i}'
+            # user_typing рассылается только при смене состояния (typing_indicator),
+            # поэтому замеров печати меньше, чем сообщений
+            with lock:
+                state['typing_at'] = time.perf_counter()
+            client.emit('typing', {'recipient_id': recipient_id})
+            with lock:
+                state['sent_at'][content] = time.perf_counter()
+            client.emit('send_message', {'recipient_id': recipient_id, 'content': content})
+            time.sleep(args.chat_pause)
+
+    threads = [threading.Thread(target=send, args=(i, sender, recipient_id, state))
+               for i, (sender, _, recipient_id, state) in enumerate(pairs)]
+    for recorder in (typing_recorder, send_recorder, read_recorder):
+        recorder.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Ждем доставки всех сообщений (не дольше 30 сек)
+    deadline = time.time() + 30
+    for _ in range(args.chat_pairs * args.chat_messages):
+        if not delivered.acquire(timeout=max(0, deadline - time.time())):
+            break
+    send_recorder.stop()
+    time.sleep(0.5)
+    typing_recorder.stop()
+    read_recorder.stop()
+
+    with lock:
+        # Недоставленные сообщения считаются ошибками
+        send_recorder.errors += sum(len(state['sent_at']) for *_, state in pairs)
+    for sender, recipient, *_ in pairs:
+        sender.disconnect()
+        recipient.disconnect()
+    return [typing_recorder, send_recorder, read_recorder]
+
+
+RUNNERS = {
+    'index_deep': index_deep,
+    'topic_view': topic_view,
+    'login': login_scenario,
+    'chat': chat,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print(f'\n{"сценарий":<20}{"запросов":>9}{"ошибок":>8}{"в сек":>9}'
+          f'{"p50 мс":>9}{"p90 мс":>9}{"p99 мс":>9}{"max мс":>9}')
+    for name, summary in results.items():
+        line = (f'{name:<20}{summary["requests"]:>9}{summary["errors"]:>8}{summary["throughput"] or 0:>9.1f}'
+                + ''.join(f'{summary[key] if summary[key] is not None else float("nan"):>9.1f}'
+                          for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')))
+        previous = (baseline or {}).get(name)
+        if previous and previous.get('p99_ms') and summary['p99_ms'] is not None:
+            line += (f'   p99 {change(summary["p99_ms"], previous["p99_ms"]):+.0%}'
+                     f', в сек {change(summary["throughput"], previous["throughput"]):+.0%}')
+        print(line)
+
+
+def change(value, previous):
+    return (value - previous) / previous if previous else 0.0
+
+
+def regressions(results, baseline, threshold):
+    """Сценарии, в которых p99 выросла или пропускная способность упала больше порога"""
+    found = []
+    for name, summary in results.items():
+        previous = baseline.get(name)
+        if not previous or summary['p99_ms'] is None:
+            continue
+        if previous.get('p99_ms') and change(summary['p99_ms'], previous['p99_ms']) > threshold:
+            found.append(f'{name}: p99 {previous["p99_ms"]} → {summary["p99_ms"]} мс')
+        if previous.get('throughput') and change(summary['throughput'], previous['throughput']) < -threshold:
+            found.append(f'{name}: {previous["throughput"]} → {summary["throughput"]} в сек')
+    return found
+
+
+def prepare_local(args):
+    """Временная база с синтетическими данными и процесс приложения"""
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'benchmark.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               CACHE_BACKEND='local',
+               SOCKETIO_MESSAGE_QUEUE='')
+    env.update(item.split('=', 1) for item in args.env)
+
+    print(f'Генерация данных: {args.users} пользователей, {args.topics} топиков, '
+          f'{args.posts} постов, {args.messages} сообщений...')
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(__file__), 'init_db.py'), '--synthetic',
+                    '--users', str(args.users), '--topics', str(args.topics), '--posts', str(args.posts),
+                    '--messages', str(args.messages), '--seed', str(args.seed)],
+                   env=env, check=True, stdout=subprocess.DEVNULL)
+
+    worker = subprocess.Popen([sys.executable, __file__, '--serve', str(args.port)], env=env)
+    wait_for_port(args.port)
+    args.url = f'http://127.0.0.1:{args.port}'
+    return worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='Адрес развернутого форума (по умолчанию локальный процесс)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'Сценарии через запятую ({", ".join(SCENARIOS)})')
+    parser.add_argument('--concurrency', type=int, default=16, help='Потоков HTTP-сценария')
+    parser.add_argument('--requests', type=int, default=1000, help='Запросов HTTP-сценария')
+    parser.add_argument('--depth', type=int, default=50, help='Глубина листания списка топиков')
+    parser.add_argument('--chat-pairs', type=int, default=20)
+    parser.add_argument('--chat-messages', type=int, default=50, help='Сообщений на отправителя')
+    parser.add_argument('--chat-pause', type=float, default=0.01, help='Пауза между сообщениями (сек)')
+    parser.add_argument('--users', type=int, default=2000, help='Пользователей bench в базе')
+    parser.add_argument('--topics', type=int, default=20000, help='Топиков в базе')
+    parser.add_argument('--posts', type=int, default=200000, help='Постов (только для локальной базы)')
+    parser.add_argument('--messages', type=int, default=50000, help='Сообщений (только для локальной базы)')
+    parser.add_argument('--first-user', type=int, default=1, help='id первого пользователя bench')
+    parser.add_argument('--first-topic', type=int, default=1, help='id первого синтетического топика')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Настройка локального процесса приложения (можно повторять)')
+    parser.add_argument('--port', type=int, default=5500)
+    parser.add_argument('--output', help='Сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON с результатами предыдущего запуска')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Допустимое ухудшение p99 и пропускной способности при --compare (доля)')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'Неизвестные сценарии: {", ".join(sorted(unknown))}')
+    if 'chat' in scenarios and args.chat_pairs * 2 > args.users:
+        parser.error('--chat-pairs: на каждую пару нужно два пользователя bench')
+
+    worker = None if args.url else prepare_local(args)
+    args.url = args.url.rstrip('/')
+    results = {}
+    try:
+        for name in scenarios:
+            print(f'Сценарий {name}...')
+            for recorder in RUNNERS[name](args):
+                results[recorder.name] = recorder.summary()
+    finally:
+        if worker is not None:
+            worker.terminate()
+            worker.wait()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['scenarios']
+    report(results, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'commit': git_commit(),
+                    'target': 'local' if worker is not None else args.url,
+                    'python': platform.python_version(),
+                    'cpus': os.cpu_count(),
+                    'env': args.env,
+                    'params': {key: value for key, value in vars(args).items()
+                               if key not in ('url', 'serve', 'output', 'compare', 'env')},
+                },
+                'scenarios': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f'\nРезультаты сохранены в {args.output}')
+
+    if baseline is not None:
+        found = regressions(results, baseline, args.max_regression)
+        for line in found:
+            print(f'✗ Регрессия {line}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Задержка доставки сообщений чата с отложенной записью и без нее
+
+Запускает процесс приложения под eventlet с временной SQLite базой.
+--pairs отправителей одновременно шлют сообщения своим собеседникам
+(--messages на отправителя, с паузой --pause сек), получатели замеряют
+время от send_message до new_message. Замер повторяется в обычном режиме
+и с CHAT_WRITE_BEHIND; после замера проверяется, что все сообщения
+записаны в БД и подтверждены событием message_persisted.
+
+Использование:
+    python scripts/chat_write_benchmark.py --pairs 20 --messages 50
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from login_storm_benchmark import serve, create_users, wait_for_port, login
+
+
+def count_messages():
+    from app import create_app, db
+    from app.models import ChatMessage
+
+    app = create_app('production')
+    with app.app_context():
+        return db.session.scalar(db.select(db.func.count(ChatMessage.id)))
+
+
+def user_ids():
+    from app import create_app, db
+    from app.models import User
+
+    app = create_app('production')
+    with app.app_context():
+        return db.session.scalars(db.select(User.id).order_by(User.id)).all()
+
+
+def connect(port, name, handlers):
+    import socketio
+
+    session = login(port, name)
+    cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+    client = socketio.Client()
+    for event, handler in handlers.items():
+        client.on(event, handler)
+    client.connect(f'http://127.0.0.1:{port}', headers={'Cookie': cookie}, transports=['websocket'])
+    return client
+
+
+def run(port, env, ids, args):
+    """Один замер: задержки доставки и число подтвержденных сообщений"""
+    worker = subprocess.Popen([sys.executable, __file__, '--serve', str(port)], env=env)
+    latencies = []
+    persisted = [0]
+    lock = threading.Lock()
+    try:
+        wait_for_port(port)
+
+        sent_at = {}
+
+        def received(data):
+            if data['sender_id'] == data['recipient_id']:
+                return
+            with lock:
+                started = sent_at.get(data['content'])
+                if started is not None:
+                    latencies.append(time.perf_counter() - started)
+
+        def acknowledged(data):
+            with lock:
+                persisted[0] += len(data['ids'])
+
+        pairs = []
+        for pair in range(args.pairs):
+            sender_id, recipient_id = ids[2 * pair], ids[2 * pair + 1]
+            recipient = connect(port, f'storm{2 * pair + 1}',
+                                {'new_message': received, 'message_persisted': acknowledged})
+            recipient.emit('join_chat', {'recipient_id': sender_id})
+            sender = connect(port, f'storm{2 * pair}', {})
+            sender.emit('join_chat', {'recipient_id': recipient_id})
+            pairs.append((sender, recipient, recipient_id))
+        time.sleep(1)
+
+        def send(index, client, recipient_id):
+            for i in range(args.messages):
+                content = f'{index}:{i}'
+                with lock:
+                    sent_at[content] = time.perf_counter()
+                client.emit('send_message', {'recipient_id': recipient_id, 'content': content})
+                time.sleep(args.pause)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=send, args=(i, sender, recipient_id))
+                   for i, (sender, _, recipient_id) in enumerate(pairs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = args.pairs * args.messages
+        deadline = time.time() + 30
+        while len(latencies) < total and time.time() < deadline:
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        # Подтверждения записи приходят после рассылки
+        time.sleep(1)
+
+        for sender, recipient, _ in pairs:
+            sender.disconnect()
+            recipient.disconnect()
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    return latencies, elapsed, persisted[0]
+
+
+def report(label, latencies, elapsed, total, stored, persisted):
+    ms = sorted(t * 1000 for t in latencies)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f'{label:<20} доставлено {len(ms):5}/{total}   p50 {statistics.median(ms):7.1f} мс   '
+          f'p95 {p95:7.1f} мс   сообщений/с {len(ms) / elapsed:7.1f}   '
+          f'в БД {stored:5}   подтверждено {persisted:5}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=50, help='Сообщений на отправителя')
+    parser.add_argument('--pause', type=float, default=0.01, help='Пауза между сообщениями (сек)')
+    parser.add_argument('--port', type=int, default=5400)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'chat.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               CACHE_BACKEND='local',
+               SOCKETIO_MESSAGE_QUEUE='',
+               PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    os.environ.update(env)
+
+    create_users(args.pairs * 2)
+    ids = user_ids()
+    total = args.pairs * args.messages
+
+    print(f'Пар: {args.pairs}, сообщений на отправителя: {args.messages}')
+    for write_behind in ('false', 'true'):
+        before = count_messages()
+        latencies, elapsed, persisted = run(args.port, dict(env, CHAT_WRITE_BEHIND=write_behind), ids, args)
+        stored = count_messages() - before
+        report('отложенная запись' if write_behind == 'true' else 'синхронная запись',
+               latencies, elapsed, total, stored, persisted)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Пропускная способность очереди писем на локальном SMTP-сервере
+
+Запускает SMTP-сервер из smtp_sink.py с задержкой ответа (имитация
+сети до почтового провайдера) и отправляет --messages писем двумя
+способами: по одному соединению на письмо (mail.send, как раньше)
+и через очередь (Outbox.drain, одно постоянное соединение). Затем
+повторяет отправку через очередь с долей временных ошибок 451
+и проверяет, что после повторов доставлены все письма.
+
+Использование:
+    python scripts/email_outbox_benchmark.py --messages 500 --delay 0.005
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from smtp_sink import SMTPSink
+
+
+def report(label, messages, elapsed, sink):
+    print(f'{label:<34} писем {sink.messages:5}   соединений {sink.connections:5}   '
+          f'{elapsed:7.2f} с   писем/с {messages / elapsed:8.1f}')
+
+
+def enqueue(outbox, db, count, prefix):
+    for i in range(count):
+        outbox.enqueue(f'Проверка {prefix} {i}', f'{prefix}{i}@example.com',
+                       'Текст письма', '<p>Текст письма</p>')
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--delay', type=float, default=0.005,
+                        help='Задержка SMTP-сервера на команду (сек)')
+    parser.add_argument('--fail-rate', type=float, default=0.2,
+                        help='Доля временных ошибок в замере повторов')
+    args = parser.parse_args()
+
+    sink = SMTPSink(delay=args.delay).start()
+
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        DATABASE_URL='sqlite:///' + os.path.join(workdir, 'outbox.db'),
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        MAIL_SERVER=sink.host,
+        MAIL_PORT=str(sink.port),
+        MAIL_USE_TLS='false',
+        MAIL_USERNAME='',
+        EMAIL_RATE_LIMIT='0',
+        EMAIL_OUTBOX_WORKER='false',
+    )
+
+    from flask_mail import Message
+    from app import create_app, db, mail
+    from app.mailer import outbox
+    from app.models import EmailMessage
+
+    app = create_app('production')
+    # Предупреждения о повторах в замере не нужны
+    app.logger.setLevel('ERROR')
+    with app.app_context():
+        db.create_all()
+
+        print(f'Писем: {args.messages}, задержка сервера: {args.delay * 1000:.0f} мс на команду')
+
+        started = time.perf_counter()
+        for i in range(args.messages):
+            msg = Message(f'Проверка {i}', sender=app.config['MAIL_DEFAULT_SENDER'],
+                          recipients=[f'direct{i}@example.com'])
+            msg.body = 'Текст письма'
+            msg.html = '<p>Текст письма</p>'
+            mail.send(msg)
+        report('соединение на письмо', args.messages, time.perf_counter() - started, sink)
+
+        sink.reset()
+        enqueue(outbox, db, args.messages, 'queued')
+        started = time.perf_counter()
+        outbox.drain()
+        outbox.close()
+        report('очередь, постоянное соединение', args.messages, time.perf_counter() - started, sink)
+
+        # Повторы: задержка повтора 0, чтобы не ждать в замере
+        sink.reset()
+        sink.fail_rate = args.fail_rate
+        outbox.retry_delay = 0
+        enqueue(outbox, db, args.messages, 'retry')
+        started = time.perf_counter()
+        rounds = 0
+        while db.session.scalar(db.select(db.func.count()).where(
+                EmailMessage.status == EmailMessage.STATUS_PENDING)) and rounds < outbox.max_attempts:
+            outbox.drain()
+            rounds += 1
+        outbox.close()
+        report(f'очередь, {args.fail_rate:.0%} ошибок 451', args.messages,
+               time.perf_counter() - started, sink)
+
+        failed = db.session.scalar(db.select(db.func.count()).where(
+            EmailMessage.status == EmailMessage.STATUS_FAILED))
+        print(f'Отклонено сервером: {sink.rejected}, проходов очереди: {rounds}, '
+              f'не доставлено: {failed}')
+
+    sink.stop()
+
+
+if __name__ == '__main__':
+    main()
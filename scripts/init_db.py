@@ -1,16 +1,44 @@
 #!/usr/bin/env python3
 """
 Скрипт для инициализации базы данных с тестовыми данными
+
+Без параметров создает трех тестовых пользователей с топиками и постами.
+С --synthetic генерирует синтетические данные для нагрузочного
+тестирования (scripts/benchmark.py): пользователей bench<id> с паролем
+password123, топики, посты и сообщения чата. Данные загружаются
+пачками через COPY (app/bulk.py), при одинаковом --seed получаются те же
+данные.
+
+Использование:
+    python scripts/init_db.py
+    python scripts/init_db.py --synthetic --users 1000000 --topics 2000000 \\
+        --posts 20000000 --messages 5000000
 """
 
+import argparse
 import os
+import random
 import sys
+import time
+from datetime import datetime, timedelta
 
 # Добавляем родительскую директорию в путь
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app, db
-from app.models import User, Topic, Post
+from app.models import User, Topic, Post, ChatMessage
+from app.site_stats import site_stats
+from app import bulk
+
+# Словарь для синтетических текстов
+WORDS = (
+    'форум сообщение вопрос ответ тема помощь настройка сервер база данных '
+    'запрос индекс страница пользователь пароль ошибка версия обновление '
+    'python flask postgres redis nginx docker deploy cache latency query'
+).split()
+
+# Начало синтетической истории: топики и сообщения идут с равным шагом
+SYNTHETIC_START = datetime(2024, 1, 1)
 
 def init_db():
     """Инициализация БД с тестовыми данными"""
@@ -109,12 +137,133 @@ def init_db():
         db.session.commit()
         print(f'✓ Создано {len(posts_data)} тестовых постов')
         
+        # Денормализованные счетчики по созданным данным
+        Topic.reconcile_counters()
+        User.reconcile_counters()
+        db.session.commit()
+        site_stats.refresh()
+        print('✓ Счетчики пересчитаны')
+        
         print('\n=== Инициализация завершена ===')
         print('Тестовые пользователи:')
         for user in users:
             print(f'  - {user.username} / {user.email} / пароль: password123')
         print('\nТеперь вы можете войти на форум используя эти данные.')
 
+def _text(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _progress(label, total):
+    started = time.perf_counter()
+
+    def report(loaded):
+        rate = loaded / max(time.perf_counter() - started, 1e-6)
+        print(f'\r  {label}: {loaded}/{total} ({rate:,.0f} строк/с)', end='', flush=True)
+        if loaded >= total:
+            print()
+    return report
+
+
+def synthetic(users, topics, posts, messages, batch_size=10000, seed=1):
+    """
+    Сгенерировать синтетические данные для нагрузочного тестирования
+
+    Строки получают id подряд от первого свободного, поэтому данные
+    можно добавлять в непустую базу.
+    """
+    app = create_app('development')
+
+    with app.app_context():
+        # Лог SQL режима разработки с миллионами строк только замедлит загрузку
+        db.engine.echo = False
+        db.create_all()
+        rng = random.Random(seed)
+
+        # Один хеш на всех: scrypt для миллиона пользователей занял бы сутки
+        sample = User(username='x', email='x')
+        sample.set_password('password123')
+        password_hash = sample.password_hash
+
+        first_user = bulk.next_id(User)
+        first_topic = bulk.next_id(Topic)
+        user_ids = range(first_user, first_user + users)
+        topic_ids = range(first_topic, first_topic + topics)
+        # Пишут в чат и на форум не все одинаково: часть активных пользователей
+        active = user_ids[:10000]
+
+        def topic_time(topic_id):
+            return SYNTHETIC_START + timedelta(minutes=topic_id - first_topic)
+
+        # Индексы строятся один раз после загрузки, а не на каждую строку
+        tables = (User, Topic, Post, ChatMessage)
+        with bulk.unlimited_statements():
+            bulk.drop_indexes(tables)
+            started = time.perf_counter()
+            print(f'Пользователи: {users}')
+            bulk.copy_rows(User, ('id', 'username', 'email', 'password_hash', 'email_verified', 'created_at'), (
+                (i, f'bench{i}', f'bench{i}@example.com', password_hash, True, SYNTHETIC_START)
+                for i in user_ids
+            ), batch_size, _progress('users', users))
+
+            print(f'Топики: {topics}')
+            bulk.copy_rows(Topic, ('id', 'title', 'content', 'author_id', 'created_at', 'updated_at', 'views'), (
+                (i, _text(rng, 3, 10).capitalize(), _text(rng, 20, 120), rng.choice(active),
+                 topic_time(i), topic_time(i), rng.randint(0, 1000))
+                for i in topic_ids
+            ), batch_size, _progress('topics', topics))
+
+            print(f'Посты: {posts}')
+
+            def post_rows():
+                for _ in range(posts):
+                    # Обсуждения неравномерны: у новых топиков больше ответов
+                    topic_id = topic_ids[min(topics - 1, int(topics * (1 - rng.random() ** 3)))]
+                    created = topic_time(topic_id) + timedelta(seconds=rng.randint(1, 30 * 86400))
+                    yield (_text(rng, 5, 60), rng.choice(active), topic_id, created, created)
+            if topics:
+                bulk.copy_rows(Post, ('content', 'author_id', 'topic_id', 'created_at', 'updated_at'),
+                               post_rows(), batch_size, _progress('posts', posts))
+
+            print(f'Сообщения чата: {messages}')
+
+            def message_rows():
+                # Переписки внутри небольших групп активных пользователей
+                for i in range(messages):
+                    sender = rng.choice(active)
+                    offset = rng.randint(1, min(20, len(active) - 1))
+                    recipient = active[(active.index(sender) + offset) % len(active)]
+                    created = SYNTHETIC_START + timedelta(seconds=i)
+                    yield (_text(rng, 1, 20), sender, recipient, created, rng.random() < 0.9)
+            if len(active) > 1:
+                bulk.copy_rows(ChatMessage, ('content', 'sender_id', 'recipient_id', 'created_at', 'is_read'),
+                               message_rows(), batch_size, _progress('messages', messages))
+
+            print(f'✓ Данные загружены за {time.perf_counter() - started:.0f} с')
+            bulk.create_indexes(tables)
+            print('✓ Индексы построены')
+            bulk.finish(tables)
+        print(f'✓ Готово за {time.perf_counter() - started:.0f} с')
+        print(f'Пользователи: bench{first_user}..bench{first_user + users - 1}@example.com / пароль: password123')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Инициализация БД тестовыми или синтетическими данными')
+    parser.add_argument('--synthetic', action='store_true', help='Сгенерировать данные для нагрузочного тестирования')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--topics', type=int, default=50000)
+    parser.add_argument('--posts', type=int, default=500000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=10000, help='Строк в одной пачке COPY')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно генератора (одинаковое — одинаковые данные)')
+    args = parser.parse_args()
+
+    if args.synthetic:
+        synthetic(args.users, args.topics, args.posts, args.messages, args.batch_size, args.seed)
+    else:
+        init_db()
+
+
 if __name__ == '__main__':
-    init_db()
+    main()
 
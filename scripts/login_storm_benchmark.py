@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Задержка событий чата во время волны входов
+
+Запускает процесс приложения под eventlet (как в продакшене: один
+процесс gunicorn с eventlet) с временной SQLite базой. Клиент Socket.IO
+непрерывно отправляет join_chat и замеряет время до ответа joined_chat,
+пока --threads потоков выполняют POST /auth/login. Замер повторяется
+с хешированием паролей в пуле потоков и без него
+(PASSWORD_HASH_OFFLOAD), печатаются p50/p95/max задержки.
+
+Использование:
+    python scripts/login_storm_benchmark.py --logins 200 --threads 16
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def serve(port):
+    """Запустить процесс приложения"""
+    import eventlet
+    eventlet.monkey_patch()
+
+    from app import create_app, socketio
+
+    app = create_app('production')
+    socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+def create_users(count):
+    """Создать схему и пользователей во временной базе"""
+    from app import create_app, db
+    from app.models import User
+
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        # Один хеш на всех: создание сотен scrypt-хешей заняло бы минуты
+        user = User(username='x', email='x')
+        user.set_password('password123')
+        password_hash = user.password_hash
+
+        db.session.execute(db.insert(User), [
+            {'username': f'storm{i}', 'email': f'storm{i}@example.com',
+             'password_hash': password_hash, 'email_verified': True}
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+def wait_for_port(port, timeout=15):
+    import socket
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Процесс на порту {port} не запустился')
+
+
+def login(port, name):
+    import requests
+
+    session = requests.Session()
+    session.post(f'http://127.0.0.1:{port}/auth/login',
+                 data={'email': f'{name}@example.com', 'password': 'password123'},
+                 allow_redirects=False)
+    return session
+
+
+def run(port, env, args):
+    """Один замер: задержки событий чата во время волны входов"""
+    import socketio
+
+    worker = subprocess.Popen([sys.executable, __file__, '--serve', str(port)], env=env)
+    try:
+        wait_for_port(port)
+
+        session = login(port, 'storm0')
+        cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+
+        client = socketio.Client()
+        reply = threading.Event()
+        client.on('joined_chat', lambda data: reply.set())
+        client.connect(f'http://127.0.0.1:{port}', headers={'Cookie': cookie},
+                       transports=['websocket'])
+
+        latencies = []
+        storm_done = threading.Event()
+
+        def ping():
+            while not storm_done.is_set():
+                reply.clear()
+                started = time.perf_counter()
+                client.emit('join_chat', {'recipient_id': 2})
+                if reply.wait(10):
+                    latencies.append(time.perf_counter() - started)
+                time.sleep(0.01)
+
+        pinger = threading.Thread(target=ping)
+        pinger.start()
+
+        counter = iter(range(args.logins))
+        counter_lock = threading.Lock()
+
+        def storm():
+            while True:
+                with counter_lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                login(port, f'storm{1 + i % (args.users - 1)}')
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=storm) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        storm_done.set()
+        pinger.join()
+        client.disconnect()
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    return latencies, elapsed
+
+
+def report(label, latencies, elapsed, logins):
+    ms = sorted(t * 1000 for t in latencies)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    print(f'{label:<24} событий {len(ms):5}   p50 {statistics.median(ms):8.1f} мс   '
+          f'p95 {p95:8.1f} мс   max {ms[-1]:8.1f} мс   входов/с {logins / elapsed:6.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200, help='Всего входов за замер')
+    parser.add_argument('--threads', type=int, default=16, help='Параллельных клиентов входа')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'storm.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               CACHE_BACKEND='local',
+               SOCKETIO_MESSAGE_QUEUE='')
+    os.environ.update(env)
+
+    create_users(args.users)
+
+    print(f'Входов: {args.logins}, параллельно: {args.threads}, '
+          f'PASSWORD_HASH_METHOD={os.environ.get("PASSWORD_HASH_METHOD", "по умолчанию")}')
+    for offload in ('false', 'true'):
+        latencies, elapsed = run(args.port, dict(env, PASSWORD_HASH_OFFLOAD=offload), args)
+        report('пул потоков' if offload == 'true' else 'в hub (без пула)', latencies, elapsed, args.logins)
+
+
+if __name__ == '__main__':
+    main()
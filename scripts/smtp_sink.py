@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Локальный SMTP-сервер для проверок и замеров очереди писем
+
+Принимает письма и никуда их не отправляет, считает соединения и
+письма. Можно задать долю ответов 451 (временная ошибка) на команду
+DATA и задержку ответа, чтобы проверить повторы и пропускную
+способность. Поддерживает только команды, которые использует smtplib
+без TLS и авторизации (MAIL_USE_TLS=false, MAIL_USERNAME пустой).
+
+Использование:
+    python scripts/smtp_sink.py --port 2525 --fail-rate 0.1
+    MAIL_SERVER=127.0.0.1 MAIL_PORT=2525 MAIL_USE_TLS=false flask forum send-emails
+
+В коде скрипты замеров запускают сервер в потоке:
+    sink = SMTPSink(port=0).start()
+    ... sink.port, sink.connections, sink.messages ...
+    sink.stop()
+"""
+
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        sink = self.server.sink
+        sink._count('connections')
+        self.reply('220 smtp-sink ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+
+            if sink.delay:
+                time.sleep(sink.delay)
+
+            if verb == 'EHLO':
+                self.reply('250-smtp-sink')
+                self.reply('250-8BITMIME')
+                self.reply('250 SIZE 52428800')
+            elif verb == 'HELO':
+                self.reply('250 smtp-sink')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                if sink.fail_rate and random.random() < sink.fail_rate:
+                    sink._count('rejected')
+                    self.reply('451 Temporary failure, try again later')
+                else:
+                    sink._count('messages')
+                    self.reply('250 OK queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SMTPSink:
+    """SMTP-сервер в фоновом потоке"""
+
+    def __init__(self, host='127.0.0.1', port=0, fail_rate=0.0, delay=0.0):
+        self.server = _Server((host, port), _Handler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.connections = 0
+        self.messages = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def reset(self):
+        with self._lock:
+            self.connections = self.messages = self.rejected = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for(self, messages, timeout=30):
+        """Дождаться, пока сервер примет messages писем"""
+        deadline = time.time() + timeout
+        while self.messages < messages and time.time() < deadline:
+            time.sleep(0.05)
+        return self.messages >= messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Доля писем, отклоняемых с кодом 451')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Задержка ответа на каждую команду (сек)')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.fail_rate, args.delay).start()
+    print(f'SMTP sink на {sink.host}:{sink.port}')
+    try:
+        while True:
+            time.sleep(5)
+            print(f'соединений {sink.connections}   писем {sink.messages}   отклонено {sink.rejected}')
+    except KeyboardInterrupt:
+        sink.stop()
+
+
+if __name__ == '__main__':
+    main()
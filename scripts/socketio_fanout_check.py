@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Проверка доставки Socket.IO событий между процессами через очередь сообщений
+
+Запускает два процесса приложения (A и B) с общей временной SQLite базой
+и общей очередью сообщений, подключает отправителя к A, получателя к B
+и проверяет, что сообщение из A доходит до клиента на B.
+
+Использование:
+    python scripts/socketio_fanout_check.py --queue redis://localhost:6379/0
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def serve(port):
+    """Запустить один процесс приложения"""
+    import eventlet
+    eventlet.monkey_patch()
+
+    from app import create_app, socketio
+
+    app = create_app('production')
+    socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+def create_users():
+    """Создать схему и двух пользователей во временной базе"""
+    from app import create_app, db
+    from app.models import User
+
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        for name in ('sender', 'receiver'):
+            user = User(username=name, email=f'{name}@example.com', email_verified=True)
+            user.set_password('password123')
+            db.session.add(user)
+        db.session.commit()
+        return [User.query.filter_by(username=name).first().id for name in ('sender', 'receiver')]
+
+
+def wait_for_port(port, timeout=15):
+    import socket
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Процесс на порту {port} не запустился')
+
+
+def connect(port, name):
+    """Войти через HTTP и подключиться к Socket.IO с cookie сессии"""
+    import requests
+    import socketio
+
+    session = requests.Session()
+    session.post(f'http://127.0.0.1:{port}/auth/login',
+                 data={'email': f'{name}@example.com', 'password': 'password123'})
+    cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+
+    client = socketio.Client()
+    client.connect(f'http://127.0.0.1:{port}', headers={'Cookie': cookie},
+                   transports=['websocket'])
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--queue', default=os.environ.get('SOCKETIO_MESSAGE_QUEUE', 'redis://localhost:6379/0'),
+                        help='URL очереди сообщений Socket.IO')
+    parser.add_argument('--ports', type=int, nargs=2, default=(5100, 5101))
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ,
+               DATABASE_URL='sqlite:///' + os.path.join(workdir, 'fanout.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               SOCKETIO_MESSAGE_QUEUE=args.queue,
+               CACHE_BACKEND='local')
+    os.environ.update(env)
+
+    _, receiver_id = create_users()
+
+    workers = [
+        subprocess.Popen([sys.executable, __file__, '--serve', str(port)], env=env)
+        for port in args.ports
+    ]
+
+    try:
+        for port in args.ports:
+            wait_for_port(port)
+
+        received = threading.Event()
+
+        receiver = connect(args.ports[1], 'receiver')
+        receiver.on('notification', lambda data: received.set())
+
+        sender = connect(args.ports[0], 'sender')
+        sender.emit('send_message', {'recipient_id': receiver_id, 'content': 'fanout check'})
+
+        ok = received.wait(10)
+
+        sender.disconnect()
+        receiver.disconnect()
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+    if ok:
+        print(f'✓ Сообщение из процесса :{args.ports[0]} доставлено клиенту процесса :{args.ports[1]}')
+    else:
+        print(f'✗ Сообщение не доставлено между процессами (очередь {args.queue})')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
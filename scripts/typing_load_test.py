@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка индикатора «печатает»
+
+Запускает процесс приложения под eventlet с временной SQLite базой и
+--pairs пар собеседников. В каждой паре один клиент шлет typing с
+частотой нажатий клавиш (--rate событий в секунду, как без ограничения
+в браузере), второй считает полученные user_typing. Отдельный клиент
+замеряет задержку ответа сервера (join_chat -> joined_chat).
+
+Прежний обработчик пересылал комнате каждое событие typing, поэтому
+объем рассылки «до» равен числу отправленных событий; «после» — число
+событий user_typing, полученных собеседниками.
+
+Использование:
+    python scripts/typing_load_test.py --pairs 50 --rate 20 --duration 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Добавляем родительскую директорию в путь
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from login_storm_benchmark import serve, wait_for_port, login
+
+
+def create_users(count):
+    """Создать схему и пользователей во временной базе"""
+    from app import create_app, db
+    from app.models import User
+
+    app = create_app('production')
+    with app.app_context():
+        db.create_all()
+        user = User(username='x', email='x')
+        user.set_password('password123')
+
+        db.session.execute(db.insert(User), [
+            {'username': f'storm{i}', 'email': f'storm{i}@example.com',
+             'password_hash': user.password_hash, 'email_verified': True}
+            for i in range(count)
+        ])
+        db.session.commit()
+        return db.session.scalars(db.select(User.id).order_by(User.id)).all()
+
+
+def connect(port, name):
+    import socketio
+
+    session = login(port, name)
+    cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+    client = socketio.Client()
+    return client, cookie
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=20, help='Событий typing в секунду на клиента')
+    parser.add_argument('--duration', type=float, default=10, help='Длительность нагрузки (сек)')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        DATABASE_URL='sqlite:///' + os.path.join(workdir, 'typing.db'),
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        CACHE_BACKEND='local',
+        SOCKETIO_MESSAGE_QUEUE='',
+        PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+    )
+    user_ids = create_users(args.pairs * 2 + 1)
+
+    worker = subprocess.Popen([sys.executable, __file__, '--serve', str(args.port)])
+    try:
+        wait_for_port(args.port)
+
+        received = [0]
+        received_lock = threading.Lock()
+
+        def count(data):
+            with received_lock:
+                received[0] += 1
+
+        typers = []
+        for pair in range(args.pairs):
+            typer_id, listener_id = user_ids[2 * pair], user_ids[2 * pair + 1]
+
+            listener, cookie = connect(args.port, f'storm{2 * pair + 1}')
+            listener.on('user_typing', count)
+            listener.connect(f'http://127.0.0.1:{args.port}', headers={'Cookie': cookie},
+                             transports=['websocket'])
+            listener.emit('join_chat', {'recipient_id': typer_id})
+
+            typer, cookie = connect(args.port, f'storm{2 * pair}')
+            typer.connect(f'http://127.0.0.1:{args.port}', headers={'Cookie': cookie},
+                          transports=['websocket'])
+            typer.emit('join_chat', {'recipient_id': listener_id})
+            typers.append((typer, listener, listener_id))
+
+        pinger, cookie = connect(args.port, f'storm{args.pairs * 2}')
+        reply = threading.Event()
+        pinger.on('joined_chat', lambda data: reply.set())
+        pinger.connect(f'http://127.0.0.1:{args.port}', headers={'Cookie': cookie},
+                       transports=['websocket'])
+        time.sleep(1)
+
+        sent = [0] * len(typers)
+        done = threading.Event()
+
+        def type_keys(index, client, recipient_id):
+            delay = 1.0 / args.rate
+            while not done.is_set():
+                client.emit('typing', {'recipient_id': recipient_id})
+                sent[index] += 1
+                time.sleep(delay)
+
+        threads = [threading.Thread(target=type_keys, args=(i, typer, recipient_id))
+                   for i, (typer, _, recipient_id) in enumerate(typers)]
+        for thread in threads:
+            thread.start()
+
+        latencies = []
+        started = time.time()
+        while time.time() - started < args.duration:
+            reply.clear()
+            ping_started = time.perf_counter()
+            pinger.emit('join_chat', {'recipient_id': user_ids[0]})
+            if reply.wait(10):
+                latencies.append((time.perf_counter() - ping_started) * 1000)
+            time.sleep(0.1)
+
+        done.set()
+        for thread in threads:
+            thread.join()
+
+        # Остановка по таймауту доходит через TYPING_TIMEOUT
+        time.sleep(7)
+
+        for typer, listener, _ in typers:
+            typer.disconnect()
+            listener.disconnect()
+        pinger.disconnect()
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    total_sent = sum(sent)
+    latencies.sort()
+    print(f'Пар: {args.pairs}, {args.rate:.0f} событий/с на клиента, {args.duration:.0f} с')
+    print(f'Отправлено typing:            {total_sent:7}   (столько рассылал прежний обработчик)')
+    print(f'Получено user_typing:         {received[0]:7}   '
+          f'(в {total_sent / max(1, received[0]):.0f} раз меньше)')
+    print(f'Задержка ответа сервера:      p50 {statistics.median(latencies):.1f} мс   '
+          f'p95 {latencies[int(len(latencies) * 0.95)]:.1f} мс')
+
+
+if __name__ == '__main__':
+    main()